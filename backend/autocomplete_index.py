@@ -0,0 +1,453 @@
+"""
+Autocomplete Index for VotaTok
+In-memory prefix index over usernames, display names and hashtags with weighted top-k completions
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+import asyncio
+import bisect
+import heapq
+import json
+import os
+import tempfile
+from datetime import datetime
+from search_index import fold_text, tokenize, extract_post_hashtags
+
+# Upper bound for every key starting with a given prefix
+MAX_KEY = "\U0010ffff"
+
+class PrefixIndex:
+    """
+    Weighted prefix index: a sorted array of keys plus a max segment tree
+    over their weights, so the top-k entries under any prefix are found in
+    O(k log n) however many keys share the prefix.
+
+    An entry can be reachable from several keys. Weight changes and removals
+    update the tree in place; entries added after the last build() live in
+    a small `recent` overlay that is scanned linearly until the next build.
+    """
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.ids: List[str] = []
+        self.weights: List[float] = []
+        self.tree: List[int] = []
+        self.size = 0
+        self.positions: Dict[str, List[int]] = {}
+        self.entry_weights: Dict[str, float] = {}
+        self.recent: Dict[str, List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.entry_weights)
+
+    def __contains__(self, entry_id: str) -> bool:
+        return entry_id in self.entry_weights
+
+    # =============  SEGMENT TREE =============
+
+    def _better(self, a: int, b: int) -> int:
+        if a < 0:
+            return b
+        if b < 0:
+            return a
+        return a if self.weights[a] >= self.weights[b] else b
+
+    def _update(self, position: int):
+        node = (position + self.size) >> 1
+        while node:
+            self.tree[node] = self._better(self.tree[2 * node], self.tree[2 * node + 1])
+            node >>= 1
+
+    def _argmax(self, lo: int, hi: int) -> int:
+        """Position of the heaviest key in [lo, hi), or -1"""
+        best = -1
+        lo += self.size
+        hi += self.size
+        while lo < hi:
+            if lo & 1:
+                best = self._better(best, self.tree[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                best = self._better(best, self.tree[hi])
+            lo >>= 1
+            hi >>= 1
+        return best
+
+    def build(self, entries: Iterable[Tuple[str, Iterable[str], float]]):
+        """Replace the whole index with (entry id, keys, weight) entries (CPU bound, run off the event loop)"""
+        pairs = []
+        self.entry_weights = {}
+        for entry_id, keys, weight in entries:
+            self.entry_weights[entry_id] = weight
+            pairs.extend((key, entry_id) for key in set(keys) if key)
+        pairs.sort()
+
+        self.keys = [key for key, _ in pairs]
+        self.ids = [entry_id for _, entry_id in pairs]
+        self.weights = [self.entry_weights[entry_id] for entry_id in self.ids]
+        self.positions = {}
+        for position, entry_id in enumerate(self.ids):
+            self.positions.setdefault(entry_id, []).append(position)
+        self.recent = {}
+
+        self.size = 1
+        while self.size < max(1, len(pairs)):
+            self.size <<= 1
+        self.tree = [-1] * (2 * self.size)
+        self.tree[self.size:self.size + len(pairs)] = range(len(pairs))
+        for node in range(self.size - 1, 0, -1):
+            self.tree[node] = self._better(self.tree[2 * node], self.tree[2 * node + 1])
+
+    # =============  UPDATES =============
+
+    def add(self, entry_id: str, keys: Iterable[str], weight: float):
+        """Add or re-key an entry"""
+        self.remove(entry_id)
+        self.entry_weights[entry_id] = weight
+        self.recent[entry_id] = sorted(set(key for key in keys if key))
+
+    def remove(self, entry_id: str):
+        self.entry_weights.pop(entry_id, None)
+        self.recent.pop(entry_id, None)
+        for position in self.positions.pop(entry_id, []):
+            self.weights[position] = -1
+            self._update(position)
+
+    def set_weight(self, entry_id: str, weight: float):
+        if entry_id not in self.entry_weights:
+            return
+        self.entry_weights[entry_id] = weight
+        for position in self.positions.get(entry_id, []):
+            self.weights[position] = weight
+            self._update(position)
+
+    # =============  QUERIES =============
+
+    def top(self, prefix: str, k: int, exclude: Iterable[str] = ()) -> List[str]:
+        """Ids of the k heaviest entries with a key starting with `prefix`"""
+        exclude = set(exclude)
+        found: Dict[str, float] = {}
+
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + MAX_KEY, lo)
+        heap = []
+        if lo < hi:
+            best = self._argmax(lo, hi)
+            heap.append((-self.weights[best], best, lo, hi))
+        while heap and len(found) < k:
+            negative_weight, position, lo, hi = heapq.heappop(heap)
+            if negative_weight > 0:
+                break  # Only removed keys left
+            entry_id = self.ids[position]
+            if entry_id not in exclude:
+                found.setdefault(entry_id, -negative_weight)
+            for sub_lo, sub_hi in ((lo, position), (position + 1, hi)):
+                if sub_lo < sub_hi:
+                    sub_best = self._argmax(sub_lo, sub_hi)
+                    heapq.heappush(heap, (-self.weights[sub_best], sub_best, sub_lo, sub_hi))
+
+        for entry_id, keys in self.recent.items():
+            if entry_id not in exclude and any(key.startswith(prefix) for key in keys):
+                found[entry_id] = self.entry_weights[entry_id]
+
+        return heapq.nlargest(k, found, key=found.get)
+
+class AutocompleteIndex:
+    """
+    Answers autocomplete keystrokes from memory: users are completed by
+    username, full display name or any display-name word and ranked by
+    follower count; hashtags are completed by tag and ranked by the number
+    of posts using them.
+
+    The index is kept current incrementally (`refresh` after writes, or
+    `apply_documents` when registered as a search index listener so other
+    workers' writes are picked up too) and follower weights are adjusted
+    on follow/unfollow. A periodic rebuild from Mongo repairs drift and is
+    written to a snapshot file, which lets a restarted worker serve
+    completions immediately instead of waiting for the first rebuild.
+    """
+
+    def __init__(self, db, snapshot_path: Optional[str] = None, snapshot_interval: int = 600):
+        self.db = db
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.users = PrefixIndex()
+        self.hashtags = PrefixIndex()
+        self.user_info: Dict[str, Dict] = {}
+        self.hashtag_text: Dict[str, str] = {}
+        self.post_hashtags: Dict[str, List[str]] = {}
+        self.ready = False
+        self.building = False
+        self.replay: List[Tuple[str, List[Dict], List[str]]] = []
+        self.snapshot_task: Optional[asyncio.Task] = None
+        self.last_built_at: Optional[datetime] = None
+        self.queries = 0
+        self.updates = 0
+
+    # =============  ENTRIES =============
+
+    def _user_keys(self, user: Dict) -> List[str]:
+        keys = [fold_text(user.get("username")), fold_text(user.get("display_name")).strip()]
+        return keys + tokenize(user.get("display_name"))
+
+    def _user_info(self, user: Dict) -> Dict:
+        return {
+            "username": user.get("username", ""),
+            "display_name": user.get("display_name") or user.get("username", ""),
+            "avatar_url": user.get("avatar_url")
+        }
+
+    def _set_user(self, user: Dict):
+        weight = self.users.entry_weights.get(user["id"], 0)
+        self.user_info[user["id"]] = self._user_info(user)
+        self.users.add(user["id"], self._user_keys(user), weight)
+
+    def _remove_user(self, user_id: str):
+        self.user_info.pop(user_id, None)
+        self.users.remove(user_id)
+
+    def _set_post(self, post_id: str, hashtags: Dict[str, str]):
+        self._remove_post(post_id)
+        if not hashtags:
+            return
+        self.post_hashtags[post_id] = list(hashtags)
+        for key, text in hashtags.items():
+            if key in self.hashtags:
+                self.hashtags.set_weight(key, self.hashtags.entry_weights[key] + 1)
+            else:
+                self.hashtag_text[key] = text
+                self.hashtags.add(key, [key], 1)
+
+    def _remove_post(self, post_id: str):
+        for key in self.post_hashtags.pop(post_id, []):
+            count = self.hashtags.entry_weights.get(key, 0) - 1
+            if count > 0:
+                self.hashtags.set_weight(key, count)
+            else:
+                self.hashtag_text.pop(key, None)
+                self.hashtags.remove(key)
+
+    # =============  BUILD & SNAPSHOTS =============
+
+    async def _install(self, users: Dict[str, Dict], weights: Dict[str, float],
+                       hashtag_text: Dict[str, str], post_hashtags: Dict[str, List[str]]):
+        """Build fresh prefix indexes off the event loop and swap them in"""
+        hashtag_counts: Dict[str, int] = {}
+        for keys in post_hashtags.values():
+            for key in keys:
+                hashtag_counts[key] = hashtag_counts.get(key, 0) + 1
+
+        user_index, hashtag_index = PrefixIndex(), PrefixIndex()
+        # Keys are computed inside the worker thread too (`users` is not shared yet)
+        await asyncio.to_thread(user_index.build, (
+            (user_id, self._user_keys(info), weights.get(user_id, 0)) for user_id, info in users.items()
+        ))
+        await asyncio.to_thread(hashtag_index.build, (
+            (key, [key], count) for key, count in hashtag_counts.items()
+        ))
+
+        self.users, self.hashtags = user_index, hashtag_index
+        self.user_info, self.post_hashtags = users, post_hashtags
+        self.hashtag_text = {key: hashtag_text.get(key, f"#{key}") for key in hashtag_counts}
+        self.ready = True
+
+    async def build(self):
+        """Rebuild every entry and weight from Mongo, then write a snapshot"""
+        self.building = True
+        self.replay = []
+        try:
+            users, weights, hashtag_text, post_hashtags = {}, {}, {}, {}
+            async for user in self.db.users.find({}, {"_id": 0, "id": 1, "username": 1, "display_name": 1, "avatar_url": 1}):
+                users[user["id"]] = self._user_info(user)
+            async for profile in self.db.user_profiles.find(
+                {"followers_count": {"$gt": 0}}, {"_id": 0, "id": 1, "followers_count": 1}
+            ):
+                if profile.get("id") in users:
+                    weights[profile["id"]] = profile["followers_count"]
+            async for post in self.db.polls.find({}, {"_id": 0, "id": 1, "title": 1, "content": 1, "tags": 1}):
+                hashtags = extract_post_hashtags(post)
+                if hashtags:
+                    post_hashtags[post["id"]] = list(hashtags)
+                    for key, text in hashtags.items():
+                        hashtag_text.setdefault(key, text)
+
+            await self._install(users, weights, hashtag_text, post_hashtags)
+        finally:
+            self.building = False
+
+        # Re-apply writes that arrived while the rebuild was reading Mongo
+        replay, self.replay = self.replay, []
+        for doc_type, docs, removed_ids in replay:
+            self.apply_documents(doc_type, docs, removed_ids)
+
+        self.last_built_at = datetime.utcnow()
+        await self.save_snapshot()
+
+    def _snapshot_data(self) -> Dict:
+        return {
+            "created_at": datetime.utcnow().isoformat(),
+            "users": [
+                [user_id, info["username"], info["display_name"], info["avatar_url"], self.users.entry_weights.get(user_id, 0)]
+                for user_id, info in self.user_info.items()
+            ],
+            "hashtags": self.hashtag_text,
+            "post_hashtags": self.post_hashtags
+        }
+
+    def _write_snapshot(self, data: Dict):
+        # Each worker writes its own temp file, so concurrent saves never
+        # interleave; the last os.replace wins with a complete snapshot
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=directory,
+            prefix=f"{os.path.basename(self.snapshot_path)}.", suffix=".tmp", delete=False
+        ) as f:
+            tmp_path = f.name
+            try:
+                json.dump(data, f, ensure_ascii=False)
+            except Exception:
+                f.close()
+                os.unlink(tmp_path)
+                raise
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        try:
+            await asyncio.to_thread(self._write_snapshot, self._snapshot_data())
+        except Exception as e:
+            print(f"❌ Autocomplete snapshot write failed: {e}")
+
+    def _read_snapshot(self) -> Optional[Dict]:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    async def load_snapshot(self) -> bool:
+        """Serve from the last snapshot until the next rebuild. Returns whether one was loaded"""
+        try:
+            data = await asyncio.to_thread(self._read_snapshot)
+            if not data:
+                return False
+
+            users, weights = {}, {}
+            for user_id, username, display_name, avatar_url, weight in data["users"]:
+                users[user_id] = {"username": username, "display_name": display_name, "avatar_url": avatar_url}
+                if weight:
+                    weights[user_id] = weight
+            await self._install(users, weights, data["hashtags"], data["post_hashtags"])
+        except Exception as e:
+            print(f"❌ Autocomplete snapshot read failed: {e}")
+            return False
+
+        print(f"🔤 Autocomplete index loaded from snapshot ({data['created_at']})")
+        return True
+
+    async def _snapshot_forever(self):
+        await self.load_snapshot()
+        while True:
+            try:
+                await self.build()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Autocomplete index rebuild failed: {e}")
+            await asyncio.sleep(self.snapshot_interval)
+
+    def start(self):
+        """Load the snapshot, then rebuild and snapshot periodically"""
+        if self.snapshot_task is None:
+            self.snapshot_task = asyncio.create_task(self._snapshot_forever())
+
+    def stop(self):
+        if self.snapshot_task is not None:
+            self.snapshot_task.cancel()
+            self.snapshot_task = None
+
+    # =============  INCREMENTAL UPDATES =============
+
+    def apply_documents(self, doc_type: str, docs: List[Dict], removed_ids: Iterable[str] = ()):
+        """Apply created/updated documents and deletions (search index listener signature)"""
+        removed_ids = list(removed_ids)
+        if self.building:
+            self.replay.append((doc_type, docs, removed_ids))
+        if doc_type == "user":
+            for user in docs:
+                self._set_user(user)
+            for user_id in removed_ids:
+                self._remove_user(user_id)
+        elif doc_type == "post":
+            for post in docs:
+                self._set_post(post["id"], extract_post_hashtags(post))
+            for post_id in removed_ids:
+                self._remove_post(post_id)
+        self.updates += 1
+
+    async def refresh(self, doc_type: str, doc_id: str):
+        """Re-read one user or post from Mongo after a write"""
+        try:
+            if doc_type == "user":
+                doc = await self.db.users.find_one(
+                    {"id": doc_id}, {"_id": 0, "id": 1, "username": 1, "display_name": 1, "avatar_url": 1}
+                )
+            else:
+                doc = await self.db.polls.find_one(
+                    {"id": doc_id}, {"_id": 0, "id": 1, "title": 1, "content": 1, "tags": 1}
+                )
+            self.apply_documents(doc_type, [doc] if doc else [], [] if doc else [doc_id])
+        except Exception as e:
+            print(f"❌ Autocomplete refresh failed for {doc_type} {doc_id}: {e}")
+
+    def adjust_user_weight(self, user_id: str, delta: int):
+        """Apply a follower count change to a user's ranking"""
+        if user_id in self.users:
+            self.users.set_weight(user_id, max(0, self.users.entry_weights[user_id] + delta))
+
+    # =============  QUERIES =============
+
+    def complete_users(self, query: str, limit: int, exclude: Iterable[str] = ()) -> List[Dict]:
+        """Top users (by followers) whose username or display name starts with `query`"""
+        self.queries += 1
+        prefix = fold_text(query.lstrip("@")).strip()
+        if not prefix:
+            return []
+        return [
+            {"id": user_id, **self.user_info[user_id], "followers_count": self.users.entry_weights[user_id]}
+            for user_id in self.users.top(prefix, limit, exclude)
+        ]
+
+    def complete_hashtags(self, query: str, limit: int) -> List[Dict]:
+        """Top hashtags (by number of posts) starting with `query`"""
+        self.queries += 1
+        prefix = fold_text(query.lstrip("#")).strip()
+        if not prefix:
+            return []
+        return [
+            {"text": self.hashtag_text[key], "count": self.hashtags.entry_weights[key]}
+            for key in self.hashtags.top(prefix, limit)
+        ]
+
+    def get_stats(self) -> Dict:
+        """Get autocomplete index statistics"""
+        return {
+            "ready": self.ready,
+            "users": len(self.users),
+            "hashtags": len(self.hashtags),
+            "recent_users": len(self.users.recent),
+            "recent_hashtags": len(self.hashtags.recent),
+            "queries": self.queries,
+            "updates": self.updates,
+            "snapshot_interval_seconds": self.snapshot_interval,
+            "last_built_at": self.last_built_at.isoformat() if self.last_built_at else None
+        }
+
+# Global instance
+autocomplete_index = None
+
+def init_autocomplete_index(db, snapshot_path: Optional[str] = None, snapshot_interval: int = 600):
+    """Initialize autocomplete index"""
+    global autocomplete_index
+    autocomplete_index = AutocompleteIndex(db, snapshot_path, snapshot_interval)
+    return autocomplete_index
@@ -0,0 +1,653 @@
+"""
+Shared Cache Subsystem for VotaTok
+Size-bounded LRU caches with per-namespace TTLs, tag/prefix invalidation
+and hit/miss/eviction counters, backed by a pluggable shared store so
+multiple uvicorn workers share hot data and invalidations
+"""
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+from collections import OrderedDict
+from datetime import date, datetime
+from enum import Enum
+import asyncio
+import base64
+import json
+import time
+import uuid
+from pydantic import BaseModel
+
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+KEY_SEPARATOR = ":"
+
+# Cached marker for lookups that are known to have no result (negative caching)
+NEGATIVE_RESULT = "__votatok_negative__"
+
+# =============  SERIALIZATION =============
+# Shared entries are stored as JSON, never pickle: anyone able to write to
+# the shared store must not be able to run code in the workers. Types JSON
+# has no representation for are wrapped in single-key tagged objects.
+
+_MODEL_CLASSES: Dict[str, type] = {}
+
+def _model_name(cls: type) -> str:
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+def _model_class(name: str) -> Optional[type]:
+    """Resolve a pydantic model among the already imported BaseModel subclasses (nothing is imported)"""
+    cls = _MODEL_CLASSES.get(name)
+    if cls is not None:
+        return cls
+    pending = [BaseModel]
+    while pending:
+        for subclass in pending.pop().__subclasses__():
+            if _model_name(subclass) == name:
+                _MODEL_CLASSES[name] = subclass
+                return subclass
+            pending.append(subclass)
+    return None
+
+def _encode_object(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        _MODEL_CLASSES[_model_name(type(value))] = type(value)
+        return {"__model__": _model_name(type(value)), "data": value.model_dump()}
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, date):
+        return {"__date__": value.isoformat()}
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": list(value)}
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} values can't be stored in the shared cache")
+
+def _decode_object(obj: Dict) -> Any:
+    if len(obj) == 1:
+        (tag, payload), = obj.items()
+        if tag == "__datetime__":
+            return datetime.fromisoformat(payload)
+        if tag == "__date__":
+            return date.fromisoformat(payload)
+        if tag == "__set__":
+            return set(payload)
+        if tag == "__bytes__":
+            return base64.b64decode(payload)
+    elif len(obj) == 2 and "__model__" in obj and "data" in obj:
+        cls = _model_class(obj["__model__"])
+        if cls is None:
+            raise ValueError(f"unknown cached model {obj['__model__']}")
+        return cls.model_validate(obj["data"])
+    return obj
+
+def dumps_entry(value: Any, tags: Iterable[str]) -> bytes:
+    """Serialize a shared cache entry (value and tags) to JSON bytes"""
+    return json.dumps({"value": value, "tags": list(tags)}, default=_encode_object).encode("utf-8")
+
+def loads_entry(raw: bytes) -> tuple:
+    """Deserialize a shared cache entry into (value, tags)"""
+    entry = json.loads(raw, object_hook=_decode_object)
+    return entry["value"], tuple(entry["tags"])
+
+# =============  SHARED BACKENDS =============
+
+class CacheBackend:
+    """
+    Shared (L2) cache store behind the per-process LRU namespaces.
+
+    Values are opaque (JSON) bytes. Indexes group keys by tag or key prefix
+    so a whole group can be dropped without scanning the store; a whole
+    namespace is dropped by its key prefix instead. Invalidation events are
+    broadcast to every worker subscribed to the backend.
+    """
+
+    name = "base"
+    shared = False
+
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float], index_keys: List[str]):
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def delete_index(self, index_key: str):
+        raise NotImplementedError
+
+    async def delete_prefix(self, prefix: str):
+        raise NotImplementedError
+
+    async def publish(self, event: Dict):
+        raise NotImplementedError
+
+    async def listen(self, handler: Callable[[Dict], None]):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class InProcessCacheBackend(CacheBackend):
+    """
+    Single-worker backend: the namespaces' local LRU is the only store and
+    invalidation events never leave the process.
+    """
+
+    name = "memory"
+    shared = False
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return None
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float], index_keys: List[str]):
+        pass
+
+    async def delete(self, key: str):
+        pass
+
+    async def delete_index(self, index_key: str):
+        pass
+
+    async def delete_prefix(self, prefix: str):
+        pass
+
+    async def publish(self, event: Dict):
+        pass
+
+    async def listen(self, handler: Callable[[Dict], None]):
+        pass
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Out-of-process backend speaking the Redis protocol (Redis, KeyDB,
+    Dragonfly, ...). Invalidation events travel over a pub/sub channel.
+
+    Indexes are sorted sets scored by each member's expiry, so members whose
+    entry expired are pruned on the next write to the index.
+    """
+
+    name = "redis"
+    shared = True
+
+    def __init__(self, url: str, key_prefix: str = "votatok:cache:"):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("redis package is not installed")
+        self.client = aioredis.from_url(url)
+        self.key_prefix = key_prefix
+        self.channel = f"{key_prefix}invalidations"
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(self.key_prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float], index_keys: List[str]):
+        expire = int(ttl) if ttl else None
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self.key_prefix + key, value, ex=expire)
+        for index_key in index_keys:
+            pipe.zadd(self.key_prefix + index_key, {key: now + expire if expire else "+inf"})
+            pipe.zremrangebyscore(self.key_prefix + index_key, "-inf", now)
+            if expire:
+                pipe.expire(self.key_prefix + index_key, expire)
+        await pipe.execute()
+
+    async def delete(self, key: str):
+        await self.client.delete(self.key_prefix + key)
+
+    async def delete_index(self, index_key: str):
+        members = await self.client.zrange(self.key_prefix + index_key, 0, -1)
+        keys = [self.key_prefix + member.decode("utf-8") for member in members]
+        await self.client.delete(self.key_prefix + index_key, *keys)
+
+    async def delete_prefix(self, prefix: str):
+        batch = []
+        async for key in self.client.scan_iter(match=f"{self.key_prefix}{prefix}*", count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                await self.client.delete(*batch)
+                batch = []
+        if batch:
+            await self.client.delete(*batch)
+
+    async def publish(self, event: Dict):
+        await self.client.publish(self.channel, json.dumps(event))
+
+    async def listen(self, handler: Callable[[Dict], None]):
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self.channel)
+        try:
+            async for message in pubsub.listen():
+                if message.get("type") == "message":
+                    handler(json.loads(message["data"]))
+        finally:
+            await pubsub.unsubscribe(self.channel)
+
+    async def close(self):
+        await self.client.close()
+
+def create_cache_backend(backend: str, redis_url: Optional[str] = None) -> CacheBackend:
+    """Build the configured backend, falling back to in-process"""
+    if backend == "redis":
+        try:
+            return RedisCacheBackend(redis_url or "redis://localhost:6379/0")
+        except Exception as e:
+            print(f"⚠️  Redis cache backend unavailable ({e}), using in-process cache")
+    return InProcessCacheBackend()
+
+# =============  NAMESPACES =============
+
+class CacheNamespace:
+    """
+    A single LRU cache with a default TTL.
+
+    Entries can carry tags, and keys built with ":" separators are indexed by
+    every prefix, so invalidate_tag / invalidate_prefix only touch the
+    matching keys instead of scanning the whole cache.
+    """
+
+    def __init__(self, name: str, max_size: int = 1000, ttl: float = 300, manager: "CacheManager" = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.manager = manager
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (value, expires_at, tags)
+        self._tag_index: Dict[str, Set[str]] = {}
+        self._prefix_index: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    # =============  INDEX MAINTENANCE =============
+
+    @staticmethod
+    def _prefixes(key: str):
+        parts = key.split(KEY_SEPARATOR)
+        for i in range(1, len(parts)):
+            yield KEY_SEPARATOR.join(parts[:i])
+
+    def _index(self, key: str, tags: Iterable[str]):
+        for tag in tags:
+            self._tag_index.setdefault(tag, set()).add(key)
+        for prefix in self._prefixes(key):
+            self._prefix_index.setdefault(prefix, set()).add(key)
+
+    def _unindex(self, key: str, tags: Iterable[str]):
+        for index, names in ((self._tag_index, tags), (self._prefix_index, self._prefixes(key))):
+            for name in names:
+                keys = index.get(name)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[name]
+
+    def _remove(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._unindex(key, entry[2])
+        return True
+
+    # =============  PUBLIC API =============
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get a cached value, or `default` if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at, _ = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and (entry[1] is None or entry[1] > time.monotonic())
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None, tags: Iterable[str] = ()):
+        """Store a value, evicting least recently used entries past max_size"""
+        if key in self._entries:
+            self._remove(key)
+
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        tags = tuple(tags)
+        self._entries[key] = (value, expires_at, tags)
+        self._index(key, tags)
+
+        while len(self._entries) > self.max_size:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def delete(self, key: str) -> bool:
+        """Remove a single key"""
+        removed = self._remove(key)
+        if removed:
+            self.invalidations += 1
+        return removed
+
+    def invalidate_tag(self, tag: str) -> int:
+        """Remove every entry carrying `tag`"""
+        keys = list(self._tag_index.get(tag, ()))
+        for key in keys:
+            self._remove(key)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def invalidate_prefix(self, prefix: str) -> int:
+        """Remove every entry whose key starts with the `prefix:` segment(s)"""
+        keys = list(self._prefix_index.get(prefix, ()))
+        if prefix in self._entries:
+            keys.append(prefix)
+        for key in keys:
+            self._remove(key)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self):
+        """Remove every entry (counters are kept)"""
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._tag_index.clear()
+        self._prefix_index.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # =============  SHARED (ASYNC) API =============
+    # The async variants read through / write through the manager's shared
+    # backend and broadcast invalidations to every worker. The sync methods
+    # above only touch this process.
+
+    def _backend_key(self, key: str) -> str:
+        return f"{self.name}{KEY_SEPARATOR}{key}"
+
+    def _index_key(self, kind: str, value: str) -> str:
+        return f"index:{self.name}:{kind}:{value}"
+
+    def _index_keys(self, key: str, tags: Iterable[str]) -> List[str]:
+        # The namespace root would index every key ever written: namespaces are flushed by key prefix (aclear)
+        return (
+            [self._index_key("tag", tag) for tag in tags] +
+            [self._index_key("prefix", prefix) for prefix in self._prefixes(key) if prefix != self.name]
+        )
+
+    @property
+    def _backend(self) -> Optional[CacheBackend]:
+        backend = self.manager.backend if self.manager else None
+        return backend if backend is not None and backend.shared else None
+
+    async def aget(self, key: str, default: Any = None) -> Any:
+        """Get from the local LRU, then from the shared backend"""
+        entry = self._entries.get(key)
+        if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+            return self.get(key, default)
+
+        backend = self._backend
+        if backend is None:
+            return self.get(key, default)
+        if entry is not None:
+            self._remove(key)
+            self.expirations += 1
+
+        try:
+            raw = await backend.get(self._backend_key(key))
+        except Exception as e:
+            print(f"⚠️  Shared cache read failed for {self.name}: {e}")
+            raw = None
+
+        if raw is None:
+            self.misses += 1
+            return default
+
+        try:
+            value, tags = loads_entry(raw)
+        except (ValueError, TypeError, KeyError) as e:
+            print(f"⚠️  Unreadable shared cache entry in {self.name}: {e}")
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.set(key, value, ttl=self.manager.local_ttl(self.ttl), tags=tags)
+        return value
+
+    async def aset(self, key: str, value: Any, ttl: Optional[float] = None, tags: Iterable[str] = ()):
+        """Store locally and in the shared backend"""
+        tags = tuple(tags)
+        backend = self._backend
+        if backend is None:
+            self.set(key, value, ttl=ttl, tags=tags)
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        self.set(key, value, ttl=self.manager.local_ttl(ttl), tags=tags)
+        try:
+            await backend.set(
+                self._backend_key(key),
+                dumps_entry(value, tags),
+                ttl,
+                self._index_keys(self._backend_key(key), tags)
+            )
+        except Exception as e:
+            print(f"⚠️  Shared cache write failed for {self.name}: {e}")
+
+    async def adelete(self, key: str) -> bool:
+        """Remove a key everywhere"""
+        removed = self.delete(key)
+        backend = self._backend
+        if backend is not None:
+            await self.manager.broadcast(self.name, "key", key, backend.delete(self._backend_key(key)))
+        return removed
+
+    async def ainvalidate_tag(self, tag: str) -> int:
+        """Remove every entry carrying `tag` in every worker"""
+        count = self.invalidate_tag(tag)
+        backend = self._backend
+        if backend is not None:
+            await self.manager.broadcast(self.name, "tag", tag, backend.delete_index(self._index_key("tag", tag)))
+        return count
+
+    async def ainvalidate_prefix(self, prefix: str) -> int:
+        """Remove every entry under `prefix` in every worker"""
+        count = self.invalidate_prefix(prefix)
+        backend = self._backend
+        if backend is not None:
+            backend_prefix = self._backend_key(prefix)
+            await self.manager.broadcast(self.name, "prefix", prefix, asyncio.gather(
+                backend.delete_index(self._index_key("prefix", backend_prefix)),
+                backend.delete(backend_prefix)
+            ))
+        return count
+
+    async def aclear(self):
+        """Remove every entry of the namespace in every worker"""
+        self.clear()
+        backend = self._backend
+        if backend is not None:
+            await self.manager.broadcast(self.name, "clear", None, asyncio.gather(
+                backend.delete_prefix(f"{self.name}{KEY_SEPARATOR}"),
+                backend.delete_prefix(f"index:{self.name}:")
+            ))
+
+    def apply_invalidation(self, op: str, value: Optional[str]):
+        """Apply an invalidation event received from another worker (local only)"""
+        if op == "key":
+            self.delete(value)
+        elif op == "tag":
+            self.invalidate_tag(value)
+        elif op == "prefix":
+            self.invalidate_prefix(value)
+        elif op == "clear":
+            self.clear()
+
+    def get_stats(self) -> Dict:
+        """Get cache statistics"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
+
+class CacheManager:
+    """Registry of named cache namespaces shared across the backend"""
+
+    def __init__(self):
+        self.namespaces: Dict[str, CacheNamespace] = {}
+        self.backend: CacheBackend = InProcessCacheBackend()
+        self.instance_id = uuid.uuid4().hex
+        self.local_ttl_cap: Optional[float] = None
+        self.listener_task: Optional[asyncio.Task] = None
+        self.events_published = 0
+        self.events_received = 0
+
+    def namespace(self, name: str, max_size: int = 1000, ttl: float = 300) -> CacheNamespace:
+        """Get a namespace, creating it with the given bounds on first use"""
+        if name not in self.namespaces:
+            self.namespaces[name] = CacheNamespace(name, max_size, ttl, manager=self)
+        return self.namespaces[name]
+
+    def configure_backend(self, backend: CacheBackend, local_ttl_cap: Optional[float] = None):
+        """
+        Select the shared backend. With a shared backend, local copies live
+        at most `local_ttl_cap` seconds so writes from other workers show up.
+        """
+        self.backend = backend
+        self.local_ttl_cap = local_ttl_cap if backend.shared else None
+
+    def local_ttl(self, ttl: Optional[float]) -> Optional[float]:
+        if not self.local_ttl_cap:
+            return ttl
+        return min(ttl, self.local_ttl_cap) if ttl else self.local_ttl_cap
+
+    async def broadcast(self, namespace: str, op: str, value: Optional[str], backend_op: Awaitable = None):
+        """Run the backend-side invalidation and tell every other worker about it"""
+        try:
+            if backend_op is not None:
+                await backend_op
+            await self.backend.publish({
+                "origin": self.instance_id,
+                "namespace": namespace,
+                "op": op,
+                "value": value
+            })
+            self.events_published += 1
+        except Exception as e:
+            print(f"⚠️  Cache invalidation broadcast failed for {namespace}: {e}")
+
+    def handle_event(self, event: Dict):
+        """Apply an invalidation event published by another worker"""
+        if event.get("origin") == self.instance_id:
+            return
+        namespace = self.namespaces.get(event.get("namespace"))
+        if namespace is not None:
+            self.events_received += 1
+            namespace.apply_invalidation(event.get("op"), event.get("value"))
+
+    async def _listen_forever(self):
+        while True:
+            try:
+                await self.backend.listen(self.handle_event)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️  Cache invalidation listener error: {e}, reconnecting...")
+                await asyncio.sleep(1)
+
+    async def start(self):
+        """Start listening for invalidation events from other workers"""
+        if self.backend.shared and self.listener_task is None:
+            self.listener_task = asyncio.create_task(self._listen_forever())
+            print(f"📡 Cache invalidation listener started ({self.backend.name})")
+
+    async def close(self):
+        """Stop the listener and release backend connections"""
+        if self.listener_task is not None:
+            self.listener_task.cancel()
+            self.listener_task = None
+        await self.backend.close()
+
+    def get_backend_info(self) -> Dict:
+        """Describe the shared backend"""
+        return {
+            "backend": self.backend.name,
+            "shared": self.backend.shared,
+            "local_ttl_cap_seconds": self.local_ttl_cap,
+            "invalidations_published": self.events_published,
+            "invalidations_received": self.events_received
+        }
+
+    def clear_all(self):
+        """Clear every namespace"""
+        for namespace in self.namespaces.values():
+            namespace.clear()
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """Get statistics for every namespace"""
+        return {name: namespace.get_stats() for name, namespace in self.namespaces.items()}
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one in-flight call.
+    Every caller awaits the same task; a caller being cancelled does not
+    cancel the shared call for the others.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every caller went away
+            task.exception()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run `fn()` for `key` unless a call for the same key is already in flight"""
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._done(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def get_stats(self) -> Dict:
+        """Get request coalescing statistics"""
+        return {
+            "in_flight": len(self._inflight),
+            "calls": self.calls,
+            "coalesced": self.coalesced
+        }
+
+# Global instance
+cache_manager = CacheManager()
@@ -65,6 +65,77 @@ class Config:
     BEHAVIOR_TRACKING_INTERVAL_SECONDS: int = int(os.getenv("BEHAVIOR_TRACKING_INTERVAL_SECONDS", "30"))
     UI_TIMEOUT_SECONDS: int = int(os.getenv("UI_TIMEOUT_SECONDS", "5"))
     
+    # Following feed materialization (fan-out-on-write)
+    FOLLOWING_TIMELINE_ENABLED: bool = os.getenv("FOLLOWING_TIMELINE_ENABLED", "false").lower() == "true"
+    TIMELINE_FANOUT_MAX_FOLLOWERS: int = int(os.getenv("TIMELINE_FANOUT_MAX_FOLLOWERS", "5000"))  # Celebrity cutoff
+    TIMELINE_BACKFILL_LIMIT: int = int(os.getenv("TIMELINE_BACKFILL_LIMIT", "200"))
+    
+    # Profile counters (incremental, repaired by a periodic reconciliation job)
+    PROFILE_RECONCILE_INTERVAL: int = int(os.getenv("PROFILE_RECONCILE_INTERVAL", "3600"))  # seconds, 0 disables
+    PROFILE_RECONCILE_BATCH_SIZE: int = int(os.getenv("PROFILE_RECONCILE_BATCH_SIZE", "500"))
+    
+    # Write-behind buffer for votes and likes (flushed as coalesced $inc updates)
+    ENGAGEMENT_WRITE_BEHIND_ENABLED: bool = os.getenv("ENGAGEMENT_WRITE_BEHIND_ENABLED", "false").lower() == "true"
+    ENGAGEMENT_FLUSH_INTERVAL_MS: int = int(os.getenv("ENGAGEMENT_FLUSH_INTERVAL_MS", "500"))
+    ENGAGEMENT_MAX_PENDING: int = int(os.getenv("ENGAGEMENT_MAX_PENDING", "5000"))  # Flush early above this
+    
+    # Sharded poll counters (votes/likes/views spread over K documents per poll)
+    SHARDED_COUNTERS_ENABLED: bool = os.getenv("SHARDED_COUNTERS_ENABLED", "false").lower() == "true"
+    SHARDED_COUNTERS_SHARDS: int = int(os.getenv("SHARDED_COUNTERS_SHARDS", "16"))
+    
+    # Buffered view ingestion (batched poll_views inserts, views counter, unique-viewer sketches)
+    VIEW_INGESTION_ENABLED: bool = os.getenv("VIEW_INGESTION_ENABLED", "true").lower() == "true"
+    VIEW_FLUSH_INTERVAL_MS: int = int(os.getenv("VIEW_FLUSH_INTERVAL_MS", "1000"))
+    VIEW_MAX_PENDING: int = int(os.getenv("VIEW_MAX_PENDING", "10000"))  # Flush early above this
+    VIEW_HLL_PRECISION: int = int(os.getenv("VIEW_HLL_PRECISION", "12"))  # 4 KB per poll, ~1.6% error
+    VIEW_SKETCH_COMPACT_INTERVAL: int = int(os.getenv("VIEW_SKETCH_COMPACT_INTERVAL", "3600"))  # seconds, 0 disables
+    
+    # Hashtag counters maintained on poll writes (trending window is SEARCH_CONFIG['TRENDING_DAYS'])
+    HASHTAG_ROLLUP_INTERVAL: int = int(os.getenv("HASHTAG_ROLLUP_INTERVAL", "3600"))  # seconds
+    
+    # Trending/recommendation rankings recomputed in the background (window is SEARCH_CONFIG['TRENDING_DAYS'])
+    TRENDING_SNAPSHOT_INTERVAL: int = int(os.getenv("TRENDING_SNAPSHOT_INTERVAL", "60"))  # seconds
+    TRENDING_SNAPSHOT_SIZE: int = int(os.getenv("TRENDING_SNAPSHOT_SIZE", "1000"))  # Polls ranked
+    TRENDING_HALF_LIFE_HOURS: float = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "24"))
+    
+    # Per-user for_you slates (candidates from recent, followed, trending and same audio/hashtag polls)
+    FEED_SLATE_SIZE: int = int(os.getenv("FEED_SLATE_SIZE", "300"))
+    FEED_SOURCE_LIMIT: int = int(os.getenv("FEED_SOURCE_LIMIT", "200"))  # Candidates per source
+    FEED_RECENT_HOURS: int = int(os.getenv("FEED_RECENT_HOURS", "48"))
+    
+    # Background loads of the next lightweight feed page, and startup warm-up of the first pages
+    FEED_PREFETCH_CONCURRENCY: int = int(os.getenv("FEED_PREFETCH_CONCURRENCY", "4"))  # Prefetches beyond this are dropped
+    FEED_WARMUP_PAGES: int = int(os.getenv("FEED_WARMUP_PAGES", "3"))
+    FEED_WARMUP_LIMIT: int = int(os.getenv("FEED_WARMUP_LIMIT", "10"))  # Page size warmed
+    
+    # Login path: password hashing worker pool, failed-login windows and batched login_attempts writes
+    LOGIN_HASH_WORKERS: int = int(os.getenv("LOGIN_HASH_WORKERS", "2"))
+    LOGIN_HASH_MAX_QUEUE: int = int(os.getenv("LOGIN_HASH_MAX_QUEUE", "100"))  # Waiting hashes before 503
+    LOGIN_RATE_WINDOW_MINUTES: int = int(os.getenv("LOGIN_RATE_WINDOW_MINUTES", "15"))
+    LOGIN_RATE_LIMIT_EMAIL: int = int(os.getenv("LOGIN_RATE_LIMIT_EMAIL", "5"))  # Failed attempts per window
+    LOGIN_RATE_LIMIT_IP: int = int(os.getenv("LOGIN_RATE_LIMIT_IP", "10"))
+    LOGIN_RATE_LIMIT_SHARED: bool = os.getenv("LOGIN_RATE_LIMIT_SHARED", "true").lower() == "true"  # Through Redis when the cache backend is
+    LOGIN_ATTEMPTS_FLUSH_INTERVAL: float = float(os.getenv("LOGIN_ATTEMPTS_FLUSH_INTERVAL", "2"))  # seconds
+    
+    # Durable background tasks (post-login side effects), run by workers in every process
+    TASK_QUEUE_WORKERS: int = int(os.getenv("TASK_QUEUE_WORKERS", "2"))
+    TASK_QUEUE_POLL_INTERVAL: float = float(os.getenv("TASK_QUEUE_POLL_INTERVAL", "1"))  # seconds
+    TASK_QUEUE_MAX_ATTEMPTS: int = int(os.getenv("TASK_QUEUE_MAX_ATTEMPTS", "5"))
+
+    # WebSocket push of message, chat request, follow and activity events
+    REALTIME_ENABLED: bool = os.getenv("REALTIME_ENABLED", "true").lower() == "true"
+    REALTIME_SHARED: bool = os.getenv("REALTIME_SHARED", "true").lower() == "true"  # Through Redis when the cache backend is
+    REALTIME_SEND_QUEUE_SIZE: int = int(os.getenv("REALTIME_SEND_QUEUE_SIZE", "100"))  # Events a client may lag before it is disconnected
+    REALTIME_MAX_CONNECTIONS_PER_USER: int = int(os.getenv("REALTIME_MAX_CONNECTIONS_PER_USER", "5"))
+    REALTIME_PING_INTERVAL: float = float(os.getenv("REALTIME_PING_INTERVAL", "25"))  # seconds
+
+    # Per-user Bloom filters of seen polls (two generations of SEEN_FILTER_CAPACITY polls each)
+    SEEN_FILTER_ENABLED: bool = os.getenv("SEEN_FILTER_ENABLED", "true").lower() == "true"
+    SEEN_FILTER_CAPACITY: int = int(os.getenv("SEEN_FILTER_CAPACITY", "2000"))
+    SEEN_FILTER_ERROR_RATE: float = float(os.getenv("SEEN_FILTER_ERROR_RATE", "0.01"))  # ~2.4 KB per generation
+    SEEN_FILTER_FLUSH_INTERVAL: float = float(os.getenv("SEEN_FILTER_FLUSH_INTERVAL", "5"))  # seconds
+    SEEN_FILTER_MAX_USERS: int = int(os.getenv("SEEN_FILTER_MAX_USERS", "10000"))  # Cached per worker
+    
     # Social Media Defaults
     DEFAULT_AVATAR_URL: str = os.getenv(
         "DEFAULT_AVATAR_URL", 
@@ -138,6 +209,9 @@ class Config:
             'CONTENT_MATCH': float(os.getenv("SEARCH_CONTENT_MULTIPLIER", "1.0")),
             'TITLE_MATCH': float(os.getenv("SEARCH_TITLE_MULTIPLIER", "1.3")),
             'HASHTAG_MATCH': float(os.getenv("SEARCH_HASHTAG_MULTIPLIER", "1.1")),
+            # Ranking boosts (see search_ranking.py): score *= 1 + POPULARITY * pop + RECENCY * recency
+            'POPULARITY': float(os.getenv("SEARCH_POPULARITY_MULTIPLIER", "0.3")),
+            'RECENCY': float(os.getenv("SEARCH_RECENCY_MULTIPLIER", "0.2")),
         },
         
         # Time-based search configuration
@@ -147,6 +221,7 @@ class Config:
         # Cache configuration
         'ENABLE_SEARCH_CACHE': os.getenv("SEARCH_ENABLE_CACHE", "true").lower() == "true",
         'CACHE_TTL_SECONDS': int(os.getenv("SEARCH_CACHE_TTL", "300")),  # 5 minutes
+        'CACHE_MAX_SIZE': int(os.getenv("SEARCH_CACHE_MAX_SIZE", "5000")),
         
         # Performance limits
         'MAX_FUZZY_RESULTS': int(os.getenv("SEARCH_MAX_FUZZY_RESULTS", "50")),
@@ -159,6 +234,64 @@ class Config:
         # Filter options
         'DEFAULT_FILTER': os.getenv("SEARCH_DEFAULT_FILTER", "all"),
         'AVAILABLE_FILTERS': ["all", "users", "posts", "hashtags", "sounds"],
+        
+        # In-memory inverted index (see search_index.py); falls back to regex queries when disabled
+        'INDEX_ENABLED': os.getenv("SEARCH_INDEX_ENABLED", "true").lower() == "true",
+        'INDEX_SYNC_INTERVAL_SECONDS': float(os.getenv("SEARCH_INDEX_SYNC_INTERVAL", "2")),
+        
+        # In-memory autocomplete index (see autocomplete_index.py), rebuilt and snapshotted periodically
+        'AUTOCOMPLETE_INDEX_ENABLED': os.getenv("AUTOCOMPLETE_INDEX_ENABLED", "true").lower() == "true",
+        'AUTOCOMPLETE_SNAPSHOT_PATH': os.getenv("AUTOCOMPLETE_SNAPSHOT_PATH", "/tmp/votatok_autocomplete.json"),
+        'AUTOCOMPLETE_SNAPSHOT_INTERVAL_SECONDS': int(os.getenv("AUTOCOMPLETE_SNAPSHOT_INTERVAL", "600")),
+    }
+    
+    # Shared cache namespaces (see cache_manager.py)
+    CACHE_CONFIG = {
+        # "memory" (per-process) or "redis" (shared across uvicorn workers)
+        'BACKEND': os.getenv("CACHE_BACKEND", "memory").lower(),
+        'REDIS_URL': os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0"),
+        # Max lifetime of a worker's local copy when a shared backend is used
+        'LOCAL_TTL_SECONDS': int(os.getenv("CACHE_LOCAL_TTL", "30")),
+        'ITUNES': {
+            'MAX_SIZE': int(os.getenv("CACHE_ITUNES_MAX_SIZE", "5000")),
+            'TTL_SECONDS': int(os.getenv("CACHE_ITUNES_TTL", "86400")),  # 24 hours
+            # Track ids / searches that returned no results
+            'NEGATIVE_TTL_SECONDS': int(os.getenv("CACHE_ITUNES_NEGATIVE_TTL", "3600")),  # 1 hour
+            # Pooled HTTP client shared by every iTunes lookup
+            'MAX_CONNECTIONS': int(os.getenv("ITUNES_MAX_CONNECTIONS", "20")),
+            'TIMEOUT_SECONDS': float(os.getenv("ITUNES_TIMEOUT", "10")),
+        },
+        'PRINCIPALS': {
+            'MAX_SIZE': int(os.getenv("CACHE_PRINCIPALS_MAX_SIZE", "10000")),
+            'TTL_SECONDS': int(os.getenv("CACHE_PRINCIPALS_TTL", "60")),  # 1 minute
+        },
+        'USER_CARDS': {
+            'MAX_SIZE': int(os.getenv("CACHE_USER_CARDS_MAX_SIZE", "20000")),
+            'TTL_SECONDS': int(os.getenv("CACHE_USER_CARDS_TTL", "600")),  # 10 minutes
+        },
+        'FOLLOW_STATUS': {
+            'MAX_SIZE': int(os.getenv("CACHE_FOLLOW_STATUS_MAX_SIZE", "20000")),
+            'TTL_SECONDS': int(os.getenv("CACHE_FOLLOW_STATUS_TTL", "600")),  # 10 minutes
+        },
+        'FEED': {
+            'MAX_SIZE': int(os.getenv("CACHE_FEED_MAX_SIZE", "2000")),
+            'TTL_SECONDS': int(os.getenv("CACHE_FEED_TTL", "300")),  # 5 minutes
+        },
+        # Ranked for_you poll ids per user
+        'FEED_SLATES': {
+            'MAX_SIZE': int(os.getenv("CACHE_FEED_SLATES_MAX_SIZE", "10000")),
+            'TTL_SECONDS': int(os.getenv("CACHE_FEED_SLATES_TTL", "600")),  # 10 minutes
+            'HISTORY_TTL_SECONDS': int(os.getenv("CACHE_FEED_SLATES_HISTORY_TTL", "86400")),  # Served slates, excluded past the slate
+        },
+        'DB_QUERY': {
+            'MAX_SIZE': int(os.getenv("CACHE_DB_QUERY_MAX_SIZE", "2000")),
+            'TTL_SECONDS': int(os.getenv("CACHE_DB_QUERY_TTL", "300")),  # 5 minutes
+        },
+        # Per-worker sums of sharded poll counters
+        'COUNTER_ROLLUPS': {
+            'MAX_SIZE': int(os.getenv("CACHE_COUNTER_ROLLUPS_MAX_SIZE", "10000")),
+            'TTL_SECONDS': int(os.getenv("CACHE_COUNTER_ROLLUPS_TTL", "2")),
+        },
     }
     
     @classmethod
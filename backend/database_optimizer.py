@@ -8,14 +8,65 @@ from typing import Dict, List, Optional, Any
 import asyncio
 from datetime import datetime, timedelta
 import json
+from feed_cursor import get_sort_fields, get_sort_spec, apply_cursor, encode_cursor
+from cache_manager import cache_manager
+from config import config
+from pymongo import UpdateOne
+
+# Markers of the last counter batches applied to a document, so a retried batch is not counted twice
+APPLIED_BATCHES_FIELD = "applied_counter_batches"
+APPLIED_BATCHES_KEPT = 100
+
+def batch_marker(batch_id: str, token: str) -> Dict:
+    """Filter and $push clauses that apply an update once per (batch, token)"""
+    marker = f"{batch_id}:{token}"
+    return {
+        "filter": {APPLIED_BATCHES_FIELD: {"$ne": marker}},
+        "push": {APPLIED_BATCHES_FIELD: {"$each": [marker], "$slice": -APPLIED_BATCHES_KEPT}}
+    }
+
+def counter_update_operations(updates: List[Dict], batch_id: Optional[str] = None) -> List[UpdateOne]:
+    """
+    Build poll counter bulk operations. Each update is either
+    {"poll_id", "type", "increment"} for a "<type>_count" field or
+    {"poll_id", "inc": {field: delta}} with an optional "option_id"
+    that positional "options.$" fields apply to.
+
+    With a `batch_id` every operation is applied at most once per batch,
+    so a batch can be written again after a partial failure.
+    """
+    bulk_ops = []
+    for update in updates:
+        if "inc" in update:
+            increments = update["inc"]
+        else:
+            counter_type = update["type"]  # "likes", "votes", "comments"
+            increments = {f"{counter_type}_count": update.get("increment", 1)}
+        
+        filter_query = {"id": update["poll_id"]}
+        if update.get("option_id"):
+            filter_query["options.id"] = update["option_id"]
+        update_doc = {"$inc": increments}
+        
+        if batch_id:
+            marker = batch_marker(batch_id, update.get("option_id") or update.get("type") or "")
+            filter_query.update(marker["filter"])
+            update_doc["$push"] = marker["push"]
+        
+        bulk_ops.append(UpdateOne(filter_query, update_doc))
+    return bulk_ops
 
 class DatabaseOptimizer:
     """Ultra-fast database operations for social media scale"""
     
     def __init__(self, db):
         self.db = db
-        self.cache = {}
-        self.cache_ttl = 300  # 5 minutes
+        # Bounded LRU/TTL cache shared through the cache manager
+        self.cache = cache_manager.namespace(
+            "db_query",
+            max_size=config.CACHE_CONFIG['DB_QUERY']['MAX_SIZE'],
+            ttl=config.CACHE_CONFIG['DB_QUERY']['TTL_SECONDS']
+        )
         
     async def initialize_indexes(self):
         """Create optimal indexes for TikTok-style queries"""
@@ -43,6 +94,27 @@ class DatabaseOptimizer:
             ("created_at", -1)
         ], name="popular_polls")
         
+        # Keyset pagination indexes - one per feed sort (see feed_cursor.FEED_SORTS; recent and for_you share the first)
+        await self.db.polls.create_index([
+            ("is_active", 1),
+            ("created_at", -1),
+            ("id", -1)
+        ], name="active_polls_keyset")
+        
+        await self.db.polls.create_index([
+            ("is_active", 1),
+            ("likes_count", -1),
+            ("total_votes", -1),
+            ("created_at", -1),
+            ("id", -1)
+        ], name="trending_keyset")
+        
+        await self.db.polls.create_index([
+            ("author_id", 1),
+            ("created_at", -1),
+            ("id", -1)
+        ], name="following_keyset")
+        
         # Users collection
         await self.db.users.create_index([("id", 1)], unique=True)
         await self.db.users.create_index([("username", 1)], unique=True)
@@ -82,29 +154,30 @@ class DatabaseOptimizer:
         user_id: str, 
         limit: int = 20, 
         offset: int = 0,
-        algorithm: str = "for_you"
+        algorithm: str = "for_you",
+        cursor: Optional[str] = None
     ) -> List[Dict]:
         """
         Ultra-optimized feed query - Single aggregation pipeline
         Replaces multiple queries with one efficient aggregation
+        Each result carries a `cursor`; pass the last one back as `cursor`
+        for keyset pagination (offset is ignored when a cursor is given)
         """
         
-        cache_key = f"feed_{algorithm}_{user_id}_{limit}_{offset}"
+        cache_key = f"feed:{algorithm}:{user_id}:{limit}:{cursor or offset}"
+        sort_fields = get_sort_fields(algorithm)
         
         # Check cache first
-        if cache_key in self.cache:
-            cached_data, timestamp = self.cache[cache_key]
-            if datetime.now().timestamp() - timestamp < self.cache_ttl:
-                return cached_data
+        cached_data = await self.cache.aget(cache_key)
+        if cached_data is not None:
+            return cached_data
         
         try:
             # Single aggregation pipeline for maximum efficiency
             pipeline = [
-                # Stage 1: Filter active polls
+                # Stage 1: Filter active polls (after the cursor position)
                 {
-                    "$match": {
-                        "is_active": True
-                    }
+                    "$match": apply_cursor({"is_active": True}, cursor, sort_fields)
                 },
                 
                 # Stage 2: Sort by algorithm
@@ -114,7 +187,7 @@ class DatabaseOptimizer:
                 
                 # Stage 3: Pagination
                 {
-                    "$skip": offset
+                    "$skip": 0 if cursor else offset
                 },
                 {
                     "$limit": limit
@@ -205,17 +278,21 @@ class DatabaseOptimizer:
                                 None
                             ]
                         },
-                        "userLiked": { "$gt": [{ "$size": "$user_like" }, 0] }
+                        "userLiked": { "$gt": [{ "$size": "$user_like" }, 0] },
+                        # Raw sort keys for the pagination cursor
+                        "sort_key": { field: f"${field}" for field in sort_fields }
                     }
                 }
             ]
             
             # Execute aggregation
-            cursor = self.db.polls.aggregate(pipeline, allowDiskUse=True)
-            results = await cursor.to_list(limit)
+            results = await self.db.polls.aggregate(pipeline, allowDiskUse=True).to_list(limit)
+            for result in results:
+                sort_key = result.pop("sort_key", {})
+                result["cursor"] = encode_cursor({**sort_key, "id": result.get("id")}, sort_fields)
             
             # Cache results
-            self.cache[cache_key] = (results, datetime.now().timestamp())
+            await self.cache.aset(cache_key, results)
             
             return results
             
@@ -224,41 +301,20 @@ class DatabaseOptimizer:
             raise
     
     def _get_sort_criteria(self, algorithm: str) -> Dict:
-        """Get sorting criteria based on algorithm"""
-        
-        algorithms = {
-            "for_you": {
-                "total_votes": -1,
-                "likes_count": -1, 
-                "created_at": -1
-            },
-            "following": {
-                "created_at": -1
-            },
-            "trending": {
-                "likes_count": -1,
-                "total_votes": -1,
-                "created_at": -1
-            },
-            "recent": {
-                "created_at": -1
-            }
-        }
-        
-        return algorithms.get(algorithm, algorithms["for_you"])
+        """Get sorting criteria based on algorithm (id is the keyset tiebreaker)"""
+        return dict(get_sort_spec(get_sort_fields(algorithm)))
     
     async def batch_user_data(self, user_ids: List[str]) -> Dict[str, Dict]:
         """
         Batch load user data to avoid N+1 queries
         """
         
-        cache_key = f"users_batch_{hash(tuple(sorted(user_ids)))}"
+        cache_key = f"users_batch:{hash(tuple(sorted(user_ids)))}"
         
         # Check cache
-        if cache_key in self.cache:
-            cached_data, timestamp = self.cache[cache_key]
-            if datetime.now().timestamp() - timestamp < self.cache_ttl:
-                return cached_data
+        cached_data = await self.cache.aget(cache_key)
+        if cached_data is not None:
+            return cached_data
         
         try:
             cursor = self.db.users.find(
@@ -276,7 +332,7 @@ class DatabaseOptimizer:
             users_dict = {user["id"]: user for user in users}
             
             # Cache results
-            self.cache[cache_key] = (users_dict, datetime.now().timestamp())
+            await self.cache.aset(cache_key, users_dict)
             
             return users_dict
             
@@ -332,22 +388,10 @@ class DatabaseOptimizer:
         """
         
         try:
-            bulk_ops = []
-            
-            for update in updates:
-                poll_id = update["poll_id"]
-                counter_type = update["type"]  # "likes", "votes", "comments"
-                increment = update.get("increment", 1)
-                
-                bulk_ops.append({
-                    "updateOne": {
-                        "filter": {"id": poll_id},
-                        "update": {"$inc": {f"{counter_type}_count": increment}}
-                    }
-                })
+            bulk_ops = counter_update_operations(updates)
             
             if bulk_ops:
-                await self.db.polls.bulk_write(bulk_ops)
+                await self.db.polls.bulk_write(bulk_ops, ordered=False)
                 print(f"✅ Updated {len(bulk_ops)} counters in batch")
             
         except Exception as e:
@@ -359,61 +403,35 @@ class DatabaseOptimizer:
         limit: int = 50
     ) -> List[Dict]:
         """
-        Get trending polls using optimized aggregation
+        Get trending polls from the precomputed trending snapshot
+        (time-decayed engagement, recomputed in the background)
         """
         
         try:
+            from trending_snapshots import trending_snapshots
+            if not trending_snapshots:
+                return []
+            
             since_time = datetime.utcnow() - timedelta(hours=time_window_hours)
+            entries = await trending_snapshots.top(limit, since=since_time)
+            authors = await self.batch_user_data(
+                list({entry["author_id"] for entry in entries if entry.get("author_id")})
+            )
             
-            pipeline = [
+            return [
                 {
-                    "$match": {
-                        "is_active": True,
-                        "created_at": {"$gte": since_time}
-                    }
-                },
-                {
-                    "$addFields": {
-                        "trending_score": {
-                            "$add": [
-                                {"$multiply": ["$likes_count", 2]},  # Likes worth 2x
-                                "$total_votes",
-                                {"$multiply": ["$comments_count", 3]}  # Comments worth 3x
-                            ]
-                        }
-                    }
-                },
-                {
-                    "$sort": {"trending_score": -1}
-                },
-                {
-                    "$limit": limit
-                },
-                {
-                    "$lookup": {
-                        "from": "users",
-                        "localField": "author_id", 
-                        "foreignField": "id",
-                        "as": "author"
-                    }
-                },
-                {
-                    "$project": {
-                        "id": 1,
-                        "title": 1,
-                        "author": {"$arrayElemAt": ["$author", 0]},
-                        "total_votes": 1,
-                        "likes_count": 1,
-                        "comments_count": 1,
-                        "trending_score": 1,
-                        "created_at": 1
-                    }
+                    "id": entry["id"],
+                    "title": entry.get("title"),
+                    "author": authors.get(entry.get("author_id")),
+                    "total_votes": entry["total_votes"],
+                    "likes_count": entry["likes_count"],
+                    "comments_count": entry["comments_count"],
+                    "trending_score": entry["score"],
+                    "created_at": entry.get("created_at")
                 }
+                for entry in entries
             ]
             
-            cursor = self.db.polls.aggregate(pipeline)
-            return await cursor.to_list(limit)
-            
         except Exception as e:
             print(f"❌ Trending polls query failed: {str(e)}")
             return []
@@ -425,10 +443,7 @@ class DatabaseOptimizer:
     
     def get_cache_stats(self) -> Dict:
         """Get cache statistics"""
-        return {
-            "cache_size": len(self.cache),
-            "cache_ttl_seconds": self.cache_ttl
-        }
+        return self.cache.get_stats()
 
 # Global instance
 db_optimizer = None
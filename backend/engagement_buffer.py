@@ -0,0 +1,494 @@
+"""
+Engagement Buffer for VotaTok
+Write-behind buffering of votes and likes, flushed as coalesced counter updates
+"""
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from collections import defaultdict
+import asyncio
+import copy
+import uuid
+from datetime import datetime
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+from models import Vote, PollLike
+from database_optimizer import counter_update_operations
+
+# Sentinel for "this (user, poll) pair has no pending change"
+NOT_PENDING = object()
+
+DUPLICATE_KEY = 11000
+
+class FlushBatch:
+    """
+    One swapped-out buffer and the writes built from it. Record ids are
+    generated once, and each step is marked done once it succeeded, so a
+    failed batch can be written again as it is.
+    """
+
+    def __init__(self, votes: Dict, likes: Dict, poll_deltas: Dict, profile_deltas: Dict):
+        self.id = uuid.uuid4().hex
+        self.votes = votes
+        self.likes = likes
+        self.poll_deltas = poll_deltas
+        self.profile_deltas = profile_deltas
+        self.vote_ops: List = []
+        self.like_ops: List = []
+        # Index in vote_ops / like_ops of each first vote or like -> ((user_id, poll_id), record id)
+        self.vote_inserts: Dict[int, Tuple[Tuple[str, str], str]] = {}
+        self.like_inserts: Dict[int, Tuple[Tuple[str, str], str]] = {}
+        self.records_written = False
+        self.counter_updates: Optional[List[Dict]] = None
+        self.counters_written = False
+        self.attempts = 0
+
+        for (user_id, poll_id), pending in votes.items():
+            if pending["option_id"] == pending["original"]:
+                continue
+            if pending["original"] is None:
+                vote = Vote(poll_id=poll_id, option_id=pending["option_id"], user_id=user_id).dict()
+                self.vote_inserts[len(self.vote_ops)] = ((user_id, poll_id), vote["id"])
+                # Insert only: a vote another worker wrote meanwhile is kept and reconciled after the write
+                self.vote_ops.append(UpdateOne(
+                    {"poll_id": poll_id, "user_id": user_id},
+                    {"$setOnInsert": vote},
+                    upsert=True
+                ))
+            else:
+                self.vote_ops.append(UpdateOne(
+                    {"poll_id": poll_id, "user_id": user_id},
+                    {"$set": {"option_id": pending["option_id"]}}
+                ))
+
+        for (user_id, poll_id), pending in likes.items():
+            if pending["liked"] == pending["original"]:
+                continue
+            if pending["liked"]:
+                like = PollLike(poll_id=poll_id, user_id=user_id).dict()
+                self.like_inserts[len(self.like_ops)] = ((user_id, poll_id), like["id"])
+                self.like_ops.append(UpdateOne(
+                    {"poll_id": poll_id, "user_id": user_id},
+                    {"$setOnInsert": like},
+                    upsert=True
+                ))
+            else:
+                self.like_ops.append(DeleteOne({"poll_id": poll_id, "user_id": user_id}))
+
+    @property
+    def record_count(self) -> int:
+        return len(self.vote_ops) + len(self.like_ops)
+
+class EngagementBuffer:
+    """
+    Accepts votes and likes into memory instead of writing them straight to
+    the poll document, which turns into a write hot-spot on viral polls.
+
+    Changes are deduped per (user, poll): only the final vote option / like
+    state is written. Every `flush_interval_ms` the buffer writes the vote
+    and like records with bulk writes and applies the coalesced per-poll
+    `$inc` deltas through DatabaseOptimizer.update_counters_batch.
+
+    Reads overlay pending deltas (overlay_poll / overlay_user_state) so users
+    see their own vote or like immediately. A batch that fails to write is
+    kept (and still overlaid) and written again before anything newer;
+    record writes are upserts and counter increments carry the batch id, so
+    a retry never applies a change twice. The buffer is per process: a
+    crash loses whatever was not flushed yet, including a batch still
+    waiting for its retry.
+    """
+
+    def __init__(
+        self,
+        db,
+        flush_interval_ms: int = 500,
+        max_pending: int = 5000,
+        on_profile_deltas: Optional[Callable[..., Awaitable]] = None
+    ):
+        self.db = db
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max_pending
+        self.on_profile_deltas = on_profile_deltas
+        self.flush_task: Optional[asyncio.Task] = None
+        self.flush_lock = asyncio.Lock()
+        self._reset()
+        # Batch currently being written (its final states are what the DB will hold)
+        self.inflight_votes: Dict[Tuple[str, str], Dict] = {}
+        self.inflight_likes: Dict[Tuple[str, str], Dict] = {}
+        self.inflight_poll_deltas: Dict[str, Dict] = {}
+        self.retry_batch: Optional[FlushBatch] = None
+
+        # Statistics
+        self.votes_buffered = 0
+        self.likes_buffered = 0
+        self.flushes = 0
+        self.records_written = 0
+        self.failed_flushes = 0
+        self.conflicts = 0
+        self.last_flush_at: Optional[datetime] = None
+
+    def _reset(self):
+        # (user_id, poll_id) -> {"original": option id in DB, "option_id": final option id}
+        self.pending_votes: Dict[Tuple[str, str], Dict] = {}
+        # (user_id, poll_id) -> {"original": liked in DB, "liked": final state}
+        self.pending_likes: Dict[Tuple[str, str], Dict] = {}
+        # poll_id -> {"total_votes": d, "likes": d, "options": {option_id: d}}
+        self.poll_deltas: Dict[str, Dict] = {}
+        # user_id -> {profile counter field: d}
+        self.profile_deltas: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def _poll_delta(self, poll_id: str) -> Dict:
+        if poll_id not in self.poll_deltas:
+            self.poll_deltas[poll_id] = {"total_votes": 0, "likes": 0, "options": defaultdict(int)}
+        return self.poll_deltas[poll_id]
+
+    def pending_count(self) -> int:
+        return len(self.pending_votes) + len(self.pending_likes)
+
+    def _maybe_flush_early(self):
+        if self.pending_count() >= self.max_pending and not self.flush_lock.locked():
+            asyncio.create_task(self.flush())
+
+    # =============  WRITE PATH =============
+
+    async def record_vote(self, user_id: str, poll: Dict, option_id: str) -> Optional[str]:
+        """
+        Buffer a vote. Returns the option the user had voted for before (if any).
+        The caller is responsible for validating `option_id` against the poll.
+        """
+        key = (user_id, poll["id"])
+        pending = self.pending_votes.get(key)
+        if pending is None:
+            inflight = self.inflight_votes.get(key)
+            if inflight is not None:
+                original = inflight["option_id"]
+            else:
+                existing_vote = await self.db.votes.find_one(
+                    {"poll_id": poll["id"], "user_id": user_id},
+                    {"_id": 0, "option_id": 1}
+                )
+                original = existing_vote["option_id"] if existing_vote else None
+            # Re-check: another request for the same pair may have been buffered meanwhile
+            pending = self.pending_votes.setdefault(
+                key, {"original": original, "option_id": original, "author_id": poll.get("author_id")}
+            )
+
+        previous = pending["option_id"]
+        if previous == option_id:
+            return previous
+
+        delta = self._poll_delta(poll["id"])
+        if previous is None:
+            delta["total_votes"] += 1
+            self.profile_deltas[user_id]["votes_count"] += 1
+            if poll.get("author_id"):
+                self.profile_deltas[poll["author_id"]]["total_votes"] += 1
+        else:
+            delta["options"][previous] -= 1
+        delta["options"][option_id] += 1
+        pending["option_id"] = option_id
+
+        self.votes_buffered += 1
+        self._maybe_flush_early()
+        return previous
+
+    async def toggle_like(self, user_id: str, poll: Dict) -> bool:
+        """Buffer a like toggle. Returns the new like state"""
+        key = (user_id, poll["id"])
+        pending = self.pending_likes.get(key)
+        if pending is None:
+            inflight = self.inflight_likes.get(key)
+            if inflight is not None:
+                original = inflight["liked"]
+            else:
+                existing_like = await self.db.poll_likes.find_one(
+                    {"poll_id": poll["id"], "user_id": user_id},
+                    {"_id": 1}
+                )
+                original = existing_like is not None
+            pending = self.pending_likes.setdefault(
+                key, {"original": original, "liked": original, "author_id": poll.get("author_id")}
+            )
+
+        liked = not pending["liked"]
+        step = 1 if liked else -1
+        self._poll_delta(poll["id"])["likes"] += step
+        self.profile_deltas[user_id]["likes_given"] += step
+        if poll.get("author_id"):
+            self.profile_deltas[poll["author_id"]]["likes_count"] += step
+        pending["liked"] = liked
+
+        self.likes_buffered += 1
+        self._maybe_flush_early()
+        return liked
+
+    # =============  READ OVERLAY =============
+
+    def overlay_poll(self, poll: Dict) -> Dict:
+        """Return a copy of a poll document with pending counter deltas applied"""
+        deltas = [
+            delta for delta in (self.inflight_poll_deltas.get(poll.get("id")), self.poll_deltas.get(poll.get("id")))
+            if delta
+        ]
+        if not deltas:
+            return poll
+
+        poll = copy.copy(poll)
+        for delta in deltas:
+            poll["total_votes"] = poll.get("total_votes", 0) + delta["total_votes"]
+            if not isinstance(poll.get("likes", 0), list):
+                poll["likes"] = poll.get("likes", 0) + delta["likes"]
+            if delta["options"]:
+                poll["options"] = [
+                    {**option, "votes": option.get("votes", 0) + delta["options"].get(option.get("id"), 0)}
+                    for option in poll.get("options", [])
+                ]
+        return poll
+
+    def get_pending_vote(self, user_id: str, poll_id: str):
+        """Pending option id for a user's vote, or NOT_PENDING"""
+        pending = self.pending_votes.get((user_id, poll_id)) or self.inflight_votes.get((user_id, poll_id))
+        return pending["option_id"] if pending else NOT_PENDING
+
+    def get_pending_like(self, user_id: str, poll_id: str):
+        """Pending like state for a user, or NOT_PENDING"""
+        pending = self.pending_likes.get((user_id, poll_id)) or self.inflight_likes.get((user_id, poll_id))
+        return pending["liked"] if pending else NOT_PENDING
+
+    def overlay_user_state(self, user_id: str, poll_ids: List[str], user_votes: Dict[str, str], liked_poll_ids: Set[str]):
+        """Apply a user's pending votes and likes to lookup maps built from the database"""
+        for poll_id in poll_ids:
+            option_id = self.get_pending_vote(user_id, poll_id)
+            if option_id is not NOT_PENDING and option_id is not None:
+                user_votes[poll_id] = option_id
+
+            liked = self.get_pending_like(user_id, poll_id)
+            if liked is True:
+                liked_poll_ids.add(poll_id)
+            elif liked is False:
+                liked_poll_ids.discard(poll_id)
+
+    # =============  FLUSH =============
+
+    def _counter_updates(self, poll_deltas: Dict[str, Dict]) -> List[Dict]:
+        updates = []
+        for poll_id, delta in poll_deltas.items():
+            poll_inc = {field: delta[field] for field in ("total_votes", "likes") if delta[field]}
+            if poll_inc:
+                updates.append({"poll_id": poll_id, "inc": poll_inc})
+            for option_id, option_delta in delta["options"].items():
+                if option_delta:
+                    updates.append({"poll_id": poll_id, "option_id": option_id, "inc": {"options.$.votes": option_delta}})
+        return updates
+
+    async def _bulk_upsert(self, collection, operations: List) -> Set[int]:
+        """Run a bulk write of upserts. Returns the indexes of the operations that inserted"""
+        try:
+            result = await collection.bulk_write(operations, ordered=False)
+            return set(result.upserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if not errors or any(error.get("code") != DUPLICATE_KEY for error in errors):
+                raise
+            # Two workers upserted the same record at once: run the losers again, they now match
+            upserted = {entry["index"] for entry in e.details.get("upserted", [])}
+            failed = [error["index"] for error in errors]
+            result = await collection.bulk_write([operations[index] for index in failed], ordered=False)
+            return upserted | {failed[index] for index in result.upserted_ids}
+
+    async def _foreign_records(self, collection, inserts: Dict, upserted: Set[int]) -> Dict[Tuple[str, str], Dict]:
+        """First votes / likes that matched a record written by someone else, by (user_id, poll_id)"""
+        candidates = {key: record_id for index, (key, record_id) in inserts.items() if index not in upserted}
+        if not candidates:
+            return {}
+        records = await collection.find(
+            {"$or": [{"user_id": user_id, "poll_id": poll_id} for user_id, poll_id in candidates]},
+            {"_id": 0, "id": 1, "user_id": 1, "poll_id": 1, "option_id": 1}
+        ).to_list(None)
+        # A record with our id was inserted by an earlier attempt of this batch
+        return {
+            (record["user_id"], record["poll_id"]): record
+            for record in records
+            if candidates.get((record["user_id"], record["poll_id"])) not in (None, record["id"])
+        }
+
+    def _cancel_vote(self, batch: FlushBatch, key: Tuple[str, str], existing_option: Optional[str]):
+        """Undo a first vote that lost to one written by another worker, and buffer the user's choice as a change"""
+        user_id, poll_id = key
+        pending = batch.votes[key]
+        option_id = pending["option_id"]
+        delta = batch.poll_deltas[poll_id]
+        delta["total_votes"] -= 1
+        delta["options"][option_id] -= 1
+        batch.profile_deltas[user_id]["votes_count"] -= 1
+        if pending.get("author_id"):
+            batch.profile_deltas[pending["author_id"]]["total_votes"] -= 1
+
+        # Later changes were buffered relative to our vote: rebase them on the stored one
+        requeued = self.pending_votes.setdefault(
+            key, {"original": option_id, "option_id": option_id, "author_id": pending.get("author_id")}
+        )
+        requeued["original"] = existing_option
+        if existing_option != option_id:
+            later = self._poll_delta(poll_id)
+            later["options"][option_id] += 1
+            later["options"][existing_option] -= 1
+
+    def _cancel_like(self, batch: FlushBatch, key: Tuple[str, str]):
+        """Undo a like that another worker had already written"""
+        user_id, poll_id = key
+        pending = batch.likes[key]
+        batch.poll_deltas[poll_id]["likes"] -= 1
+        batch.profile_deltas[user_id]["likes_given"] -= 1
+        if pending.get("author_id"):
+            batch.profile_deltas[pending["author_id"]]["likes_count"] -= 1
+
+    async def _write_records(self, batch: FlushBatch):
+        upserted_votes, upserted_likes = set(), set()
+        if batch.vote_ops:
+            upserted_votes = await self._bulk_upsert(self.db.votes, batch.vote_ops)
+        if batch.like_ops:
+            upserted_likes = await self._bulk_upsert(self.db.poll_likes, batch.like_ops)
+
+        foreign_votes = await self._foreign_records(self.db.votes, batch.vote_inserts, upserted_votes)
+        foreign_likes = await self._foreign_records(self.db.poll_likes, batch.like_inserts, upserted_likes)
+        for key, record in foreign_votes.items():
+            self._cancel_vote(batch, key, record.get("option_id"))
+        for key in foreign_likes:
+            self._cancel_like(batch, key)
+        self.conflicts += len(foreign_votes) + len(foreign_likes)
+
+    async def _write_counters(self, batch: FlushBatch):
+        from sharded_counters import sharded_counters
+
+        if batch.counter_updates is None:
+            counter_updates = self._counter_updates(batch.poll_deltas)
+            if sharded_counters:
+                counter_updates = await sharded_counters.absorb_counter_updates(counter_updates, batch.id)
+            batch.counter_updates = counter_updates
+        if batch.counter_updates:
+            await self.db.polls.bulk_write(counter_update_operations(batch.counter_updates, batch.id), ordered=False)
+
+    async def _write_profile_deltas(self, batch: FlushBatch):
+        if not self.on_profile_deltas:
+            batch.profile_deltas.clear()
+            return
+        deltas_by_user = {
+            user_id: {field: delta for field, delta in deltas.items() if delta}
+            for user_id, deltas in batch.profile_deltas.items()
+        }
+        user_ids = [user_id for user_id, deltas in deltas_by_user.items() if deltas]
+        for user_id in set(deltas_by_user) - set(user_ids):
+            del batch.profile_deltas[user_id]
+        results = await asyncio.gather(*[
+            self.on_profile_deltas(user_id, **deltas_by_user[user_id]) for user_id in user_ids
+        ], return_exceptions=True)
+        # Keep only the users whose update failed
+        errors = []
+        for user_id, result in zip(user_ids, results):
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                del batch.profile_deltas[user_id]
+        if errors:
+            raise errors[0]
+
+    async def _write_batch(self, batch: FlushBatch):
+        """Write a batch's remaining steps: records, then poll counters, then profile counters"""
+        batch.attempts += 1
+        if not batch.records_written:
+            await self._write_records(batch)
+            batch.records_written = True
+        if not batch.counters_written:
+            await self._write_counters(batch)
+            batch.counters_written = True
+        await self._write_profile_deltas(batch)
+
+    async def flush(self) -> int:
+        """
+        Write every pending change, after the batch left over by a failed
+        flush (if any). Returns the number of records written
+        """
+        async with self.flush_lock:
+            written = 0
+            # At most the retried batch and one fresh one
+            for _ in range(2):
+                if self.retry_batch is None:
+                    if not self.pending_count():
+                        break
+                    # Swap buffers before the first await so new changes go to a fresh buffer
+                    self.retry_batch = FlushBatch(self.pending_votes, self.pending_likes, self.poll_deltas, self.profile_deltas)
+                    self.inflight_votes, self.inflight_likes = self.pending_votes, self.pending_likes
+                    self.inflight_poll_deltas = self.poll_deltas
+                    self._reset()
+
+                batch = self.retry_batch
+                try:
+                    await self._write_batch(batch)
+                except Exception as e:
+                    self.failed_flushes += 1
+                    print(f"❌ Engagement buffer flush failed (attempt {batch.attempts}, kept for retry): {e}")
+                    return written
+
+                # Only now is the database caught up with the overlay
+                self.retry_batch = None
+                self.inflight_votes, self.inflight_likes = {}, {}
+                self.inflight_poll_deltas = {}
+                written += batch.record_count
+                self.flushes += 1
+                self.records_written += batch.record_count
+                self.last_flush_at = datetime.utcnow()
+            return written
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Engagement buffer flush loop error: {e}")
+
+    def start(self):
+        """Start the periodic flush loop"""
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        """Stop the flush loop and write whatever is still pending"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        if self.retry_batch is not None:
+            print(f"⚠️  Engagement buffer stopped with {self.retry_batch.record_count} unwritten records")
+
+    def get_stats(self) -> Dict:
+        """Get write-behind buffer statistics"""
+        return {
+            "pending_votes": len(self.pending_votes),
+            "pending_likes": len(self.pending_likes),
+            "pending_polls": len(self.poll_deltas),
+            "votes_buffered": self.votes_buffered,
+            "likes_buffered": self.likes_buffered,
+            "flushes": self.flushes,
+            "records_written": self.records_written,
+            "failed_flushes": self.failed_flushes,
+            "retry_pending": self.retry_batch is not None,
+            "conflicts": self.conflicts,
+            "flush_interval_ms": int(self.flush_interval * 1000),
+            "last_flush_at": self.last_flush_at.isoformat() if self.last_flush_at else None
+        }
+
+# Global instance
+engagement_buffer = None
+
+def init_engagement_buffer(
+    db,
+    flush_interval_ms: int = 500,
+    max_pending: int = 5000,
+    on_profile_deltas: Optional[Callable[..., Awaitable]] = None
+):
+    """Initialize the write-behind engagement buffer"""
+    global engagement_buffer
+    engagement_buffer = EngagementBuffer(db, flush_interval_ms, max_pending, on_profile_deltas)
+    return engagement_buffer
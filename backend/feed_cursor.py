@@ -0,0 +1,102 @@
+"""
+Keyset (cursor) pagination for VotaTok feeds
+Opaque cursors replace .skip(offset) so deep scrolls stay index-bounded
+and new polls never shift or duplicate items between pages
+"""
+from typing import List, Dict, Optional, Tuple, Any
+from datetime import datetime
+import base64
+import json
+
+# Sort keys per feed algorithm (all descending, "id" is appended as tiebreaker)
+FEED_SORTS = {
+    # Ranked pages come from the user's slate (FeedRanker); past it for_you pages
+    # by an immutable key, since scores are rewritten on every snapshot
+    "for_you": ["created_at"],
+    "following": ["created_at"],
+    "trending": ["likes_count", "total_votes", "created_at"],
+    "recent": ["created_at"]
+}
+
+def get_sort_fields(algorithm: str) -> List[str]:
+    """Get the sort keys for a feed algorithm (defaults to for_you)"""
+    return FEED_SORTS.get(algorithm, FEED_SORTS["for_you"])
+
+def get_sort_spec(sort_fields: List[str], id_field: str = "id") -> List[Tuple[str, int]]:
+    """Mongo sort specification matching the keyset filter"""
+    return [(field, -1) for field in sort_fields] + [(id_field, -1)]
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    return value
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict) and "$dt" in value:
+        return datetime.fromisoformat(value["$dt"])
+    return value
+
+def encode_cursor(doc: Dict, sort_fields: List[str]) -> Optional[str]:
+    """Build an opaque cursor pointing just after `doc` in the given sort"""
+    if not doc or not doc.get("id"):
+        return None
+    payload = {
+        "k": [_encode_value(doc.get(field)) for field in sort_fields],
+        "id": doc["id"]
+    }
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def page_cursor(docs: List[Dict], limit: int, sort_fields: List[str]) -> Optional[str]:
+    """
+    Next cursor for a page read with `limit`: None once the query returned
+    fewer documents (end of feed). Pass the raw query result, before any
+    filtering that may drop documents from the page.
+    """
+    if not docs or len(docs) < limit:
+        return None
+    return encode_cursor(docs[-1], sort_fields)
+
+def decode_cursor(cursor: str, sort_fields: List[str]) -> Tuple[List[Any], str]:
+    """Decode a cursor into (sort values, last id). Raises ValueError if malformed"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        values = [_decode_value(value) for value in payload["k"]]
+        last_id = payload["id"]
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if len(values) != len(sort_fields) or not isinstance(last_id, str):
+        raise ValueError("Cursor does not match feed sort")
+    return values, last_id
+
+def _after_value(field: str, value: Any) -> Optional[Dict]:
+    """Filter for documents that sort strictly after `value` in a descending sort"""
+    if value is None:
+        # Missing/null sorts last in descending order, nothing comes after it
+        return None
+    return {"$or": [{field: {"$lt": value}}, {field: None}]}
+
+def build_cursor_filter(cursor: str, sort_fields: List[str], id_field: str = "id") -> Dict:
+    """
+    Keyset filter selecting documents after the cursor position.
+    Raises ValueError if the cursor is malformed.
+    """
+    values, last_id = decode_cursor(cursor, sort_fields)
+
+    branches = []
+    equal_prefix = {}
+    for field, value in zip(sort_fields, values):
+        after = _after_value(field, value)
+        if after:
+            branches.append({"$and": [equal_prefix, after]} if equal_prefix else after)
+        equal_prefix = {**equal_prefix, field: value}
+    branches.append({**equal_prefix, id_field: {"$lt": last_id}})
+
+    return {"$or": branches}
+
+def apply_cursor(filter_query: Dict, cursor: Optional[str], sort_fields: List[str], id_field: str = "id") -> Dict:
+    """Combine a base filter with the keyset filter for `cursor` (if any)"""
+    if not cursor:
+        return filter_query
+    return {"$and": [filter_query, build_cursor_filter(cursor, sort_fields, id_field)]}
@@ -0,0 +1,340 @@
+"""
+Feed Ranking for VotaTok
+Per-user for_you slates built from several candidate sources and ranked by decayed engagement
+"""
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta
+from cache_manager import cache_manager
+from config import config
+from feed_cursor import encode_cursor, decode_cursor, get_sort_fields
+from trending_snapshots import decayed_score
+
+# Score multiplier per candidate source (a poll found by several sources takes the highest)
+SOURCE_BOOSTS = {
+    "recent": 1.0,
+    "trending": 1.0,
+    "following": 1.5,
+    "affinity": 1.2
+}
+
+# for_you cursors name the slate they page: inside it they carry the position,
+# past it the for_you keyset position (plain for_you keyset cursors do not decode with these)
+SLATE_PAGE = "slate"
+CONTINUATION_PAGE = "after_slate"
+SLATE_CURSOR_FIELDS = ["page", "slate_id", "slate_position"]
+CONTINUATION_CURSOR_FIELDS = ["page", "slate_id", *get_sort_fields("for_you")]
+
+# Fields needed to score a candidate
+CANDIDATE_PROJECTION = {
+    "_id": 0, "id": 1, "author_id": 1, "created_at": 1, "total_votes": 1, "likes": 1,
+    "likes_count": 1, "comments_count": 1, "views": 1
+}
+
+class FeedRanker:
+    """
+    Builds each user's for_you slate: candidates are gathered from recent
+    polls, polls by followed authors, the trending snapshot and polls sharing
+    audio or hashtags with what the user recently voted on or liked. They are
+    scored with the trending snapshot's decayed engagement model (boosted per
+    source), filtered by the user's feed preferences and by polls they already
+    voted on or viewed, and the ranked ids are cached per user.
+
+    Pages are served from the cached slate. Each build gets an id that the
+    page cursors carry: when the slate was rebuilt in between (expiry or a
+    hidden poll/author), paging resumes after the last poll served if the new
+    slate still has it, otherwise at the new slate's first page. Once a user
+    scrolls past the slate, the caller continues with the index-backed
+    for_you sort, excluding the slate the user paged; served slates are kept
+    (`HISTORY_TTL_SECONDS`) well beyond the slate TTL for that.
+    """
+
+    def __init__(
+        self,
+        db,
+        slate_size: int = 300,
+        source_limit: int = 200,
+        recent_hours: int = 48,
+        half_life_hours: float = 24
+    ):
+        self.db = db
+        self.slate_size = slate_size
+        self.source_limit = source_limit
+        self.recent_window = timedelta(hours=recent_hours)
+        self.half_life_hours = half_life_hours
+        self.slates = cache_manager.namespace(
+            "feed_slates",
+            max_size=config.CACHE_CONFIG['FEED_SLATES']['MAX_SIZE'],
+            ttl=config.CACHE_CONFIG['FEED_SLATES']['TTL_SECONDS']
+        )
+        self.history_ttl = config.CACHE_CONFIG['FEED_SLATES']['HISTORY_TTL_SECONDS']
+
+        # Statistics
+        self.slates_built = 0
+        self.last_build_ms = 0.0
+
+    async def initialize_indexes(self):
+        """Create indexes used by candidate generation"""
+
+        await self.db.polls.create_index([("music_id", 1), ("created_at", -1)], name="polls_by_music")
+        await self.db.polls.create_index([("tags", 1), ("created_at", -1)], name="polls_by_tag")
+        await self.db.poll_views.create_index([("user_id", 1), ("poll_id", 1)], name="user_poll_views")
+        await self.db.user_preferences.create_index([("user_id", 1), ("preference_type", 1)], name="user_preferences")
+
+        print("✅ Feed ranking indexes created successfully")
+
+    # =============  CANDIDATE SOURCES =============
+
+    async def _recent(self, user_id: str) -> List[str]:
+        since = datetime.utcnow() - self.recent_window
+        polls = await self.db.polls.find(
+            {"is_active": True, "created_at": {"$gte": since}}, {"_id": 0, "id": 1}
+        ).sort([("created_at", -1), ("id", -1)]).limit(self.source_limit).to_list(self.source_limit)
+        return [poll["id"] for poll in polls]
+
+    async def _following(self, user_id: str) -> List[str]:
+        follows = await self.db.follows.find(
+            {"follower_id": user_id}, {"_id": 0, "following_id": 1}
+        ).to_list(1000)
+        if not follows:
+            return []
+        polls = await self.db.polls.find(
+            {"is_active": True, "author_id": {"$in": [follow["following_id"] for follow in follows]}},
+            {"_id": 0, "id": 1}
+        ).sort([("created_at", -1), ("id", -1)]).limit(self.source_limit).to_list(self.source_limit)
+        return [poll["id"] for poll in polls]
+
+    async def _trending(self, user_id: str) -> List[str]:
+        from trending_snapshots import trending_snapshots
+        if not trending_snapshots:
+            return []
+        return [entry["id"] for entry in await trending_snapshots.top(self.source_limit)]
+
+    async def _affinity(self, user_id: str) -> List[str]:
+        """Polls sharing audio or hashtags with the user's latest votes and likes"""
+        votes, likes = await asyncio.gather(
+            self.db.votes.find({"user_id": user_id}, {"_id": 0, "poll_id": 1}).sort("created_at", -1).limit(20).to_list(20),
+            self.db.poll_likes.find({"user_id": user_id}, {"_id": 0, "poll_id": 1}).sort("created_at", -1).limit(20).to_list(20)
+        )
+        engaged_ids = list({doc["poll_id"] for doc in votes + likes})
+        if not engaged_ids:
+            return []
+
+        engaged = await self.db.polls.find(
+            {"id": {"$in": engaged_ids}}, {"_id": 0, "music_id": 1, "tags": 1}
+        ).to_list(len(engaged_ids))
+        music_ids = list({poll["music_id"] for poll in engaged if poll.get("music_id")})
+        tags = list({tag for poll in engaged for tag in poll.get("tags") or []})
+        clauses = []
+        if music_ids:
+            clauses.append({"music_id": {"$in": music_ids}})
+        if tags:
+            clauses.append({"tags": {"$in": tags}})
+        if not clauses:
+            return []
+
+        polls = await self.db.polls.find(
+            {"is_active": True, "id": {"$nin": engaged_ids}, "$or": clauses}, {"_id": 0, "id": 1}
+        ).sort([("created_at", -1), ("id", -1)]).limit(self.source_limit).to_list(self.source_limit)
+        return [poll["id"] for poll in polls]
+
+    # =============  FILTERS =============
+
+    async def _excluded(self, user_id: str, candidate_ids: List[str]) -> Tuple[Set[str], Set[str]]:
+        """(poll ids, author ids) to leave out: opted-out, already voted on or already viewed"""
+        from seen_filter import seen_filter
+        if seen_filter:
+            return await seen_filter.excluded(user_id, candidate_ids)
+        
+        preferences, votes, views = await asyncio.gather(
+            self.db.user_preferences.find(
+                {"user_id": user_id, "preference_type": {"$in": ["hidden_user", "not_interested"]}},
+                {"_id": 0, "preference_type": 1, "poll_id": 1, "author_id": 1}
+            ).to_list(1000),
+            self.db.votes.find(
+                {"user_id": user_id, "poll_id": {"$in": candidate_ids}}, {"_id": 0, "poll_id": 1}
+            ).to_list(len(candidate_ids)),
+            self.db.poll_views.distinct("poll_id", {"user_id": user_id, "poll_id": {"$in": candidate_ids}})
+        )
+        excluded = {doc["poll_id"] for doc in votes} | set(views)
+        hidden_authors = set()
+        for pref in preferences:
+            if pref["preference_type"] == "hidden_user" and pref.get("author_id"):
+                hidden_authors.add(pref["author_id"])
+            elif pref["preference_type"] == "not_interested" and pref.get("poll_id"):
+                excluded.add(pref["poll_id"])
+        return excluded, hidden_authors
+
+    # =============  SLATES =============
+
+    async def build_slate(self, user_id: str) -> List[str]:
+        """Generate, filter and rank candidates for a user"""
+        started = time.perf_counter()
+        sources = ["recent", "following", "trending", "affinity"]
+        results = await asyncio.gather(
+            self._recent(user_id),
+            self._following(user_id),
+            self._trending(user_id),
+            self._affinity(user_id),
+            return_exceptions=True
+        )
+
+        boosts: Dict[str, float] = {}
+        for source, poll_ids in zip(sources, results):
+            if isinstance(poll_ids, Exception):
+                print(f"❌ Feed candidate source '{source}' failed: {poll_ids}")
+                continue
+            for poll_id in poll_ids:
+                boosts[poll_id] = max(boosts.get(poll_id, 0), SOURCE_BOOSTS[source])
+        if not boosts:
+            return []
+
+        candidate_ids = list(boosts)
+        polls, (excluded, hidden_authors) = await asyncio.gather(
+            self.db.polls.find(
+                {"id": {"$in": candidate_ids}, "is_active": True}, CANDIDATE_PROJECTION
+            ).to_list(len(candidate_ids)),
+            self._excluded(user_id, candidate_ids)
+        )
+
+        # Counters kept outside the poll document
+        from sharded_counters import sharded_counters
+        from engagement_buffer import engagement_buffer
+        if sharded_counters:
+            polls = await sharded_counters.overlay_polls(polls)
+        if engagement_buffer:
+            polls = [engagement_buffer.overlay_poll(poll) for poll in polls]
+
+        now = datetime.utcnow()
+        scored = [
+            (decayed_score(poll, now, self.half_life_hours) * boosts[poll["id"]], poll["id"])
+            for poll in polls
+            if poll["id"] not in excluded and poll.get("author_id") not in hidden_authors
+        ]
+        scored.sort(reverse=True)
+
+        self.slates_built += 1
+        self.last_build_ms = (time.perf_counter() - started) * 1000
+        return [poll_id for _, poll_id in scored[:self.slate_size]]
+
+    def _history_key(self, user_id: str, slate_id: str) -> str:
+        return f"{user_id}:{slate_id}"
+
+    async def get_slate(self, user_id: str) -> Dict:
+        """The user's cached slate {"id", "poll_ids"} (built on first use)"""
+        slate = await self.slates.aget(user_id)
+        if slate is None:
+            slate = {"id": uuid.uuid4().hex[:12], "poll_ids": await self.build_slate(user_id)}
+            await self.slates.aset(user_id, slate)
+            await self.slates.aset(self._history_key(user_id, slate["id"]), slate["poll_ids"], ttl=self.history_ttl)
+        return slate
+
+    async def _served_slate(self, user_id: str, slate_id: Optional[str]) -> List[str]:
+        """Poll ids of a slate the user paged (the current one if it is gone)"""
+        if slate_id:
+            poll_ids = await self.slates.aget(self._history_key(user_id, slate_id))
+            if poll_ids is not None:
+                return poll_ids
+        current = await self.slates.aget(user_id)
+        return current["poll_ids"] if current else []
+
+    async def invalidate(self, user_id: str):
+        """Drop a user's slate (after they hide a poll or an author)"""
+        await self.slates.adelete(user_id)
+
+    async def get_page(self, user_id: str, limit: int, offset: int = 0, cursor: Optional[str] = None) -> Dict:
+        """
+        One page of the user's slate: {"poll_ids", "next_cursor", "slate_id", "slate", "cursor", "offset"}.
+        "poll_ids" is None when the page lies past the slate; the caller then
+        pages the for_you sort itself from "cursor" / "offset", skipping the
+        ids in "slate", and builds its next cursor with `continuation_cursor`.
+        """
+        position = offset
+        if cursor:
+            decoded = self._decode_cursor(cursor)
+            if decoded is None:
+                # Plain keyset cursor of the for_you sort
+                current = await self.slates.aget(user_id)
+                return self._continuation(current["id"] if current else None, await self._served_slate(user_id, None), cursor)
+
+            page, slate_id, values, last_id = decoded
+            if page == CONTINUATION_PAGE:
+                sort_fields = get_sort_fields("for_you")
+                keyset = encode_cursor({**dict(zip(sort_fields, values)), "id": last_id}, sort_fields)
+                return self._continuation(slate_id, await self._served_slate(user_id, slate_id), keyset)
+
+            slate = await self.get_slate(user_id)
+            if slate["id"] == slate_id:
+                position = int(values[0])
+            elif last_id in slate["poll_ids"]:
+                # Rebuilt since the previous page: resume after the last poll served
+                position = slate["poll_ids"].index(last_id) + 1
+            else:
+                position = 0
+        else:
+            slate = await self.get_slate(user_id)
+
+        poll_ids = slate["poll_ids"]
+        if position >= len(poll_ids):
+            page = self._continuation(slate["id"], poll_ids, None)
+            page["offset"] = 0 if cursor else position - len(poll_ids)
+            return page
+
+        page_ids = poll_ids[position:position + limit]
+        next_position = position + len(page_ids)
+        return {
+            "poll_ids": page_ids,
+            # At the end of the slate the cursor points past it, where the for_you sort takes over
+            "next_cursor": encode_cursor(
+                {"page": SLATE_PAGE, "slate_id": slate["id"], "slate_position": next_position, "id": page_ids[-1]},
+                SLATE_CURSOR_FIELDS
+            ),
+            "slate_id": slate["id"],
+            "slate": poll_ids,
+            "cursor": None,
+            "offset": 0
+        }
+
+    def _decode_cursor(self, cursor: str) -> Optional[Tuple[str, str, List, str]]:
+        """(page kind, slate id, position values, last poll id) of a slate or continuation cursor"""
+        for page, fields in ((SLATE_PAGE, SLATE_CURSOR_FIELDS), (CONTINUATION_PAGE, CONTINUATION_CURSOR_FIELDS)):
+            try:
+                values, last_id = decode_cursor(cursor, fields)
+            except ValueError:
+                continue
+            if values[0] == page:
+                return page, values[1], values[2:], last_id
+        return None
+
+    def _continuation(self, slate_id: Optional[str], slate: List[str], cursor: Optional[str]) -> Dict:
+        return {"poll_ids": None, "next_cursor": None, "slate_id": slate_id, "slate": slate, "cursor": cursor, "offset": 0}
+
+    def continuation_cursor(self, slate_id: Optional[str], poll: Dict) -> Optional[str]:
+        """Cursor after `poll` in the for_you sort, past the slate `slate_id`"""
+        if not slate_id:
+            return encode_cursor(poll, get_sort_fields("for_you"))
+        return encode_cursor({**poll, "page": CONTINUATION_PAGE, "slate_id": slate_id}, CONTINUATION_CURSOR_FIELDS)
+
+    def get_stats(self) -> Dict:
+        """Get feed ranking statistics"""
+        return {
+            "slates_built": self.slates_built,
+            "slate_size": self.slate_size,
+            "last_build_ms": round(self.last_build_ms, 2),
+            "slate_cache": self.slates.get_stats()
+        }
+
+# Global instance
+feed_ranker = None
+
+def init_feed_ranker(db, slate_size: int = 300, source_limit: int = 200, recent_hours: int = 48, half_life_hours: float = 24):
+    """Initialize the feed ranker"""
+    global feed_ranker
+    feed_ranker = FeedRanker(db, slate_size, source_limit, recent_hours, half_life_hours)
+
+    # Initialize indexes in background
+    asyncio.create_task(feed_ranker.initialize_indexes())
+
+    return feed_ranker
@@ -0,0 +1,246 @@
+"""
+Hashtag Statistics for VotaTok
+Per-hashtag post counts maintained at write time, with hourly buckets for trending
+"""
+from typing import Dict, List, Optional
+from collections import Counter
+import asyncio
+import re
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from search_index import fold_text, extract_post_hashtags
+
+def _post_hour(post: Dict) -> Optional[datetime]:
+    """Creation hour of a post (created_at may be a datetime or an ISO string)"""
+    created_at = post.get("created_at")
+    if isinstance(created_at, str):
+        try:
+            created_at = datetime.fromisoformat(created_at.replace("Z", "+00:00")).replace(tzinfo=None)
+        except ValueError:
+            return None
+    if not isinstance(created_at, datetime):
+        return None
+    return created_at.replace(minute=0, second=0, microsecond=0)
+
+class HashtagStats:
+    """
+    Keeps `hashtag_stats` ({tag, display, total_posts, window_posts}) and
+    `hashtag_hourly` ({tag, hour, count}) current from the poll write paths,
+    so trending hashtags and "N posts" counts are single indexed reads
+    instead of regex scans over recent polls.
+
+    `tag` is the accent-folded, lowercase hashtag without "#". Buckets are
+    keyed by the hour the post was created and expire after the trending
+    window. `window_posts` is incremented on write and recomputed from the
+    buckets by an hourly rollup, which also ages out posts that left the
+    window.
+    """
+
+    def __init__(self, db, window_days: int = 7, rollup_interval: int = 3600):
+        self.db = db
+        self.window = timedelta(days=window_days)
+        self.rollup_interval = rollup_interval
+        self.rollup_task: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.last_rollup_at: Optional[datetime] = None
+
+    async def initialize_indexes(self):
+        """Create indexes used by hashtag counters and trending reads"""
+
+        await self.db.hashtag_stats.create_index([("tag", 1)], unique=True, name="hashtag_tag")
+        await self.db.hashtag_stats.create_index([("window_posts", -1)], name="hashtag_trending")
+        await self.db.hashtag_hourly.create_index([("tag", 1), ("hour", 1)], unique=True, name="hashtag_hour")
+        await self.db.hashtag_hourly.create_index(
+            [("hour", 1)],
+            expireAfterSeconds=int(self.window.total_seconds()) + 86400,
+            name="hashtag_hour_ttl"
+        )
+
+        print("✅ Hashtag stats indexes created successfully")
+
+    # =============  WRITE PATH =============
+
+    def _window_start(self) -> datetime:
+        return (datetime.utcnow() - self.window).replace(minute=0, second=0, microsecond=0)
+
+    async def _apply(self, deltas: Dict[str, int], displays: Dict[str, str], hour: Optional[datetime]):
+        deltas = {tag: delta for tag, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        in_window = hour is not None and hour >= self._window_start()
+        now = datetime.utcnow()
+
+        stats_ops, hourly_ops = [], []
+        for tag, delta in deltas.items():
+            increments = {"total_posts": delta}
+            if in_window:
+                increments["window_posts"] = delta
+            stats_ops.append(UpdateOne(
+                {"tag": tag},
+                {"$inc": increments, "$set": {"updated_at": now}, "$setOnInsert": {"display": displays.get(tag, f"#{tag}")}},
+                upsert=delta > 0
+            ))
+            if in_window:
+                hourly_ops.append(UpdateOne(
+                    {"tag": tag, "hour": hour},
+                    {"$inc": {"count": delta}},
+                    upsert=delta > 0
+                ))
+
+        await self.db.hashtag_stats.bulk_write(stats_ops, ordered=False)
+        if hourly_ops:
+            await self.db.hashtag_hourly.bulk_write(hourly_ops, ordered=False)
+        self.writes += 1
+
+    async def record_change(self, before: Optional[Dict], after: Optional[Dict]):
+        """
+        Apply a poll create (before=None), edit (both) or delete (after=None).
+        Only hashtags that were added or removed are touched.
+        """
+        try:
+            old_tags = extract_post_hashtags(before) if before else {}
+            new_tags = extract_post_hashtags(after) if after else {}
+            deltas = Counter()
+            for tag in old_tags:
+                if tag not in new_tags:
+                    deltas[tag] -= 1
+            for tag in new_tags:
+                if tag not in old_tags:
+                    deltas[tag] += 1
+            await self._apply(deltas, new_tags, _post_hour(after or before))
+        except Exception as e:
+            print(f"❌ Hashtag stats update failed: {e}")
+
+    # =============  ROLLUP =============
+
+    async def backfill(self):
+        """Build the counters from every poll (used once, when the collections are empty)"""
+        totals, windowed, displays = Counter(), Counter(), {}
+        window_start = self._window_start()
+        async for post in self.db.polls.find({}, {"_id": 0, "title": 1, "content": 1, "tags": 1, "created_at": 1}):
+            hashtags = extract_post_hashtags(post)
+            hour = _post_hour(post)
+            for tag, display in hashtags.items():
+                displays.setdefault(tag, display)
+                totals[tag] += 1
+                if hour is not None and hour >= window_start:
+                    windowed[(tag, hour)] += 1
+
+        now = datetime.utcnow()
+        window_totals = Counter()
+        for (tag, _), count in windowed.items():
+            window_totals[tag] += count
+        if totals:
+            await self.db.hashtag_stats.bulk_write([
+                UpdateOne(
+                    {"tag": tag},
+                    {"$set": {
+                        "display": displays[tag],
+                        "total_posts": total,
+                        "window_posts": window_totals.get(tag, 0),
+                        "updated_at": now
+                    }},
+                    upsert=True
+                )
+                for tag, total in totals.items()
+            ], ordered=False)
+        if windowed:
+            await self.db.hashtag_hourly.bulk_write([
+                UpdateOne({"tag": tag, "hour": hour}, {"$set": {"count": count}}, upsert=True)
+                for (tag, hour), count in windowed.items()
+            ], ordered=False)
+        print(f"#️⃣ Hashtag stats backfilled for {len(totals)} hashtags")
+
+    async def rollup(self):
+        """Recompute window_posts from the hourly buckets and drop hashtags no post uses"""
+        started = datetime.utcnow()
+        window_start = self._window_start()
+        sums = await self.db.hashtag_hourly.aggregate([
+            {"$match": {"hour": {"$gte": window_start}}},
+            {"$group": {"_id": "$tag", "count": {"$sum": "$count"}}}
+        ]).to_list(None)
+
+        if sums:
+            await self.db.hashtag_stats.bulk_write([
+                UpdateOne({"tag": doc["_id"]}, {"$set": {"window_posts": max(0, doc["count"]), "rolled_up_at": started}})
+                for doc in sums
+            ], ordered=False)
+        # Hashtags without any bucket left in the window
+        await self.db.hashtag_stats.update_many(
+            {"window_posts": {"$ne": 0}, "$or": [
+                {"rolled_up_at": {"$lt": started}},
+                {"rolled_up_at": {"$exists": False}}
+            ]},
+            {"$set": {"window_posts": 0}}
+        )
+        await self.db.hashtag_stats.delete_many({"total_posts": {"$lte": 0}})
+        await self.db.hashtag_hourly.delete_many({"$or": [{"count": {"$lte": 0}}, {"hour": {"$lt": window_start}}]})
+        self.last_rollup_at = started
+
+    async def _rollup_forever(self):
+        try:
+            if not await self.db.hashtag_stats.find_one({}, {"_id": 1}):
+                await self.backfill()
+        except Exception as e:
+            print(f"❌ Hashtag stats backfill failed: {e}")
+        while True:
+            await asyncio.sleep(self.rollup_interval)
+            try:
+                await self.rollup()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Hashtag stats rollup failed: {e}")
+
+    def start(self):
+        """Backfill if needed and start the hourly rollup"""
+        if self.rollup_task is None:
+            self.rollup_task = asyncio.create_task(self._rollup_forever())
+
+    def stop(self):
+        if self.rollup_task is not None:
+            self.rollup_task.cancel()
+            self.rollup_task = None
+
+    # =============  READS =============
+
+    async def get_trending(self, limit: int = 10) -> List[Dict]:
+        """Hashtags with the most posts created inside the trending window"""
+        docs = await self.db.hashtag_stats.find(
+            {"window_posts": {"$gt": 0}},
+            {"_id": 0, "display": 1, "window_posts": 1}
+        ).sort("window_posts", -1).limit(limit).to_list(limit)
+        return [{"hashtag": doc["display"], "count": doc["window_posts"]} for doc in docs]
+
+    async def complete(self, prefix: str, limit: int) -> List[Dict]:
+        """Hashtags starting with `prefix`, most used first"""
+        prefix = fold_text(prefix.lstrip("#")).strip()
+        if not prefix:
+            return []
+        docs = await self.db.hashtag_stats.find(
+            {"tag": {"$regex": f"^{re.escape(prefix)}"}, "total_posts": {"$gt": 0}},
+            {"_id": 0, "display": 1, "total_posts": 1}
+        ).sort("total_posts", -1).limit(limit).to_list(limit)
+        return [{"text": doc["display"], "count": doc["total_posts"]} for doc in docs]
+
+    def get_stats(self) -> Dict:
+        """Get hashtag stats statistics"""
+        return {
+            "writes": self.writes,
+            "window_days": self.window.days,
+            "rollup_interval_seconds": self.rollup_interval,
+            "last_rollup_at": self.last_rollup_at.isoformat() if self.last_rollup_at else None
+        }
+
+# Global instance
+hashtag_stats = None
+
+def init_hashtag_stats(db, window_days: int = 7, rollup_interval: int = 3600):
+    """Initialize hashtag stats"""
+    global hashtag_stats
+    hashtag_stats = HashtagStats(db, window_days, rollup_interval)
+
+    # Initialize indexes in background
+    asyncio.create_task(hashtag_stats.initialize_indexes())
+
+    return hashtag_stats
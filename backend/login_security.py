@@ -0,0 +1,341 @@
+"""
+Login Security for VotaTok
+Password hashing in a bounded worker pool, sliding-window login rate limits and batched login attempt writes
+"""
+from typing import Deque, Dict, List, Optional
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo.errors import BulkWriteError
+from auth import verify_password, get_password_hash
+
+DUPLICATE_KEY = 11000
+
+class PasswordPoolBusy(Exception):
+    """Raised when too many password hashes are already waiting for a worker"""
+
+class PasswordHasher:
+    """
+    Runs password hashing and verification (argon2/bcrypt, ~100-300 ms of
+    CPU each) on a small thread pool so they never block the event loop.
+    At most `max_queue` calls wait for a worker; beyond that they fail fast
+    with PasswordPoolBusy instead of piling up during login bursts.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 100):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password")
+        self.slots = asyncio.Semaphore(workers)
+
+        # Statistics
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_ms = 0.0
+        self.total_run_ms = 0.0
+
+    async def _run(self, fn, *args):
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise PasswordPoolBusy("Password worker pool is saturated")
+
+        queued_at = time.perf_counter()
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+
+        started = time.perf_counter()
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.running -= 1
+            self.slots.release()
+            self.completed += 1
+            self.total_wait_ms += (started - queued_at) * 1000
+            self.total_run_ms += (time.perf_counter() - started) * 1000
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def get_stats(self) -> Dict:
+        """Get password pool statistics"""
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queue_depth": self.queued,
+            "max_queue_depth": self.max_queued,
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait_ms / self.completed, 2) if self.completed else 0.0,
+            "avg_run_ms": round(self.total_run_ms / self.completed, 2) if self.completed else 0.0
+        }
+
+class SlidingWindowCounter:
+    """
+    Timestamps of recent events per key (e.g. failed logins per email),
+    counted over the last `window` seconds. Only the newest `max_events`
+    per key are kept (counts saturate there, which is all a limit needs)
+    and keys are kept in LRU order, capped at `max_keys`. When a Redis
+    client is given, events go to one sorted set per key so every worker
+    sees the same counts.
+    """
+
+    def __init__(self, name: str, window: float, max_events: int, max_keys: int = 100000, redis_client=None):
+        self.name = name
+        self.window = window
+        self.max_events = max_events
+        self.max_keys = max_keys
+        self.redis = redis_client
+        self.events: "OrderedDict[str, Deque[float]]" = OrderedDict()
+
+    def _local(self, key: str, now: float) -> Deque[float]:
+        events = self.events.get(key)
+        if events is None:
+            events = self.events[key] = deque(maxlen=self.max_events)
+            while len(self.events) > self.max_keys:
+                self.events.popitem(last=False)
+        else:
+            self.events.move_to_end(key)
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        return events
+
+    def _redis_key(self, key: str) -> str:
+        return f"votatok:ratelimit:{self.name}:{key}"
+
+    async def add(self, key: str, at: Optional[float] = None):
+        """Record one event (at `at`, a Unix timestamp, or now)"""
+        at = at or time.time()
+        if self.redis is not None:
+            redis_key = self._redis_key(key)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.zadd(redis_key, {uuid.uuid4().hex: at})
+            pipe.zremrangebyscore(redis_key, 0, at - self.window)
+            pipe.zremrangebyrank(redis_key, 0, -(self.max_events + 1))
+            pipe.expire(redis_key, int(self.window) + 1)
+            await pipe.execute()
+            return
+        self._local(key, time.time()).append(at)
+
+    async def count(self, key: str) -> int:
+        """Events recorded for `key` inside the window"""
+        now = time.time()
+        if self.redis is not None:
+            return await self.redis.zcount(self._redis_key(key), now - self.window, "+inf")
+        if key not in self.events:
+            return 0
+        return len(self._local(key, now))
+
+class LoginSecurity:
+    """
+    Keeps the login path off Mongo and off the event loop: password checks
+    go through a PasswordHasher, failed attempts are counted per email and
+    per IP in sliding windows (shared through Redis when the cache backend
+    is), and `login_attempts` documents are buffered and inserted in
+    batches every `flush_interval` seconds.
+
+    On start the windows are seeded from the failures already stored in
+    `login_attempts`, so a restart does not reset the limits.
+    """
+
+    def __init__(
+        self,
+        db,
+        hash_workers: int = 2,
+        max_hash_queue: int = 100,
+        window_minutes: int = 15,
+        email_limit: int = 5,
+        ip_limit: int = 10,
+        flush_interval: float = 2,
+        max_pending: int = 1000,
+        redis_client=None
+    ):
+        self.db = db
+        self.hasher = PasswordHasher(hash_workers, max_hash_queue)
+        self.window = timedelta(minutes=window_minutes)
+        self.email_limit = email_limit
+        self.ip_limit = ip_limit
+        self.email_failures = SlidingWindowCounter("email", self.window.total_seconds(), email_limit, redis_client=redis_client)
+        self.ip_failures = SlidingWindowCounter("ip", self.window.total_seconds(), ip_limit, redis_client=redis_client)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.flush_task: Optional[asyncio.Task] = None
+        self.flush_lock = asyncio.Lock()
+        self.pending_attempts: List[Dict] = []
+
+        # Statistics
+        self.attempts_buffered = 0
+        self.attempts_written = 0
+        self.failed_flushes = 0
+        self.rate_limited = 0
+
+    async def initialize_indexes(self):
+        """Create indexes used by login security"""
+
+        await self.db.login_attempts.create_index([
+            ("email", 1),
+            ("success", 1),
+            ("created_at", -1)
+        ], name="login_attempts_by_email")
+
+        await self.db.login_attempts.create_index([
+            ("success", 1),
+            ("created_at", -1)
+        ], name="login_failures_by_date")
+
+        print("✅ Login security indexes created successfully")
+
+    async def seed(self):
+        """Load failures inside the window from `login_attempts` (local counters only)"""
+        if self.email_failures.redis is not None:
+            return
+        failures = await self.db.login_attempts.find(
+            {"success": False, "created_at": {"$gte": datetime.utcnow() - self.window}},
+            {"_id": 0, "email": 1, "ip_address": 1, "created_at": 1}
+        ).sort("created_at", 1).to_list(None)
+        for attempt in failures:
+            at = (attempt["created_at"] - datetime(1970, 1, 1)).total_seconds()
+            await self.email_failures.add(attempt["email"], at)
+            await self.ip_failures.add(attempt["ip_address"], at)
+
+    # =============  PASSWORDS =============
+
+    async def verify_password(self, plain_password: str, hashed_password: str) -> bool:
+        return await self.hasher.verify(plain_password, hashed_password)
+
+    async def hash_password(self, password: str) -> str:
+        return await self.hasher.hash(password)
+
+    # =============  RATE LIMITS =============
+
+    async def allow(self, email: str, ip_address: str) -> bool:
+        """False once the email or the IP has too many failed attempts inside the window"""
+        email_count, ip_count = await asyncio.gather(
+            self.email_failures.count(email),
+            self.ip_failures.count(ip_address)
+        )
+        allowed = email_count < self.email_limit and ip_count < self.ip_limit
+        if not allowed:
+            self.rate_limited += 1
+        return allowed
+
+    async def record_attempt(self, attempt: Dict):
+        """Count a failed attempt and buffer the document for the next batch insert"""
+        if not attempt["success"]:
+            await asyncio.gather(
+                self.email_failures.add(attempt["email"]),
+                self.ip_failures.add(attempt["ip_address"])
+            )
+        self.pending_attempts.append(attempt)
+        self.attempts_buffered += 1
+        if len(self.pending_attempts) >= self.max_pending and not self.flush_lock.locked():
+            asyncio.create_task(self.flush())
+
+    # =============  FLUSH =============
+
+    async def flush(self) -> int:
+        """Insert every buffered attempt. Returns the number written"""
+        async with self.flush_lock:
+            if not self.pending_attempts:
+                return 0
+            attempts, self.pending_attempts = self.pending_attempts, []
+            try:
+                await self.db.login_attempts.insert_many(attempts, ordered=False)
+                self.attempts_written += len(attempts)
+                return len(attempts)
+            except BulkWriteError as e:
+                # Attempts keyed by id (from retried login tasks) that were already written
+                errors = e.details.get("writeErrors", [])
+                if any(error.get("code") != DUPLICATE_KEY for error in errors):
+                    self.failed_flushes += 1
+                    print(f"❌ Login attempts flush failed: {e}")
+                written = e.details.get("nInserted", 0)
+                self.attempts_written += written
+                return written
+            except Exception as e:
+                self.failed_flushes += 1
+                print(f"❌ Login attempts flush failed: {e}")
+                return 0
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Login attempts flush loop error: {e}")
+
+    async def start(self):
+        """Seed the rate-limit windows and start the periodic flush"""
+        try:
+            await self.seed()
+        except Exception as e:
+            print(f"❌ Login rate limit seeding failed: {e}")
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        """Stop the flush loop, write whatever is still buffered and release the workers"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        self.hasher.shutdown()
+
+    def get_stats(self) -> Dict:
+        """Get login security statistics"""
+        return {
+            "password_pool": self.hasher.get_stats(),
+            "rate_limit_shared": self.email_failures.redis is not None,
+            "rate_limited": self.rate_limited,
+            "tracked_emails": len(self.email_failures.events),
+            "tracked_ips": len(self.ip_failures.events),
+            "pending_attempts": len(self.pending_attempts),
+            "attempts_buffered": self.attempts_buffered,
+            "attempts_written": self.attempts_written,
+            "failed_flushes": self.failed_flushes
+        }
+
+# Global instance
+login_security = None
+
+def init_login_security(
+    db,
+    hash_workers: int = 2,
+    max_hash_queue: int = 100,
+    window_minutes: int = 15,
+    email_limit: int = 5,
+    ip_limit: int = 10,
+    flush_interval: float = 2,
+    redis_client=None
+):
+    """Initialize login security"""
+    global login_security
+    login_security = LoginSecurity(
+        db, hash_workers, max_hash_queue, window_minutes, email_limit, ip_limit, flush_interval,
+        redis_client=redis_client
+    )
+
+    # Initialize indexes in background
+    asyncio.create_task(login_security.initialize_indexes())
+
+    return login_security
@@ -44,6 +44,7 @@ class User(BaseModel):
     is_active: bool = True
     created_at: datetime = Field(default_factory=datetime.utcnow)
     last_login: Optional[datetime] = None
+    token_version: int = 0  # Bumped to revoke previously issued tokens
     
     # Privacy settings
     is_public: bool = True
@@ -324,8 +325,10 @@ class MessageCreate(BaseModel):
 class Conversation(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     participants: List[str]  # user_ids
-    last_message: Optional[str] = None
+    participant_cards: Dict[str, Dict] = {}  # user_id -> {id, username, display_name, avatar_url, is_verified}
+    last_message: Optional[str] = None  # Snippet of the latest message
     last_message_at: Optional[datetime] = None
+    last_message_sender_id: Optional[str] = None
     unread_count: Dict[str, int] = {}  # user_id -> unread count
     is_active: bool = True
     created_at: datetime = Field(default_factory=datetime.utcnow)
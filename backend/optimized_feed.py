@@ -2,33 +2,56 @@
 Optimized Feed System for VotaTok
 Implements performance optimizations for fast loading
 """
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Set, Tuple
 from fastapi import HTTPException
 import asyncio
 from datetime import datetime, timedelta
+from feed_cursor import get_sort_fields, get_sort_spec, apply_cursor, page_cursor
+from cache_manager import cache_manager
+from config import config
 
 class FeedOptimizer:
     """Handles feed optimization strategies"""
     
-    def __init__(self, db):
+    def __init__(self, db, prefetch_concurrency: int = 4):
         self.db = db
-        self.cache = {}  # Simple in-memory cache
-        self.cache_ttl = 300  # 5 minutes
+        # Bounded LRU/TTL cache shared through the cache manager
+        self.cache = cache_manager.namespace(
+            "feed",
+            max_size=config.CACHE_CONFIG['FEED']['MAX_SIZE'],
+            ttl=config.CACHE_CONFIG['FEED']['TTL_SECONDS']
+        )
+        # Background page loads (prefetch and warm-up) share a few slots;
+        # when they are all busy a prefetch is dropped rather than queued
+        self.prefetch_slots = asyncio.Semaphore(prefetch_concurrency)
+        self.prefetching: Set[str] = set()
+        
+        # Statistics
+        self.light_hits = 0
+        self.light_misses = 0
+        self.prefetches = 0
+        self.prefetches_skipped = 0
+        self.pages_warmed = 0
     
     async def get_optimized_polls(
         self, 
         current_user_id: str,
         limit: int = 20, 
         offset: int = 0,
-        load_thumbnails: bool = False
-    ) -> List[Dict]:
+        load_thumbnails: bool = False,
+        cursor: Optional[str] = None
+    ) -> Dict:
         """
         Optimized poll loading with minimal DB queries
+        Uses keyset pagination when `cursor` is given (offset is ignored)
+        Returns {"polls", "next_cursor"}
         """
         
+        sort_fields = get_sort_fields("recent")
+        
         # 1. GET BASIC POLLS DATA (Single Query)
         polls_cursor = self.db.polls.find(
-            {"is_active": True},
+            apply_cursor({"is_active": True}, cursor, sort_fields),
             {
                 "id": 1,
                 "title": 1, 
@@ -36,6 +59,7 @@ class FeedOptimizer:
                 "created_at": 1,
                 "total_votes": 1,
                 "likes_count": 1,
+                "sharded_counters": 1,
                 "comments_count": 1,
                 "layout": 1,
                 "music": 1,
@@ -43,12 +67,18 @@ class FeedOptimizer:
                     "$slice": ["$options", 2]  # Only first 2 options for speed
                 }
             }
-        ).sort("created_at", -1).skip(offset).limit(limit)
+        ).sort(get_sort_spec(sort_fields))
+        if not cursor:
+            polls_cursor = polls_cursor.skip(offset)
         
-        polls = await polls_cursor.to_list(limit)
+        polls = await polls_cursor.limit(limit).to_list(limit)
         
         if not polls:
-            return []
+            return {"polls": [], "next_cursor": None}
+        # The page is full (and the feed goes on) based on the query, not on
+        # what survives the author filter below
+        next_cursor = page_cursor(polls, limit, sort_fields)
+        polls = await self._overlay_counters(polls)
         
         # 2. BATCH GET ALL REQUIRED DATA (3 Queries Total)
         poll_ids = [poll["id"] for poll in polls]
@@ -134,30 +164,44 @@ class FeedOptimizer:
             
             result.append(poll_response)
         
-        return result
+        return {"polls": result, "next_cursor": next_cursor}
 
     async def get_lightweight_feed(
         self, 
         current_user_id: str,
         limit: int = 10,
-        offset: int = 0
-    ) -> List[Dict]:
+        offset: int = 0,
+        cursor: Optional[str] = None
+    ) -> Dict:
         """
         Ultra-lightweight feed for initial load
         Only essential data, no media processing
+        Uses keyset pagination when `cursor` is given (offset is ignored)
+        Returns {"polls", "next_cursor"}; the following page is prefetched in the background
         """
         
-        cache_key = f"feed_light_{current_user_id}_{limit}_{offset}"
+        cached_data = await self.cache.aget(self._light_key(limit, offset, cursor))
+        if cached_data is not None:
+            self.light_hits += 1
+            page = cached_data
+        else:
+            self.light_misses += 1
+            page = await self._load_lightweight_page(limit, offset, cursor)
         
-        # Check cache
-        if cache_key in self.cache:
-            cached_data, timestamp = self.cache[cache_key]
-            if datetime.now().timestamp() - timestamp < self.cache_ttl:
-                return cached_data
+        self.prefetch_next_page(page, limit, offset, cursor)
+        return page
+
+    def _light_key(self, limit: int, offset: int, cursor: Optional[str]) -> str:
+        # Lightweight pages carry nothing user-specific, so users share them
+        return f"feed_light:{limit}:{cursor or offset}"
+
+    async def _load_lightweight_page(self, limit: int, offset: int, cursor: Optional[str]) -> Dict:
+        sort_fields = get_sort_fields("recent")
+        cache_key = self._light_key(limit, offset, cursor)
         
         # Minimal data query
         polls_cursor = self.db.polls.find(
-            {"is_active": True},
+            apply_cursor({"is_active": True}, cursor, sort_fields),
             {
                 "id": 1,
                 "title": 1,
@@ -165,16 +209,23 @@ class FeedOptimizer:
                 "created_at": 1,
                 "total_votes": 1,
                 "likes_count": 1,
+                "sharded_counters": 1,
                 "layout": 1,
                 # Only get first option for preview
                 "options": {"$slice": ["$options", 1]}
             }
-        ).sort("created_at", -1).skip(offset).limit(limit)
+        ).sort(get_sort_spec(sort_fields))
+        if not cursor:
+            polls_cursor = polls_cursor.skip(offset)
         
-        polls = await polls_cursor.to_list(limit)
+        polls = await polls_cursor.limit(limit).to_list(limit)
         
         if not polls:
-            return []
+            return {"polls": [], "next_cursor": None}
+        # Decided on the query result: polls dropped below (missing author)
+        # must not end the feed early
+        next_cursor = page_cursor(polls, limit, sort_fields)
+        polls = await self._overlay_counters(polls)
         
         # Get authors in batch
         author_ids = list(set(poll["author_id"] for poll in polls))
@@ -220,9 +271,68 @@ class FeedOptimizer:
             result.append(poll_response)
         
         # Cache result
-        self.cache[cache_key] = (result, datetime.now().timestamp())
+        page = {"polls": result, "next_cursor": next_cursor}
+        await self.cache.aset(cache_key, page)
         
-        return result
+        return page
+
+    # =============  PREFETCH / WARM-UP =============
+
+    def next_pages(self, page: Dict, limit: int, offset: int = 0, cursor: Optional[str] = None) -> List[Tuple[int, Optional[str]]]:
+        """
+        (offset, cursor) of the page after `page`, paged the way it was requested.
+        A first page may be followed by offset or by its next cursor, so both are returned.
+        """
+        next_cursor = page["next_cursor"]
+        if not next_cursor:
+            return []
+        if cursor:
+            return [(0, next_cursor)]
+        pages = [(offset + limit, None)]
+        if offset == 0:
+            pages.append((0, next_cursor))
+        return pages
+
+    def prefetch_next_page(self, page: Dict, limit: int, offset: int = 0, cursor: Optional[str] = None):
+        """Load and cache the page after `page` in the background"""
+        for next_offset, next_cursor in self.next_pages(page, limit, offset, cursor):
+            cache_key = self._light_key(limit, next_offset, next_cursor)
+            if cache_key in self.prefetching or cache_key in self.cache:
+                continue
+            if self.prefetch_slots.locked():
+                self.prefetches_skipped += 1
+                continue
+            self.prefetching.add(cache_key)
+            asyncio.create_task(self._prefetch(cache_key, limit, next_offset, next_cursor))
+
+    async def _prefetch(self, cache_key: str, limit: int, offset: int, cursor: Optional[str]):
+        try:
+            async with self.prefetch_slots:
+                await self._load_lightweight_page(limit, offset, cursor)
+                self.prefetches += 1
+        except Exception as e:
+            print(f"❌ Feed prefetch failed: {e}")
+        finally:
+            self.prefetching.discard(cache_key)
+
+    async def warm_up(self, limit: int = 10, pages: int = 3):
+        """Cache the first pages of the recent feed (by offset and by cursor) and the trending snapshot"""
+        async with self.prefetch_slots:
+            try:
+                page = await self._load_lightweight_page(limit, 0, None)
+                self.pages_warmed += 1
+                for page_number in range(1, pages):
+                    if not page["next_cursor"]:
+                        break
+                    await self._load_lightweight_page(limit, page_number * limit, None)
+                    page = await self._load_lightweight_page(limit, 0, page["next_cursor"])
+                    self.pages_warmed += 1
+                
+                from trending_snapshots import trending_snapshots
+                if trending_snapshots:
+                    await trending_snapshots.refresh()
+            except Exception as e:
+                print(f"❌ Feed warm-up failed: {e}")
 
     async def get_poll_details_on_demand(
         self, 
@@ -237,6 +347,7 @@ class FeedOptimizer:
         poll_data = await self.db.polls.find_one({"id": poll_id})
         if not poll_data:
             return None
+        poll_data = (await self._overlay_counters([poll_data]))[0]
         
         # Get author
         author = await self.db.users.find_one({"id": poll_data["author_id"]})
@@ -276,10 +387,29 @@ class FeedOptimizer:
             "userLiked": bool(user_like)
         }
 
+    async def _overlay_counters(self, polls: List[Dict]) -> List[Dict]:
+        """Add sharded counter totals to polls that use them"""
+        from sharded_counters import sharded_counters
+        if sharded_counters:
+            return await sharded_counters.overlay_polls(polls)
+        return polls
+
+    def get_cache_stats(self) -> Dict:
+        """Get cache statistics"""
+        return {
+            **self.cache.get_stats(),
+            "lightweight_hits": self.light_hits,
+            "lightweight_misses": self.light_misses,
+            "prefetches": self.prefetches,
+            "prefetches_skipped": self.prefetches_skipped,
+            "prefetches_in_flight": len(self.prefetching),
+            "pages_warmed": self.pages_warmed
+        }
+
 # Initialize optimizer
 feed_optimizer = None
 
-def init_feed_optimizer(db):
+def init_feed_optimizer(db, prefetch_concurrency: int = 4):
     global feed_optimizer
-    feed_optimizer = FeedOptimizer(db)
+    feed_optimizer = FeedOptimizer(db, prefetch_concurrency)
     return feed_optimizer
\ No newline at end of file
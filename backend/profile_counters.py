@@ -0,0 +1,226 @@
+"""
+Profile Counters for VotaTok
+Incremental user_profiles counters with periodic drift reconciliation
+"""
+from typing import List, Dict, Optional
+import asyncio
+from datetime import datetime
+from pymongo import UpdateOne
+
+# Counters maintained incrementally on user_profiles
+PROFILE_COUNTER_FIELDS = [
+    "followers_count",
+    "following_count",
+    "total_polls_created",
+    "total_votes",
+    "likes_count",
+    "votes_count",
+    "likes_given"
+]
+
+class ProfileCounters:
+    """
+    Keeps the counters on `user_profiles` current with atomic `$inc` deltas
+    from the write paths (votes, likes, follows), so a vote costs O(1)
+    instead of recomputing both profiles from scratch.
+
+    Deltas can drift (deleted polls, failed writes, races with a concurrent
+    recompute), so a background job periodically recomputes every counter
+    from the source collections (and the counter shards of sharded polls)
+    and repairs profiles that differ.
+    """
+
+    def __init__(self, db, reconcile_interval: int = 3600, batch_size: int = 500):
+        self.db = db
+        self.reconcile_interval = reconcile_interval
+        self.batch_size = batch_size
+        self.reconcile_task: Optional[asyncio.Task] = None
+        self.increments = 0
+        self.missing_profiles = 0
+        self.last_reconciled_at: Optional[datetime] = None
+        self.last_repaired = 0
+
+    async def initialize_indexes(self):
+        """Create indexes used by counter updates and reconciliation"""
+
+        # votes/poll_likes/polls are already covered by DatabaseOptimizer indexes
+        await self.db.user_profiles.create_index([("id", 1)], name="profile_id")
+
+        print("✅ Profile counter indexes created successfully")
+
+    # =============  WRITE PATH =============
+
+    async def increment(self, user_id: str, **deltas: int) -> bool:
+        """
+        Apply counter deltas to a user's profile.
+        Returns False if the profile does not exist yet (caller should build it).
+        """
+        deltas = {field: delta for field, delta in deltas.items() if delta}
+        if not user_id or not deltas:
+            return True
+
+        result = await self.db.user_profiles.update_one(
+            {"id": user_id},
+            {"$inc": deltas, "$set": {"last_activity": datetime.utcnow()}}
+        )
+        self.increments += 1
+        if result.matched_count == 0:
+            self.missing_profiles += 1
+            return False
+        return True
+
+    # =============  RECONCILIATION =============
+
+    async def _group_counts(self, collection, match: Dict, group_field: str, value=1) -> Dict[str, int]:
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": f"${group_field}", "count": {"$sum": value}}}
+        ]
+        docs = await collection.aggregate(pipeline).to_list(None)
+        return {doc["_id"]: doc["count"] for doc in docs}
+
+    async def _shard_totals(self, user_ids: List[str]) -> Dict[str, Dict[str, int]]:
+        """Votes and likes recorded on counter shards of the authors' sharded polls, per author"""
+        sharded_polls = await self.db.polls.find(
+            {"author_id": {"$in": user_ids}, "is_active": True, "sharded_counters": True},
+            {"_id": 0, "id": 1, "author_id": 1}
+        ).to_list(None)
+        if not sharded_polls:
+            return {}
+
+        author_by_poll = {poll["id"]: poll["author_id"] for poll in sharded_polls}
+        shards = await self.db.poll_counter_shards.aggregate([
+            {"$match": {"poll_id": {"$in": list(author_by_poll)}}},
+            {"$group": {
+                "_id": "$poll_id",
+                "votes": {"$sum": "$total_votes"},
+                "likes": {"$sum": "$likes"}
+            }}
+        ]).to_list(None)
+
+        totals: Dict[str, Dict[str, int]] = {}
+        for shard in shards:
+            author_totals = totals.setdefault(author_by_poll[shard["_id"]], {"votes": 0, "likes": 0})
+            author_totals["votes"] += shard["votes"]
+            author_totals["likes"] += shard["likes"]
+        return totals
+
+    async def compute_counters(self, user_ids: List[str]) -> Dict[str, Dict[str, int]]:
+        """Recompute every profile counter for a batch of users"""
+        followers, following, votes_made, likes_given, poll_stats = await asyncio.gather(
+            self._group_counts(self.db.follows, {"following_id": {"$in": user_ids}}, "following_id"),
+            self._group_counts(self.db.follows, {"follower_id": {"$in": user_ids}}, "follower_id"),
+            self._group_counts(self.db.votes, {"user_id": {"$in": user_ids}}, "user_id"),
+            self._group_counts(self.db.poll_likes, {"user_id": {"$in": user_ids}}, "user_id"),
+            self.db.polls.aggregate([
+                {"$match": {"author_id": {"$in": user_ids}, "is_active": True}},
+                {"$project": {
+                    "author_id": 1,
+                    "likes": {"$ifNull": ["$likes", 0]},
+                    "votes": {"$sum": "$options.votes"}
+                }},
+                {"$group": {
+                    "_id": "$author_id",
+                    "polls": {"$sum": 1},
+                    "likes": {"$sum": "$likes"},
+                    "votes": {"$sum": "$votes"}
+                }}
+            ]).to_list(None)
+        )
+        polls_by_author = {doc["_id"]: doc for doc in poll_stats}
+        shard_totals = await self._shard_totals(user_ids)
+
+        counters = {}
+        for user_id in user_ids:
+            author_stats = polls_by_author.get(user_id, {})
+            author_shards = shard_totals.get(user_id, {})
+            counters[user_id] = {
+                "followers_count": followers.get(user_id, 0),
+                "following_count": following.get(user_id, 0),
+                "total_polls_created": author_stats.get("polls", 0),
+                "total_votes": author_stats.get("votes", 0) + author_shards.get("votes", 0),
+                "likes_count": author_stats.get("likes", 0) + author_shards.get("likes", 0),
+                "votes_count": votes_made.get(user_id, 0),
+                "likes_given": likes_given.get(user_id, 0)
+            }
+        return counters
+
+    async def _reconcile_batch(self, profiles: List[Dict]) -> int:
+        counters = await self.compute_counters([profile["id"] for profile in profiles])
+
+        operations = []
+        for profile in profiles:
+            expected = counters[profile["id"]]
+            drifted = {
+                field: value for field, value in expected.items()
+                if profile.get(field) != value
+            }
+            if drifted:
+                operations.append(UpdateOne({"id": profile["id"]}, {"$set": drifted}))
+
+        if operations:
+            await self.db.user_profiles.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    async def reconcile_all(self) -> int:
+        """Repair counter drift on every profile. Returns the number of profiles fixed"""
+        projection = {"_id": 0, "id": 1, **{field: 1 for field in PROFILE_COUNTER_FIELDS}}
+        repaired = 0
+        batch = []
+
+        async for profile in self.db.user_profiles.find({}, projection):
+            batch.append(profile)
+            if len(batch) >= self.batch_size:
+                repaired += await self._reconcile_batch(batch)
+                batch = []
+        if batch:
+            repaired += await self._reconcile_batch(batch)
+
+        self.last_reconciled_at = datetime.utcnow()
+        self.last_repaired = repaired
+        print(f"🧮 Profile counter reconciliation repaired {repaired} profiles")
+        return repaired
+
+    async def _reconcile_forever(self):
+        while True:
+            try:
+                await self.reconcile_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Profile counter reconciliation failed: {e}")
+            await asyncio.sleep(self.reconcile_interval)
+
+    def start(self):
+        """Start the periodic reconciliation job"""
+        if self.reconcile_task is None and self.reconcile_interval > 0:
+            self.reconcile_task = asyncio.create_task(self._reconcile_forever())
+
+    def stop(self):
+        """Stop the periodic reconciliation job"""
+        if self.reconcile_task is not None:
+            self.reconcile_task.cancel()
+            self.reconcile_task = None
+
+    def get_stats(self) -> Dict:
+        """Get profile counter statistics"""
+        return {
+            "increments": self.increments,
+            "missing_profiles": self.missing_profiles,
+            "reconcile_interval_seconds": self.reconcile_interval,
+            "last_reconciled_at": self.last_reconciled_at.isoformat() if self.last_reconciled_at else None,
+            "last_repaired": self.last_repaired
+        }
+
+# Global instance
+profile_counters = None
+
+def init_profile_counters(db, reconcile_interval: int = 3600, batch_size: int = 500):
+    """Initialize profile counters"""
+    global profile_counters
+    profile_counters = ProfileCounters(db, reconcile_interval, batch_size)
+
+    # Initialize indexes in background
+    asyncio.create_task(profile_counters.initialize_indexes())
+
+    return profile_counters
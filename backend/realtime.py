@@ -0,0 +1,297 @@
+"""
+Realtime Gateway for VotaTok
+Pushes message, chat request, follow and activity events to connected users over WebSockets
+"""
+from typing import Callable, Dict, Iterable, List, Optional
+import asyncio
+import json
+from datetime import datetime
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+# Close code sent to a connection that fell too far behind (clients reconnect and refetch)
+CLOSE_SLOW_CONSUMER = 1013
+# Close code sent to the oldest connection when a user opens one too many
+CLOSE_REPLACED = 4000
+
+# =============  PUB/SUB =============
+
+class PubSub:
+    """
+    Carries events between the process that produced them and the processes
+    holding the recipients' connections. Envelopes are JSON-serializable
+    dicts: {"user_ids": [...], "event": {...}}.
+    """
+
+    name = "base"
+    shared = False
+
+    def __init__(self):
+        self.handler: Optional[Callable[[Dict], None]] = None
+
+    def subscribe(self, handler: Callable[[Dict], None]):
+        self.handler = handler
+
+    async def publish(self, envelope: Dict):
+        raise NotImplementedError
+
+    async def listen(self):
+        pass
+
+class LocalPubSub(PubSub):
+    """
+    Single-worker pub/sub: envelopes are handed straight to the local
+    connections. Only correct when every client connects to this process.
+    """
+
+    name = "memory"
+    shared = False
+
+    async def publish(self, envelope: Dict):
+        if self.handler is not None:
+            self.handler(envelope)
+
+class RedisPubSub(PubSub):
+    """
+    Broker-backed pub/sub over a Redis channel. Every worker (including the
+    publisher) receives every envelope and delivers it to the connections
+    it holds.
+    """
+
+    name = "redis"
+    shared = True
+
+    def __init__(self, client, channel: str = "votatok:realtime:events"):
+        super().__init__()
+        self.client = client
+        self.channel = channel
+
+    async def publish(self, envelope: Dict):
+        await self.client.publish(self.channel, json.dumps(envelope, default=str))
+
+    async def listen(self):
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self.channel)
+        try:
+            async for message in pubsub.listen():
+                if message.get("type") == "message" and self.handler is not None:
+                    self.handler(json.loads(message["data"]))
+        finally:
+            await pubsub.unsubscribe(self.channel)
+
+# =============  CONNECTIONS =============
+
+class Connection:
+    """
+    One client socket. Events are queued (bounded) and written by a single
+    writer task, so a slow client never blocks the publisher.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: str, queue_size: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.close_code: Optional[int] = None
+
+    def push(self, event: Dict) -> bool:
+        """Queue an event; False (and the connection is marked for closing) if the queue is full"""
+        if self.close_code is not None:
+            return False
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            self.close(CLOSE_SLOW_CONSUMER)
+            return False
+
+    def close(self, code: int):
+        if self.close_code is None:
+            self.close_code = code
+            # Wake the writer so it notices
+            try:
+                self.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+                self.queue.put_nowait(None)
+
+class RealtimeGateway:
+    """
+    Keeps the WebSocket connections of the users talking to this process and
+    fans events out to them. Producers call `publish(user_ids, type, data)`
+    after their write succeeds; the envelope goes through the pub/sub (local,
+    or a broker shared by every worker) and each worker delivers it to the
+    recipients' connections it holds. Users without a connection simply
+    miss the push and see the change on their next fetch.
+
+    Each connection has a bounded send queue. A client that falls
+    `send_queue_size` events behind is disconnected rather than buffered
+    without limit; it reconnects and refetches. Idle connections get a ping
+    every `ping_interval` seconds to keep proxies from closing them.
+    """
+
+    def __init__(
+        self,
+        pubsub: Optional[PubSub] = None,
+        send_queue_size: int = 100,
+        max_connections_per_user: int = 5,
+        ping_interval: float = 25
+    ):
+        self.pubsub = pubsub or LocalPubSub()
+        self.pubsub.subscribe(self.deliver)
+        self.send_queue_size = send_queue_size
+        self.max_connections_per_user = max_connections_per_user
+        self.ping_interval = ping_interval
+        self.connections: Dict[str, List[Connection]] = {}
+        self.listener_task: Optional[asyncio.Task] = None
+
+        # Statistics
+        self.connections_opened = 0
+        self.published = 0
+        self.publish_failures = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.slow_disconnects = 0
+
+    # =============  PUBLISH =============
+
+    async def publish(self, user_ids: Iterable[str], event_type: str, data: Dict):
+        """Push an event to every connection of `user_ids` (failures are logged, never raised)"""
+        user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id]
+        if not user_ids:
+            return
+        envelope = {
+            "user_ids": user_ids,
+            "event": {"type": event_type, "data": data, "at": datetime.utcnow().isoformat()}
+        }
+        try:
+            await self.pubsub.publish(envelope)
+            self.published += 1
+        except Exception as e:
+            self.publish_failures += 1
+            print(f"❌ Realtime publish of {event_type} failed: {e}")
+
+    def deliver(self, envelope: Dict):
+        """Queue an envelope's event on the local connections of its recipients"""
+        event = envelope["event"]
+        for user_id in envelope["user_ids"]:
+            for connection in self.connections.get(user_id, ()):
+                if connection.close_code is not None:
+                    continue
+                if connection.push(event):
+                    self.delivered += 1
+                else:
+                    self.dropped += 1
+                    self.slow_disconnects += 1
+
+    # =============  CONNECTIONS =============
+
+    def _register(self, connection: Connection):
+        user_connections = self.connections.setdefault(connection.user_id, [])
+        user_connections.append(connection)
+        while len(user_connections) > self.max_connections_per_user:
+            user_connections.pop(0).close(CLOSE_REPLACED)
+        self.connections_opened += 1
+
+    def _unregister(self, connection: Connection):
+        user_connections = self.connections.get(connection.user_id)
+        if user_connections and connection in user_connections:
+            user_connections.remove(connection)
+            if not user_connections:
+                del self.connections[connection.user_id]
+
+    async def _write_forever(self, connection: Connection):
+        while True:
+            try:
+                event = await asyncio.wait_for(connection.queue.get(), self.ping_interval)
+            except asyncio.TimeoutError:
+                event = {"type": "ping"}
+            if event is None:
+                return
+            await connection.websocket.send_text(json.dumps(event, default=str))
+
+    async def _read_forever(self, connection: Connection):
+        while True:
+            message = await connection.websocket.receive_text()
+            if message == "ping":
+                connection.push({"type": "pong"})
+
+    async def serve(self, websocket: WebSocket, user_id: str):
+        """Run an accepted socket for `user_id` until either side closes it"""
+        connection = Connection(websocket, user_id, self.send_queue_size)
+        self._register(connection)
+        connection.push({"type": "ready", "data": {"user_id": user_id}})
+        writer = asyncio.create_task(self._write_forever(connection))
+        reader = asyncio.create_task(self._read_forever(connection))
+        try:
+            done, pending = await asyncio.wait({writer, reader}, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                error = task.exception()
+                if error is not None and not isinstance(error, WebSocketDisconnect):
+                    print(f"❌ Realtime connection error for {user_id}: {error}")
+        finally:
+            writer.cancel()
+            reader.cancel()
+            self._unregister(connection)
+            if connection.close_code is not None:
+                try:
+                    await websocket.close(code=connection.close_code)
+                except Exception:
+                    pass
+
+    # =============  LIFECYCLE =============
+
+    async def _listen_forever(self):
+        while True:
+            try:
+                await self.pubsub.listen()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️  Realtime listener error: {e}, reconnecting...")
+                await asyncio.sleep(1)
+
+    def start(self):
+        """Start receiving envelopes from the broker (no-op for local pub/sub)"""
+        if self.pubsub.shared and self.listener_task is None:
+            self.listener_task = asyncio.create_task(self._listen_forever())
+            print(f"📡 Realtime listener started ({self.pubsub.name})")
+
+    def stop(self):
+        """Stop the broker listener and close every local connection"""
+        if self.listener_task is not None:
+            self.listener_task.cancel()
+            self.listener_task = None
+        for user_connections in list(self.connections.values()):
+            for connection in list(user_connections):
+                connection.close(1001)
+
+    def get_stats(self) -> Dict:
+        """Get realtime gateway statistics"""
+        return {
+            "pubsub": self.pubsub.name,
+            "connected_users": len(self.connections),
+            "connections": sum(len(user_connections) for user_connections in self.connections.values()),
+            "connections_opened": self.connections_opened,
+            "published": self.published,
+            "publish_failures": self.publish_failures,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "slow_disconnects": self.slow_disconnects
+        }
+
+# Global instance
+realtime_gateway = None
+
+def init_realtime_gateway(
+    send_queue_size: int = 100,
+    max_connections_per_user: int = 5,
+    ping_interval: float = 25,
+    redis_client=None
+):
+    """Initialize the realtime gateway (events go through Redis when a client is given)"""
+    global realtime_gateway
+    pubsub = RedisPubSub(redis_client) if redis_client is not None else LocalPubSub()
+    realtime_gateway = RealtimeGateway(pubsub, send_queue_size, max_connections_per_user, ping_interval)
+    return realtime_gateway
@@ -0,0 +1,359 @@
+"""
+Search Index for VotaTok
+Locally maintained inverted index (accent-folded, prefix-aware) for users and posts
+"""
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from collections import defaultdict
+import asyncio
+import bisect
+import heapq
+import re
+import unicodedata
+import uuid
+from datetime import datetime, timedelta
+from config import config
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+HASHTAG_PATTERN = re.compile(r"#(\w+)")
+
+# Field weights, shared with the rest of the search configuration
+MULTIPLIERS = config.SEARCH_CONFIG['MULTIPLIERS']
+FIELD_WEIGHTS = {
+    "user": {
+        "username": MULTIPLIERS['USERNAME_MATCH'],
+        "display_name": MULTIPLIERS['DISPLAY_NAME_MATCH'],
+    },
+    "post": {
+        "title": MULTIPLIERS['TITLE_MATCH'],
+        "content": MULTIPLIERS['CONTENT_MATCH'],
+    },
+}
+HASHTAG_WEIGHT = MULTIPLIERS['HASHTAG_MATCH']
+EXACT_WEIGHT = MULTIPLIERS['EXACT_MATCH']
+
+def fold_text(text: Optional[str]) -> str:
+    """Lowercase and strip accents ("Canción" -> "cancion", "Ñandú" -> "nandu")"""
+    if not text:
+        return ""
+    text = str(text)
+    if text.isascii():
+        return text.lower()
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Accent-folded word tokens"""
+    return TOKEN_PATTERN.findall(fold_text(text))
+
+def extract_hashtag_tokens(*texts: Optional[str], tags: Iterable[str] = ()) -> List[str]:
+    """Hashtag tokens ("#tag") from free text and a tags array"""
+    hashtags = set()
+    for text in texts:
+        for tag in HASHTAG_PATTERN.findall(text or ""):
+            hashtags.update(f"#{token}" for token in tokenize(tag))
+    for tag in tags or []:
+        hashtags.update(f"#{token}" for token in tokenize(tag))
+    return sorted(hashtags)
+
+def extract_post_hashtags(post: Dict) -> Dict[str, str]:
+    """Folded hashtag key -> display text ("musica" -> "#Música") from a post's title, content and tags"""
+    hashtags = {}
+    for text in (post.get("title"), post.get("content")):
+        for tag in HASHTAG_PATTERN.findall(text or ""):
+            hashtags.setdefault(fold_text(tag), f"#{tag}")
+    for tag in post.get("tags") or []:
+        tag = str(tag).lstrip("#")
+        if tag:
+            hashtags.setdefault(fold_text(tag), f"#{tag}")
+    hashtags.pop("", None)
+    return hashtags
+
+class InvertedIndex:
+    """Token -> {doc id: weight} postings with a sorted vocabulary for prefix lookups"""
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self.doc_tokens: Dict[str, Dict[str, float]] = {}
+        self.vocabulary: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.doc_tokens)
+
+    def add(self, doc_id: str, token_weights: Dict[str, float], bulk: bool = False):
+        """Index a document (replacing it). With `bulk`, call rebuild_vocabulary() afterwards"""
+        self.remove(doc_id)
+        if not token_weights:
+            return
+        self.doc_tokens[doc_id] = token_weights
+        for token, weight in token_weights.items():
+            if token not in self.postings and not bulk:
+                bisect.insort(self.vocabulary, token)
+            self.postings[token][doc_id] = weight
+
+    def rebuild_vocabulary(self):
+        self.vocabulary = sorted(self.postings)
+
+    def remove(self, doc_id: str):
+        for token in self.doc_tokens.pop(doc_id, {}):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(doc_id, None)
+            if not posting:
+                del self.postings[token]
+                index = bisect.bisect_left(self.vocabulary, token)
+                if index < len(self.vocabulary) and self.vocabulary[index] == token:
+                    self.vocabulary.pop(index)
+
+    def expand_prefix(self, prefix: str, max_terms: int = 200) -> List[str]:
+        """Vocabulary terms starting with `prefix` (at most max_terms)"""
+        terms = []
+        index = bisect.bisect_left(self.vocabulary, prefix)
+        while index < len(self.vocabulary) and len(terms) < max_terms:
+            term = self.vocabulary[index]
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+            index += 1
+        return terms
+
+    def match(self, query_tokens: List[str]) -> Dict[str, float]:
+        """
+        Score documents matching every query token. A token matches a term
+        exactly (weighted by EXACT_MATCH) or as a prefix of it.
+        """
+        scores: Optional[Dict[str, float]] = None
+        for token in query_tokens:
+            token_scores: Dict[str, float] = defaultdict(float)
+            for term in self.expand_prefix(token):
+                multiplier = EXACT_WEIGHT if term == token else 1.0
+                for doc_id, weight in self.postings[term].items():
+                    token_scores[doc_id] = max(token_scores[doc_id], weight * multiplier)
+
+            if scores is None:
+                scores = dict(token_scores)
+            else:
+                scores = {
+                    doc_id: score + token_scores[doc_id]
+                    for doc_id, score in scores.items()
+                    if doc_id in token_scores
+                }
+            if not scores:
+                return {}
+        return scores or {}
+
+class SearchIndex:
+    """
+    In-memory inverted indexes over users (username, display name) and
+    posts (title, content, hashtags/tags), replacing unanchored `$regex`
+    scans in search.
+
+    The index is built from Mongo at startup and kept current by calling
+    `refresh(doc_type, doc_id)` after a poll or user is created, updated
+    or deleted. Each refresh is also appended to `search_index_events`,
+    which every worker tails, so all workers converge on the same index.
+    Until the initial build finishes (`ready`), callers fall back to their
+    Mongo queries. Listeners (see add_listener) receive every reindexed
+    batch, local or from another worker.
+    """
+
+    def __init__(self, db, sync_interval: float = 2.0, event_ttl: int = 86400):
+        self.db = db
+        self.sync_interval = sync_interval
+        self.event_ttl = event_ttl
+        self.instance_id = uuid.uuid4().hex
+        self.indexes = {"user": InvertedIndex(), "post": InvertedIndex()}
+        self.ready = False
+        self.last_event_at: Optional[datetime] = None
+        self.sync_task: Optional[asyncio.Task] = None
+        self.listeners: List[Callable[[str, List[Dict], List[str]], None]] = []
+        self.queries = 0
+        self.refreshes = 0
+
+    async def initialize_indexes(self):
+        """Create Mongo indexes used by search and index synchronization"""
+
+        await self.db.search_index_events.create_index([("created_at", 1)], name="search_events_by_date")
+        await self.db.search_index_events.create_index(
+            [("expires_at", 1)], expireAfterSeconds=0, name="search_events_ttl"
+        )
+
+        print("✅ Search indexes created successfully")
+
+    # =============  DOCUMENT TOKENIZATION =============
+
+    def _user_tokens(self, user: Dict) -> Dict[str, float]:
+        weights: Dict[str, float] = {}
+        for field, field_weight in FIELD_WEIGHTS["user"].items():
+            for token in tokenize(user.get(field)):
+                weights[token] = max(weights.get(token, 0), field_weight)
+        return weights
+
+    def _post_tokens(self, post: Dict) -> Dict[str, float]:
+        weights: Dict[str, float] = {}
+        for field, field_weight in FIELD_WEIGHTS["post"].items():
+            for token in tokenize(post.get(field)):
+                weights[token] = max(weights.get(token, 0), field_weight)
+        for hashtag in extract_hashtag_tokens(post.get("title"), post.get("content"), tags=post.get("tags")):
+            weights[hashtag] = HASHTAG_WEIGHT
+        return weights
+
+    def index_document(self, doc_type: str, doc: Dict, bulk: bool = False):
+        tokens = self._user_tokens(doc) if doc_type == "user" else self._post_tokens(doc)
+        self.indexes[doc_type].add(doc["id"], tokens, bulk=bulk)
+
+    # =============  BUILD & SYNC =============
+
+    async def build(self):
+        """Load every user and post into the index"""
+        started = datetime.utcnow()
+        self.last_event_at = started
+
+        async for user in self.db.users.find({}, {"_id": 0, "id": 1, "username": 1, "display_name": 1}):
+            self.index_document("user", user, bulk=True)
+        async for post in self.db.polls.find({}, {"_id": 0, "id": 1, "title": 1, "content": 1, "tags": 1}):
+            self.index_document("post", post, bulk=True)
+        for index in self.indexes.values():
+            index.rebuild_vocabulary()
+
+        # Catch up with writes that happened while building
+        await self.sync()
+        self.ready = True
+        elapsed = (datetime.utcnow() - started).total_seconds()
+        print(f"🔎 Search index built: {len(self.indexes['user'])} users, {len(self.indexes['post'])} posts in {elapsed:.1f}s")
+
+    async def _reload(self, doc_type: str, doc_ids: List[str]):
+        """Re-read documents from Mongo and reindex them (removing deleted ones)"""
+        if doc_type == "user":
+            docs = await self.db.users.find(
+                {"id": {"$in": doc_ids}},
+                {"_id": 0, "id": 1, "username": 1, "display_name": 1, "avatar_url": 1}
+            ).to_list(len(doc_ids))
+        else:
+            docs = await self.db.polls.find(
+                {"id": {"$in": doc_ids}},
+                {"_id": 0, "id": 1, "title": 1, "content": 1, "tags": 1}
+            ).to_list(len(doc_ids))
+
+        found = set()
+        for doc in docs:
+            self.index_document(doc_type, doc)
+            found.add(doc["id"])
+        removed_ids = [doc_id for doc_id in doc_ids if doc_id not in found]
+        for doc_id in removed_ids:
+            self.indexes[doc_type].remove(doc_id)
+
+        for listener in self.listeners:
+            try:
+                listener(doc_type, docs, removed_ids)
+            except Exception as e:
+                print(f"❌ Search index listener failed: {e}")
+
+    def add_listener(self, listener: Callable[[str, List[Dict], List[str]], None]):
+        """Call `listener(doc_type, docs, removed_ids)` whenever documents are reindexed"""
+        self.listeners.append(listener)
+
+    async def refresh(self, doc_type: str, doc_id: str):
+        """Reindex one document after a create/update/delete and tell the other workers"""
+        try:
+            await self._reload(doc_type, [doc_id])
+            self.refreshes += 1
+            now = datetime.utcnow()
+            await self.db.search_index_events.insert_one({
+                "doc_type": doc_type,
+                "doc_id": doc_id,
+                "origin": self.instance_id,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=self.event_ttl)
+            })
+        except Exception as e:
+            print(f"❌ Search index refresh failed for {doc_type} {doc_id}: {e}")
+
+    async def sync(self):
+        """Apply index events written by other workers since the last sync"""
+        if self.last_event_at is None:
+            return
+        # Overlap the window a little to tolerate clock skew between workers (reindexing is idempotent)
+        events = await self.db.search_index_events.find(
+            {"created_at": {"$gte": self.last_event_at - timedelta(seconds=5)}, "origin": {"$ne": self.instance_id}},
+            {"_id": 0, "doc_type": 1, "doc_id": 1, "created_at": 1}
+        ).sort("created_at", 1).to_list(None)
+        if not events:
+            return
+
+        doc_ids = defaultdict(set)
+        for event in events:
+            doc_ids[event["doc_type"]].add(event["doc_id"])
+        for doc_type, ids in doc_ids.items():
+            if doc_type in self.indexes:
+                await self._reload(doc_type, list(ids))
+        self.last_event_at = events[-1]["created_at"]
+
+    async def _sync_forever(self):
+        try:
+            await self.build()
+        except Exception as e:
+            print(f"❌ Search index build failed: {e}")
+            return
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Search index sync failed: {e}")
+
+    def start(self):
+        """Build the index in the background and start following other workers' updates"""
+        if self.sync_task is None:
+            self.sync_task = asyncio.create_task(self._sync_forever())
+
+    def stop(self):
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+            self.sync_task = None
+
+    # =============  QUERIES =============
+
+    def search(self, doc_type: str, query: str, limit: int, exclude: Iterable[str] = ()) -> List[Tuple[str, float]]:
+        """Ranked (doc id, score) hits for a free-text query"""
+        self.queries += 1
+        scores = self.indexes[doc_type].match(tokenize(query))
+        for doc_id in exclude:
+            scores.pop(doc_id, None)
+        return heapq.nlargest(limit, scores.items(), key=lambda hit: hit[1])
+
+    def search_hashtag(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        """Ranked (post id, score) hits for posts tagged with a hashtag (prefix match)"""
+        self.queries += 1
+        tokens = tokenize(query.replace("#", " "))
+        if not tokens:
+            return []
+        scores = self.indexes["post"].match([f"#{token}" for token in tokens])
+        return heapq.nlargest(limit, scores.items(), key=lambda hit: hit[1])
+
+    def get_stats(self) -> Dict:
+        """Get search index statistics"""
+        return {
+            "ready": self.ready,
+            "users": len(self.indexes["user"]),
+            "posts": len(self.indexes["post"]),
+            "user_terms": len(self.indexes["user"].vocabulary),
+            "post_terms": len(self.indexes["post"].vocabulary),
+            "queries": self.queries,
+            "refreshes": self.refreshes
+        }
+
+# Global instance
+search_index = None
+
+def init_search_index(db, sync_interval: float = 2.0):
+    """Initialize search index"""
+    global search_index
+    search_index = SearchIndex(db, sync_interval)
+
+    # Initialize indexes in background
+    asyncio.create_task(search_index.initialize_indexes())
+
+    return search_index
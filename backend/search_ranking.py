@@ -0,0 +1,195 @@
+"""
+Search Ranking for VotaTok
+Batch relevance scoring (trigram similarity, BM25, popularity, recency) for universal search results
+"""
+from typing import Dict, List, Optional, Set
+import math
+from datetime import datetime
+from config import config
+from search_index import fold_text, tokenize, TOKEN_PATTERN
+
+# Optional NumPy for vectorized scoring (pure Python fallback computes the same scores)
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+MULTIPLIERS = config.SEARCH_CONFIG['MULTIPLIERS']
+
+# Text fields scored per result type, with the multiplier applied to each
+RESULT_FIELDS = {
+    "user": [("username", "USERNAME_MATCH"), ("display_name", "DISPLAY_NAME_MATCH"), ("bio", "BIO_MATCH")],
+    "post": [("title", "TITLE_MATCH"), ("content", "CONTENT_MATCH"), ("tags", "HASHTAG_MATCH")],
+    "sound": [("title", "TITLE_MATCH"), ("artist", "CONTENT_MATCH")],
+}
+NUM_FIELDS = max(len(fields) for fields in RESULT_FIELDS.values())
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def _folded_trigrams(folded: str) -> Set[str]:
+    padded = f"  {folded.strip()} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def trigrams(text: str) -> Set[str]:
+    """Character trigrams of accent-folded text, padded so short words still have some"""
+    return _folded_trigrams(fold_text(text))
+
+def trigram_similarity(a: str, b: str) -> float:
+    """Jaccard similarity of two strings' trigram sets (0..1)"""
+    grams_a, grams_b = trigrams(a), trigrams(b)
+    if not grams_a or not grams_b:
+        return 0.0
+    shared = len(grams_a & grams_b)
+    return shared / (len(grams_a) + len(grams_b) - shared)
+
+def _field_text(result: Dict, field: str) -> str:
+    value = result.get(field)
+    if field == "tags":
+        value = " ".join(str(tag) for tag in (value or []) + (result.get("hashtags") or []))
+    return value if isinstance(value, str) else ""
+
+def _age_days(created_at, now: datetime) -> Optional[float]:
+    if isinstance(created_at, str) and created_at:
+        try:
+            created_at = datetime.fromisoformat(created_at.replace("Z", "+00:00")).replace(tzinfo=None)
+        except ValueError:
+            return None
+    if not isinstance(created_at, datetime):
+        return None
+    return max(0.0, (now - created_at).total_seconds() / 86400)
+
+class CandidateFeatures:
+    """
+    Per-candidate raw features, laid out as (candidate, field slot[, query term])
+    matrices so the scoring arithmetic runs once over the whole batch.
+    """
+
+    def __init__(self, query: str, results: List[Dict]):
+        now = datetime.utcnow()
+        self.query_terms = tokenize(query)
+        self.query_grams = trigrams(query)
+        folded_query = fold_text(query).strip().lstrip("#@")
+
+        n, num_terms = len(results), len(self.query_terms)
+        self.multipliers = [[0.0] * NUM_FIELDS for _ in range(n)]
+        self.shared_grams = [[0] * NUM_FIELDS for _ in range(n)]
+        self.doc_grams = [[0] * NUM_FIELDS for _ in range(n)]
+        self.exact = [[False] * NUM_FIELDS for _ in range(n)]
+        self.lengths = [[0] * NUM_FIELDS for _ in range(n)]
+        self.term_freqs = [[[0] * num_terms for _ in range(NUM_FIELDS)] for _ in range(n)]
+        self.popularity = [float(result.get("popularity_score") or 0) for result in results]
+        self.ages = [_age_days(result.get("created_at"), now) for result in results]
+
+        for row, result in enumerate(results):
+            for slot, (field, multiplier) in enumerate(RESULT_FIELDS.get(result.get("type"), [])):
+                text = _field_text(result, field)
+                if not text:
+                    continue
+                folded = fold_text(text)
+                grams = _folded_trigrams(folded)
+                tokens = TOKEN_PATTERN.findall(folded)
+                self.multipliers[row][slot] = MULTIPLIERS[multiplier]
+                self.shared_grams[row][slot] = len(self.query_grams & grams)
+                self.doc_grams[row][slot] = len(grams)
+                self.exact[row][slot] = folded.strip().lstrip("#@") == folded_query
+                self.lengths[row][slot] = len(tokens)
+                freqs = self.term_freqs[row][slot]
+                for token in tokens:
+                    for term_index, term in enumerate(self.query_terms):
+                        if token.startswith(term):
+                            freqs[term_index] += 1
+
+def _score_numpy(features: CandidateFeatures) -> List[float]:
+    multipliers = np.array(features.multipliers, dtype=float)
+    shared = np.array(features.shared_grams, dtype=float)
+    doc_grams = np.array(features.doc_grams, dtype=float)
+    exact = np.array(features.exact, dtype=bool)
+    lengths = np.array(features.lengths, dtype=float)
+
+    # Trigram Jaccard similarity per field
+    union = len(features.query_grams) + doc_grams - shared
+    jaccard = np.divide(shared, union, out=np.zeros_like(shared), where=union > 0)
+
+    # BM25 over the candidate set (document frequency = candidates containing the term)
+    bm25 = np.zeros_like(shared)
+    if features.query_terms:
+        term_freqs = np.array(features.term_freqs, dtype=float)
+        n = term_freqs.shape[0]
+        df = (term_freqs.sum(axis=1) > 0).sum(axis=0)
+        idf = np.log1p((n - df + 0.5) / (df + 0.5))
+        present = lengths > 0
+        avg_length = np.divide(
+            (lengths * present).sum(axis=0), present.sum(axis=0),
+            out=np.ones(NUM_FIELDS), where=present.sum(axis=0) > 0
+        )
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / np.maximum(avg_length, 1e-9))
+        saturation = term_freqs * (BM25_K1 + 1) / (term_freqs + norm[:, :, None])
+        bm25 = (saturation * idf).sum(axis=2) / max(idf.sum() * (BM25_K1 + 1), 1e-9)
+
+    text = multipliers * (0.5 * jaccard + 0.5 * bm25) * np.where(exact, MULTIPLIERS['EXACT_MATCH'], 1.0)
+    text_score = text.max(axis=1)
+
+    popularity = np.log1p(np.maximum(np.array(features.popularity, dtype=float), 0))
+    if popularity.max() > 0:
+        popularity /= popularity.max()
+    ages = np.array([age if age is not None else np.inf for age in features.ages], dtype=float)
+    recency = np.exp(-ages / config.SEARCH_CONFIG['RECENT_DAYS'])
+
+    boost = 1 + MULTIPLIERS['POPULARITY'] * popularity + MULTIPLIERS['RECENCY'] * recency
+    return (text_score * boost).tolist()
+
+def _score_python(features: CandidateFeatures) -> List[float]:
+    n = len(features.multipliers)
+    num_terms = len(features.query_terms)
+    query_grams = len(features.query_grams)
+
+    df = [
+        sum(1 for row in range(n) if any(features.term_freqs[row][slot][t] for slot in range(NUM_FIELDS)))
+        for t in range(num_terms)
+    ]
+    idf = [math.log1p((n - df[t] + 0.5) / (df[t] + 0.5)) for t in range(num_terms)]
+    avg_length = []
+    for slot in range(NUM_FIELDS):
+        present = [features.lengths[row][slot] for row in range(n) if features.lengths[row][slot]]
+        avg_length.append(sum(present) / len(present) if present else 1.0)
+    max_bm25 = max(sum(idf) * (BM25_K1 + 1), 1e-9)
+    max_popularity = max((math.log1p(max(p, 0)) for p in features.popularity), default=0)
+
+    scores = []
+    for row in range(n):
+        text_score = 0.0
+        for slot in range(NUM_FIELDS):
+            union = query_grams + features.doc_grams[row][slot] - features.shared_grams[row][slot]
+            jaccard = features.shared_grams[row][slot] / union if union > 0 else 0.0
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * features.lengths[row][slot] / max(avg_length[slot], 1e-9))
+            bm25 = sum(
+                idf[t] * tf * (BM25_K1 + 1) / (tf + norm)
+                for t, tf in enumerate(features.term_freqs[row][slot]) if tf
+            ) / max_bm25
+            text = features.multipliers[row][slot] * (0.5 * jaccard + 0.5 * bm25)
+            if features.exact[row][slot]:
+                text *= MULTIPLIERS['EXACT_MATCH']
+            text_score = max(text_score, text)
+
+        popularity = math.log1p(max(features.popularity[row], 0)) / max_popularity if max_popularity > 0 else 0.0
+        age = features.ages[row]
+        recency = math.exp(-age / config.SEARCH_CONFIG['RECENT_DAYS']) if age is not None else 0.0
+        scores.append(text_score * (1 + MULTIPLIERS['POPULARITY'] * popularity + MULTIPLIERS['RECENCY'] * recency))
+    return scores
+
+def rank_results(query: str, results: List[Dict]) -> List[Dict]:
+    """
+    Score mixed user/post/sound results against the query in one batch,
+    store the score as `relevance_score` and return them best first.
+    """
+    if not results:
+        return results
+    features = CandidateFeatures(query, results)
+    scores = _score_numpy(features) if NUMPY_AVAILABLE else _score_python(features)
+    for result, score in zip(results, scores):
+        result["relevance_score"] = round(score, 4)
+    order = sorted(range(len(results)), key=lambda index: scores[index], reverse=True)
+    return [results[index] for index in order]
@@ -0,0 +1,346 @@
+"""
+Seen Filter for VotaTok
+Per-user rotating Bloom filters of polls already viewed, voted on or dismissed
+"""
+from typing import Dict, List, Optional, Set, Tuple
+from collections import OrderedDict
+import asyncio
+import hashlib
+import math
+import time
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+
+class RotatingBloomFilter:
+    """
+    Two Bloom filter generations of `capacity` items each. New items go to
+    the current generation; once it is full it becomes the previous one and
+    a fresh generation starts, so a filter remembers between `capacity` and
+    2 * `capacity` recent items at a bounded false positive rate.
+
+    Filters of the same user merge by rotating to the same generation and
+    OR-ing the bits, so workers can update their copies independently.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 2000,
+        error_rate: float = 0.01,
+        generation: int = 0,
+        current: Optional[bytes] = None,
+        previous: Optional[bytes] = None,
+        count: int = 0
+    ):
+        self.capacity = capacity
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        size = (self.num_bits + 7) // 8
+        self.generation = generation
+        self.current = bytearray(current) if current else bytearray(size)
+        self.previous = bytearray(previous) if previous else bytearray(size)
+        self.count = count
+
+    def _positions(self, value: str) -> List[int]:
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    @staticmethod
+    def _test(bits: bytearray, positions: List[int]) -> bool:
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def add(self, value: str):
+        positions = self._positions(value)
+        if self._test(self.current, positions):
+            return
+        if self.count >= self.capacity:
+            self.rotate()
+        for position in positions:
+            self.current[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        positions = self._positions(value)
+        return self._test(self.current, positions) or self._test(self.previous, positions)
+
+    def rotate(self):
+        self.previous, self.current = self.current, bytearray(len(self.current))
+        self.generation += 1
+        self.count = 0
+
+    def merge(self, other: "RotatingBloomFilter"):
+        """Union with another copy of the same user's filter"""
+        while self.generation < other.generation:
+            self.rotate()
+        if other.generation < self.generation - 1:
+            return  # Everything in the other copy has already rotated out
+        if other.generation == self.generation:
+            pairs = [(self.current, other.current), (self.previous, other.previous)]
+            self.count = max(self.count, other.count)
+        else:
+            pairs = [(self.previous, other.current)]
+        for mine, theirs in pairs:
+            for index, byte in enumerate(theirs):
+                mine[index] |= byte
+
+    def to_document(self) -> Dict:
+        return {
+            "generation": self.generation,
+            "current": bytes(self.current),
+            "previous": bytes(self.previous),
+            "count": self.count
+        }
+
+    @classmethod
+    def from_document(cls, doc: Dict, capacity: int, error_rate: float) -> "RotatingBloomFilter":
+        return cls(capacity, error_rate, doc.get("generation", 0), doc.get("current"), doc.get("previous"), doc.get("count", 0))
+
+class SeenFilter:
+    """
+    Keeps, per user, a rotating Bloom filter of the polls they viewed, voted
+    on or marked "not interested", plus their hidden authors, so the feed can
+    drop seen polls while generating candidates without querying poll_views,
+    votes and user_preferences on every request.
+
+    Filters live in a bounded in-memory LRU, are built from those collections
+    the first time a user is seen, and are persisted to `user_seen_filters`
+    in periodic batches (merged with other workers' copies). Entries are
+    reloaded after `reload_interval` seconds to pick up other workers' updates.
+    """
+
+    def __init__(
+        self,
+        db,
+        capacity: int = 2000,
+        error_rate: float = 0.01,
+        flush_interval: float = 5,
+        max_users: int = 10000,
+        reload_interval: float = 300
+    ):
+        self.db = db
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.flush_interval = flush_interval
+        self.max_users = max_users
+        self.reload_interval = reload_interval
+        self.flush_task: Optional[asyncio.Task] = None
+        self.flush_lock = asyncio.Lock()
+
+        self.entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self.dirty: Set[str] = set()
+
+        # Statistics
+        self.loads = 0
+        self.bootstraps = 0
+        self.writes = 0
+        self.failed_flushes = 0
+
+    async def initialize_indexes(self):
+        """Create indexes used by the seen filter"""
+
+        await self.db.user_seen_filters.create_index([("user_id", 1)], unique=True, name="seen_filter_user")
+
+        print("✅ Seen filter indexes created successfully")
+
+    # =============  LOADING =============
+
+    async def _bootstrap(self, user_id: str) -> Dict:
+        """Build a user's filter from their views, votes and feed preferences"""
+        views, votes, preferences = await asyncio.gather(
+            self.db.poll_views.find(
+                {"user_id": user_id}, {"_id": 0, "poll_id": 1}
+            ).sort("viewed_at", -1).limit(self.capacity).to_list(self.capacity),
+            self.db.votes.find(
+                {"user_id": user_id}, {"_id": 0, "poll_id": 1}
+            ).sort("created_at", -1).limit(self.capacity).to_list(self.capacity),
+            self.db.user_preferences.find(
+                {"user_id": user_id, "preference_type": {"$in": ["hidden_user", "not_interested"]}},
+                {"_id": 0, "preference_type": 1, "poll_id": 1, "author_id": 1}
+            ).to_list(None)
+        )
+
+        bloom = RotatingBloomFilter(self.capacity, self.error_rate)
+        hidden_authors, not_interested = set(), set()
+        for pref in preferences:
+            if pref["preference_type"] == "hidden_user" and pref.get("author_id"):
+                hidden_authors.add(pref["author_id"])
+            elif pref["preference_type"] == "not_interested" and pref.get("poll_id"):
+                not_interested.add(pref["poll_id"])
+        # Oldest first, so the newest ones survive a rotation
+        for poll_id in reversed([doc["poll_id"] for doc in views + votes]):
+            bloom.add(poll_id)
+        for poll_id in not_interested:
+            bloom.add(poll_id)
+
+        try:
+            await self.db.user_seen_filters.insert_one({
+                "user_id": user_id,
+                **bloom.to_document(),
+                "hidden_authors": list(hidden_authors),
+                "not_interested": list(not_interested),
+                "version": 0,
+                "updated_at": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            # Another worker built it first, ours is merged in on the next flush
+            self.dirty.add(user_id)
+        self.bootstraps += 1
+        return {"bloom": bloom, "hidden_authors": hidden_authors, "not_interested": not_interested}
+
+    async def _load(self, user_id: str) -> Dict:
+        doc = await self.db.user_seen_filters.find_one({"user_id": user_id}, {"_id": 0})
+        self.loads += 1
+        if not doc:
+            return await self._bootstrap(user_id)
+        return {
+            "bloom": RotatingBloomFilter.from_document(doc, self.capacity, self.error_rate),
+            "hidden_authors": set(doc.get("hidden_authors") or []),
+            "not_interested": set(doc.get("not_interested") or [])
+        }
+
+    async def get(self, user_id: str) -> Dict:
+        """A user's {"bloom", "hidden_authors", "not_interested"} state"""
+        entry = self.entries.get(user_id)
+        if entry is not None and time.monotonic() - entry["loaded_at"] < self.reload_interval:
+            self.entries.move_to_end(user_id)
+            return entry
+
+        loaded = await self._load(user_id)
+        if entry is not None:
+            # Keep local additions that were not flushed yet
+            loaded["bloom"].merge(entry["bloom"])
+        loaded["loaded_at"] = time.monotonic()
+        self.entries[user_id] = loaded
+        self.entries.move_to_end(user_id)
+
+        while len(self.entries) > self.max_users:
+            evicted_id, _ = next(iter(self.entries.items()))
+            if evicted_id in self.dirty:
+                break  # Flushed first, evicted on a later call
+            self.entries.popitem(last=False)
+        return loaded
+
+    # =============  UPDATES =============
+
+    async def mark_seen(self, user_id: str, *poll_ids: str):
+        """Record polls the user viewed or voted on"""
+        if not user_id:
+            return
+        entry = await self.get(user_id)
+        for poll_id in poll_ids:
+            if poll_id:
+                entry["bloom"].add(poll_id)
+        self.dirty.add(user_id)
+
+    async def mark_not_interested(self, user_id: str, poll_id: str):
+        entry = await self.get(user_id)
+        entry["not_interested"].add(poll_id)
+        entry["bloom"].add(poll_id)
+        self.dirty.add(user_id)
+        await self.db.user_seen_filters.update_one({"user_id": user_id}, {"$addToSet": {"not_interested": poll_id}})
+
+    async def hide_author(self, user_id: str, author_id: str):
+        entry = await self.get(user_id)
+        entry["hidden_authors"].add(author_id)
+        await self.db.user_seen_filters.update_one({"user_id": user_id}, {"$addToSet": {"hidden_authors": author_id}})
+
+    # =============  READS =============
+
+    async def excluded(self, user_id: str, poll_ids: List[str]) -> Tuple[Set[str], Set[str]]:
+        """(poll ids the user has probably seen, author ids they hid)"""
+        entry = await self.get(user_id)
+        bloom = entry["bloom"]
+        return {poll_id for poll_id in poll_ids if poll_id in bloom}, set(entry["hidden_authors"])
+
+    # =============  FLUSH =============
+
+    async def _write(self, user_id: str, bloom: RotatingBloomFilter) -> bool:
+        """Merge a filter into the stored copy (optimistic, retried on concurrent writes)"""
+        for _ in range(3):
+            doc = await self.db.user_seen_filters.find_one(
+                {"user_id": user_id},
+                {"_id": 0, "generation": 1, "current": 1, "previous": 1, "count": 1, "version": 1}
+            )
+            if doc is None:
+                return False  # Bootstrap failed, rebuilt on the next load
+            merged = RotatingBloomFilter.from_document(doc, self.capacity, self.error_rate)
+            merged.merge(bloom)
+            result = await self.db.user_seen_filters.update_one(
+                {"user_id": user_id, "version": doc.get("version", 0)},
+                {"$set": {**merged.to_document(), "updated_at": datetime.utcnow()}, "$inc": {"version": 1}}
+            )
+            if result.matched_count:
+                bloom.merge(merged)
+                return True
+        return False
+
+    async def flush(self) -> int:
+        """Persist every filter changed since the last flush. Returns the number written"""
+        async with self.flush_lock:
+            dirty, self.dirty = self.dirty, set()
+            written = 0
+            for user_id in dirty:
+                entry = self.entries.get(user_id)
+                if entry is None:
+                    continue
+                try:
+                    if await self._write(user_id, entry["bloom"]):
+                        written += 1
+                    else:
+                        self.dirty.add(user_id)
+                except Exception as e:
+                    self.failed_flushes += 1
+                    self.dirty.add(user_id)
+                    print(f"❌ Seen filter flush failed for {user_id}: {e}")
+            self.writes += written
+            return written
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Seen filter flush loop error: {e}")
+
+    def start(self):
+        """Start the periodic flush loop"""
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        """Stop the flush loop and persist pending changes"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+    def get_stats(self) -> Dict:
+        """Get seen filter statistics"""
+        sample = RotatingBloomFilter(self.capacity, self.error_rate)
+        return {
+            "cached_users": len(self.entries),
+            "dirty_users": len(self.dirty),
+            "loads": self.loads,
+            "bootstraps": self.bootstraps,
+            "writes": self.writes,
+            "failed_flushes": self.failed_flushes,
+            "capacity": self.capacity,
+            "error_rate": self.error_rate,
+            "bytes_per_user": 2 * len(sample.current)
+        }
+
+# Global instance
+seen_filter = None
+
+def init_seen_filter(db, capacity: int = 2000, error_rate: float = 0.01, flush_interval: float = 5, max_users: int = 10000):
+    """Initialize the seen filter"""
+    global seen_filter
+    seen_filter = SeenFilter(db, capacity, error_rate, flush_interval, max_users)
+
+    # Initialize indexes in background
+    asyncio.create_task(seen_filter.initialize_indexes())
+
+    return seen_filter
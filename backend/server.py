@@ -1,17 +1,18 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Response, UploadFile, File, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Response, UploadFile, File, Query, WebSocket
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 import os
 import uuid
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, NamedTuple
 import uuid
 from datetime import datetime, timedelta, date, timedelta
 import random
@@ -75,6 +76,8 @@ from auth import (
     verify_password, get_password_hash, create_access_token, 
     verify_token, ACCESS_TOKEN_EXPIRE_MINUTES
 )
+from feed_cursor import get_sort_fields, get_sort_spec, apply_cursor, encode_cursor, page_cursor
+from cache_manager import cache_manager, create_cache_backend, SingleFlight, NEGATIVE_RESULT
 
 # Import configuration
 from config import config
@@ -100,7 +103,7 @@ print(f"🗄️ Database: Usando '{config.DB_NAME}'")
 # Initialize Feed Optimizer
 try:
     from optimized_feed import init_feed_optimizer
-    init_feed_optimizer(db)
+    init_feed_optimizer(db, prefetch_concurrency=config.FEED_PREFETCH_CONCURRENCY)
     print("🚀 Feed optimizer initialized successfully")
 except Exception as e:
     print(f"⚠️  Feed optimizer initialization failed: {e}")
@@ -154,6 +157,136 @@ try:
 except Exception as e:
     print(f"⚠️  Database optimizer initialization failed: {e}")
 
+# Initialize Following Timeline Materializer
+if config.FOLLOWING_TIMELINE_ENABLED:
+    try:
+        from timeline_materializer import init_timeline_materializer
+        init_timeline_materializer(db, config.TIMELINE_FANOUT_MAX_FOLLOWERS, config.TIMELINE_BACKFILL_LIMIT)
+        print("📬 Following timeline materializer initialized successfully")
+    except Exception as e:
+        print(f"⚠️  Following timeline materializer initialization failed: {e}")
+
+# Initialize Profile Counters
+try:
+    from profile_counters import init_profile_counters
+    init_profile_counters(db, config.PROFILE_RECONCILE_INTERVAL, config.PROFILE_RECONCILE_BATCH_SIZE)
+    print("🧮 Profile counters initialized successfully")
+except Exception as e:
+    print(f"⚠️  Profile counters initialization failed: {e}")
+
+# Initialize Sharded Counters (always, so polls already switched over keep reading their shards)
+try:
+    from sharded_counters import init_sharded_counters
+    init_sharded_counters(db, config.SHARDED_COUNTERS_SHARDS, config.SHARDED_COUNTERS_ENABLED)
+    print("🧩 Sharded counters initialized successfully")
+except Exception as e:
+    print(f"⚠️  Sharded counters initialization failed: {e}")
+
+# Initialize Search Index
+if config.SEARCH_CONFIG['INDEX_ENABLED']:
+    try:
+        from search_index import init_search_index
+        init_search_index(db, config.SEARCH_CONFIG['INDEX_SYNC_INTERVAL_SECONDS'])
+        print("🔎 Search index initialized successfully")
+    except Exception as e:
+        print(f"⚠️  Search index initialization failed: {e}")
+
+# Initialize Hashtag Stats
+try:
+    from hashtag_stats import init_hashtag_stats
+    init_hashtag_stats(db, config.SEARCH_CONFIG['TRENDING_DAYS'], config.HASHTAG_ROLLUP_INTERVAL)
+    print("#️⃣ Hashtag stats initialized successfully")
+except Exception as e:
+    print(f"⚠️  Hashtag stats initialization failed: {e}")
+
+# Initialize Trending Snapshots
+try:
+    from trending_snapshots import init_trending_snapshots
+    init_trending_snapshots(
+        db,
+        config.TRENDING_SNAPSHOT_INTERVAL,
+        config.TRENDING_SNAPSHOT_SIZE,
+        config.SEARCH_CONFIG['TRENDING_DAYS'],
+        config.TRENDING_HALF_LIFE_HOURS
+    )
+    print("📈 Trending snapshots initialized successfully")
+except Exception as e:
+    print(f"⚠️  Trending snapshots initialization failed: {e}")
+
+# Initialize Feed Ranker (for_you slates)
+try:
+    from feed_ranking import init_feed_ranker
+    init_feed_ranker(
+        db,
+        config.FEED_SLATE_SIZE,
+        config.FEED_SOURCE_LIMIT,
+        config.FEED_RECENT_HOURS,
+        config.TRENDING_HALF_LIFE_HOURS
+    )
+    print("🎯 Feed ranker initialized successfully")
+except Exception as e:
+    print(f"⚠️  Feed ranker initialization failed: {e}")
+
+# Initialize Seen Filter (polls already viewed, voted on or dismissed, per user)
+if config.SEEN_FILTER_ENABLED:
+    try:
+        from seen_filter import init_seen_filter
+        init_seen_filter(
+            db,
+            config.SEEN_FILTER_CAPACITY,
+            config.SEEN_FILTER_ERROR_RATE,
+            config.SEEN_FILTER_FLUSH_INTERVAL,
+            config.SEEN_FILTER_MAX_USERS
+        )
+        print("👁️ Seen filter initialized successfully")
+    except Exception as e:
+        print(f"⚠️  Seen filter initialization failed: {e}")
+
+# Initialize Autocomplete Index (follows the search index's updates when it is enabled)
+if config.SEARCH_CONFIG['AUTOCOMPLETE_INDEX_ENABLED']:
+    try:
+        from autocomplete_index import init_autocomplete_index
+        from search_index import search_index
+        autocomplete = init_autocomplete_index(
+            db,
+            config.SEARCH_CONFIG['AUTOCOMPLETE_SNAPSHOT_PATH'],
+            config.SEARCH_CONFIG['AUTOCOMPLETE_SNAPSHOT_INTERVAL_SECONDS']
+        )
+        if search_index:
+            search_index.add_listener(autocomplete.apply_documents)
+        print("🔤 Autocomplete index initialized successfully")
+    except Exception as e:
+        print(f"⚠️  Autocomplete index initialization failed: {e}")
+
+# Initialize Buffered View Ingestion
+if config.VIEW_INGESTION_ENABLED:
+    try:
+        from view_ingestion import init_view_ingestion
+        init_view_ingestion(
+            db,
+            config.VIEW_FLUSH_INTERVAL_MS,
+            config.VIEW_MAX_PENDING,
+            config.VIEW_HLL_PRECISION,
+            config.VIEW_SKETCH_COMPACT_INTERVAL
+        )
+        print("👁️ View ingestion pipeline initialized successfully")
+    except Exception as e:
+        print(f"⚠️  View ingestion pipeline initialization failed: {e}")
+
+# Initialize Write-Behind Engagement Buffer (votes and likes)
+if config.ENGAGEMENT_WRITE_BEHIND_ENABLED:
+    try:
+        from engagement_buffer import init_engagement_buffer
+        init_engagement_buffer(
+            db,
+            config.ENGAGEMENT_FLUSH_INTERVAL_MS,
+            config.ENGAGEMENT_MAX_PENDING,
+            on_profile_deltas=lambda user_id, **deltas: increment_profile_counters(user_id, **deltas)
+        )
+        print("🗳️ Engagement write-behind buffer initialized successfully")
+    except Exception as e:
+        print(f"⚠️  Engagement write-behind buffer initialization failed: {e}")
+
 # File upload configuration using config
 config.create_upload_directories()
 UPLOAD_DIR = config.UPLOAD_BASE_DIR
@@ -161,23 +294,194 @@ UPLOAD_DIR = config.UPLOAD_BASE_DIR
 # Mount static files to serve uploads
 app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
-# Cache for iTunes API responses to improve performance
-itunes_cache = {}
-follow_status_cache = {}
-CACHE_EXPIRY_HOURS = 24  # Cache iTunes data for 24 hours
-FOLLOW_CACHE_EXPIRY_MINUTES = 10  # Cache follow status for 10 minutes
+# Shared cache backend: per-process memory or Redis shared by every worker
+cache_manager.configure_backend(
+    create_cache_backend(config.CACHE_CONFIG['BACKEND'], config.CACHE_CONFIG['REDIS_URL']),
+    local_ttl_cap=config.CACHE_CONFIG['LOCAL_TTL_SECONDS']
+)
+print(f"🧠 Cache backend: {cache_manager.backend.name}")
 
-def is_cache_valid(cached_item):
-    """Check if cached item is still valid"""
-    if not cached_item:
-        return False
-    return (datetime.utcnow() - cached_item['cached_at']).total_seconds() < (CACHE_EXPIRY_HOURS * 3600)
+# Initialize Login Security (failed-login windows go through Redis when the cache backend does)
+try:
+    from login_security import init_login_security
+    init_login_security(
+        db,
+        config.LOGIN_HASH_WORKERS,
+        config.LOGIN_HASH_MAX_QUEUE,
+        config.LOGIN_RATE_WINDOW_MINUTES,
+        config.LOGIN_RATE_LIMIT_EMAIL,
+        config.LOGIN_RATE_LIMIT_IP,
+        config.LOGIN_ATTEMPTS_FLUSH_INTERVAL,
+        redis_client=cache_manager.backend.client if cache_manager.backend.shared and config.LOGIN_RATE_LIMIT_SHARED else None
+    )
+    print("🔐 Login security initialized successfully")
+except Exception as e:
+    print(f"⚠️  Login security initialization failed: {e}")
+
+# Initialize Task Queue (post-login side effects)
+try:
+    from task_queue import init_task_queue
+    init_task_queue(db, config.TASK_QUEUE_WORKERS, config.TASK_QUEUE_POLL_INTERVAL, config.TASK_QUEUE_MAX_ATTEMPTS)
+    print("📮 Task queue initialized successfully")
+except Exception as e:
+    print(f"⚠️  Task queue initialization failed: {e}")
+
+# Initialize Realtime Gateway (events go through Redis when the cache backend does, so any worker can deliver them)
+if config.REALTIME_ENABLED:
+    try:
+        from realtime import init_realtime_gateway
+        init_realtime_gateway(
+            config.REALTIME_SEND_QUEUE_SIZE,
+            config.REALTIME_MAX_CONNECTIONS_PER_USER,
+            config.REALTIME_PING_INTERVAL,
+            redis_client=cache_manager.backend.client if cache_manager.backend.shared and config.REALTIME_SHARED else None
+        )
+        print("⚡ Realtime gateway initialized successfully")
+    except Exception as e:
+        print(f"⚠️  Realtime gateway initialization failed: {e}")
+
+# Bounded LRU/TTL caches for iTunes API responses and follow status
+itunes_cache = cache_manager.namespace(
+    "itunes",
+    max_size=config.CACHE_CONFIG['ITUNES']['MAX_SIZE'],
+    ttl=config.CACHE_CONFIG['ITUNES']['TTL_SECONDS']
+)
+# Concurrent lookups for the same iTunes track/search share one request
+itunes_lookups = SingleFlight("itunes")
+itunes_http_client: Optional[httpx.AsyncClient] = None
+
+def get_itunes_http_client() -> httpx.AsyncClient:
+    """Long-lived pooled HTTP client for the iTunes API (created inside the event loop)"""
+    global itunes_http_client
+    if itunes_http_client is None or itunes_http_client.is_closed:
+        max_connections = config.CACHE_CONFIG['ITUNES']['MAX_CONNECTIONS']
+        itunes_http_client = httpx.AsyncClient(
+            timeout=config.CACHE_CONFIG['ITUNES']['TIMEOUT_SECONDS'],
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+    return itunes_http_client
+
+follow_status_cache = cache_manager.namespace(
+    "follow_status",
+    max_size=config.CACHE_CONFIG['FOLLOW_STATUS']['MAX_SIZE'],
+    ttl=config.CACHE_CONFIG['FOLLOW_STATUS']['TTL_SECONDS']
+)
+
+# Ranked search results, shared by every user (per-user fields are added when serving)
+search_results_cache = cache_manager.namespace(
+    "search_results",
+    max_size=config.SEARCH_CONFIG['CACHE_MAX_SIZE'],
+    ttl=config.SEARCH_CONFIG['CACHE_TTL_SECONDS']
+)
+
+def search_cache_key(kind: str, query: str, *params) -> str:
+    """Cache key for a search: lowercased query with collapsed whitespace, plus its parameters"""
+    return ":".join([kind, *(str(param) for param in params), " ".join(query.lower().split())])
+
+async def get_cached_search(key: str):
+    if not config.SEARCH_CONFIG['ENABLE_SEARCH_CACHE']:
+        return None
+    return await search_results_cache.aget(key)
 
-def is_follow_cache_valid(cached_item):
-    """Check if follow cache item is still valid"""
-    if not cached_item:
-        return False
-    return (datetime.utcnow() - cached_item['cached_at']).total_seconds() < (FOLLOW_CACHE_EXPIRY_MINUTES * 60)
+async def cache_search(key: str, value):
+    if config.SEARCH_CONFIG['ENABLE_SEARCH_CACHE']:
+        await search_results_cache.aset(key, value)
+
+async def invalidate_follow_status_cache(*user_ids: str):
+    """Drop cached follow status entries involving any of the given users (in every worker)"""
+    for user_id in user_ids:
+        if user_id:
+            await follow_status_cache.ainvalidate_tag(f"user:{user_id}")
+
+# Public identity of a user as shown next to messages and in the inbox
+user_cards_cache = cache_manager.namespace(
+    "user_cards",
+    max_size=config.CACHE_CONFIG['USER_CARDS']['MAX_SIZE'],
+    ttl=config.CACHE_CONFIG['USER_CARDS']['TTL_SECONDS']
+)
+
+USER_CARD_PROJECTION = {"_id": 0, "id": 1, "username": 1, "display_name": 1, "avatar_url": 1, "is_verified": 1}
+
+# Conversations keep the start of their latest message for the inbox
+MESSAGE_SNIPPET_LENGTH = 200
+
+def user_card(user: Dict) -> Dict:
+    return {
+        "id": user["id"],
+        "username": user.get("username"),
+        "display_name": user.get("display_name"),
+        "avatar_url": user.get("avatar_url"),
+        "is_verified": user.get("is_verified", False)
+    }
+
+async def get_user_cards(user_ids) -> Dict[str, Dict]:
+    """Cards of the given users (missing users are left out): cached ones first, the rest in one query"""
+    cards, missing = {}, []
+    for user_id in dict.fromkeys(user_ids):
+        card = await user_cards_cache.aget(user_id)
+        if card is None:
+            missing.append(user_id)
+        else:
+            cards[user_id] = card
+    
+    if missing:
+        users = await db.users.find({"id": {"$in": missing}}, USER_CARD_PROJECTION).to_list(len(missing))
+        for user in users:
+            cards[user["id"]] = user_card(user)
+            await user_cards_cache.aset(user["id"], cards[user["id"]])
+    return cards
+
+async def refresh_user_card(user_id: str):
+    """Re-snapshot a user's card after a profile change (cache and the conversations that embed it)"""
+    await user_cards_cache.adelete(user_id)
+    card = (await get_user_cards([user_id])).get(user_id)
+    if card:
+        await db.conversations.update_many(
+            {"participants": user_id},
+            {"$set": {f"participant_cards.{user_id}": card}}
+        )
+
+async def push_event(user_ids, event_type: str, data: Dict):
+    """Push an event to the users' open WebSocket connections (a no-op when the gateway is disabled)"""
+    from realtime import realtime_gateway
+    if realtime_gateway:
+        await realtime_gateway.publish(user_ids, event_type, data)
+
+async def push_activity(poll: Dict, actor_id: str, kind: str, **data):
+    """Tell a poll's author about a like, comment or vote by someone else"""
+    author_id = poll.get("author_id")
+    if not author_id or author_id == actor_id:
+        return
+    actor = (await get_user_cards([actor_id])).get(actor_id)
+    await push_event([author_id], "activity", {"kind": kind, "poll_id": poll["id"], "actor": actor, **data})
+
+async def refresh_search_index(doc_type: str, doc_id: str):
+    """Reindex a user or post after it was created, updated or deleted"""
+    from search_index import search_index
+    from autocomplete_index import autocomplete_index
+    if search_index:
+        # Also updates the autocomplete index (registered as a listener)
+        await search_index.refresh(doc_type, doc_id)
+    elif autocomplete_index:
+        await autocomplete_index.refresh(doc_type, doc_id)
+
+async def mark_polls_seen(user_id: Optional[str], *poll_ids: str):
+    """Record polls a user viewed or voted on so the feed stops serving them"""
+    from seen_filter import seen_filter
+    if seen_filter and user_id:
+        await seen_filter.mark_seen(user_id, *poll_ids)
+
+async def invalidate_feed_slate(user_id: str):
+    """Rebuild a user's for_you slate on their next page (after a feed preference changed)"""
+    from feed_ranking import feed_ranker
+    if feed_ranker:
+        await feed_ranker.invalidate(user_id)
+
+async def record_hashtag_change(before: Optional[Dict], after: Optional[Dict]):
+    """Update hashtag counters after a poll was created (before=None), edited or deleted (after=None)"""
+    from hashtag_stats import hashtag_stats
+    if hashtag_stats:
+        await hashtag_stats.record_change(before, after)
 
 # Create a router with configurable prefix
 api_router = APIRouter(prefix=config.API_PREFIX)
@@ -185,28 +489,80 @@ api_router = APIRouter(prefix=config.API_PREFIX)
 # Security
 security = HTTPBearer()
 
+# Authenticated users by token subject and version, so most requests skip the users lookup
+principal_cache = cache_manager.namespace(
+    "principals",
+    max_size=config.CACHE_CONFIG['PRINCIPALS']['MAX_SIZE'],
+    ttl=config.CACHE_CONFIG['PRINCIPALS']['TTL_SECONDS']
+)
+
+class TokenPrincipal(NamedTuple):
+    """Identity carried by a verified token (no database lookup)"""
+    id: str
+    token_version: int = 0
+
+def token_principal(token: str) -> Optional[TokenPrincipal]:
+    payload = verify_token(token)
+    if not payload or not payload.get("sub"):
+        return None
+    return TokenPrincipal(payload["sub"], payload.get("ver", 0))
+
+async def load_principal_user(principal: TokenPrincipal) -> Optional[UserResponse]:
+    """The token's user (cached); None if it no longer exists or the token was revoked"""
+    cache_key = f"{principal.id}:{principal.token_version}"
+    user = await principal_cache.aget(cache_key)
+    if user is not None:
+        return user
+    
+    # Get user from database - exclude _id to avoid ObjectId serialization issues
+    user_data = await db.users.find_one({"id": principal.id}, {"_id": 0})
+    if not user_data or user_data.get("token_version", 0) != principal.token_version:
+        return None
+    
+    user = UserResponse(**user_data)
+    await principal_cache.aset(cache_key, user, tags=[f"user:{principal.id}"])
+    return user
+
+async def invalidate_principal(user_id: str):
+    """Drop a user's cached principal (in every worker) after their profile, settings or password change"""
+    await principal_cache.ainvalidate_tag(f"user:{user_id}")
+
 # Authentication dependency
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> UserResponse:
     """Get current authenticated user"""
-    token = credentials.credentials
-    payload = verify_token(token)
-    if not payload:
+    principal = token_principal(credentials.credentials)
+    if not principal:
         raise HTTPException(
             status_code=config.StatusCodes.UNAUTHORIZED,
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Get user from database - exclude _id to avoid ObjectId serialization issues
-    user_data = await db.users.find_one({"id": payload["sub"]}, {"_id": 0})
-    if not user_data:
+    user = await load_principal_user(principal)
+    if not user:
         raise HTTPException(
             status_code=config.StatusCodes.UNAUTHORIZED,
             detail="User not found",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    return UserResponse(**user_data)
+    return user
+
+
+async def get_token_principal(credentials: HTTPAuthorizationCredentials = Depends(security)) -> TokenPrincipal:
+    """
+    Authenticated user id straight from the token, without touching the database.
+    For read endpoints that only need `current_user.id`; revocation is only
+    enforced by the full get_current_user dependency.
+    """
+    principal = token_principal(credentials.credentials)
+    if not principal:
+        raise HTTPException(
+            status_code=config.StatusCodes.UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return principal
 
 
 async def get_current_user_optional(
@@ -217,36 +573,54 @@ async def get_current_user_optional(
         return None
     
     try:
-        token = credentials.credentials
-        payload = verify_token(token)
-        if not payload:
-            return None
-        
-        # Get user from database - exclude _id to avoid ObjectId serialization issues
-        user_data = await db.users.find_one({"id": payload["sub"]}, {"_id": 0})
-        if not user_data:
+        principal = token_principal(credentials.credentials)
+        if not principal:
             return None
-        
-        return UserResponse(**user_data)
+        return await load_principal_user(principal)
     except Exception:
         return None
 
 
 # =============  SECURITY UTILITIES =============
 
-async def track_login_attempt(email: str, ip_address: str, user_agent: str, success: bool, failure_reason: Optional[str] = None):
-    """Track login attempts for security monitoring"""
+async def track_login_attempt(
+    email: str,
+    ip_address: str,
+    user_agent: str,
+    success: bool,
+    failure_reason: Optional[str] = None,
+    attempt_id: Optional[str] = None
+):
+    """
+    Track login attempts for security monitoring (written in batches).
+    With an `attempt_id` the record is written at most once.
+    """
     attempt = LoginAttempt(
         email=email,
         ip_address=ip_address,
         user_agent=user_agent,
         success=success,
-        failure_reason=failure_reason
+        failure_reason=failure_reason,
+        **({"id": attempt_id} if attempt_id else {})
     )
-    await db.login_attempts.insert_one(attempt.dict())
+    attempt_doc = attempt.dict()
+    if attempt_id:
+        attempt_doc["_id"] = attempt_id
+    from login_security import login_security
+    if login_security:
+        await login_security.record_attempt(attempt_doc)
+    else:
+        try:
+            await db.login_attempts.insert_one(attempt_doc)
+        except DuplicateKeyError:
+            pass
 
 async def check_rate_limit(email: str, ip_address: str) -> bool:
     """Check if user has exceeded login attempt limits"""
+    from login_security import login_security
+    if login_security:
+        return await login_security.allow(email, ip_address)
+    
     # Check failed attempts in last 15 minutes
     time_threshold = datetime.utcnow() - timedelta(minutes=15)
     
@@ -267,6 +641,26 @@ async def check_rate_limit(email: str, ip_address: str) -> bool:
     # Rate limits: 5 attempts per email, 10 per IP in 15 minutes
     return email_failures < 5 and ip_failures < 10
 
+async def check_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password on the login security worker pool (inline when it is unavailable)"""
+    from login_security import login_security, PasswordPoolBusy
+    if not login_security:
+        return verify_password(plain_password, hashed_password)
+    try:
+        return await login_security.verify_password(plain_password, hashed_password)
+    except PasswordPoolBusy:
+        raise HTTPException(status_code=503, detail="Too many sign-ins in progress. Please try again shortly.")
+
+async def hash_password(password: str) -> str:
+    """Hash a password on the login security worker pool (inline when it is unavailable)"""
+    from login_security import login_security, PasswordPoolBusy
+    if not login_security:
+        return get_password_hash(password)
+    try:
+        return await login_security.hash_password(password)
+    except PasswordPoolBusy:
+        raise HTTPException(status_code=503, detail="Too many sign-ins in progress. Please try again shortly.")
+
 def parse_user_agent(user_agent_string: str) -> Dict[str, str]:
     """Parse user agent string to extract device information"""
     user_agent = parse(user_agent_string)
@@ -316,20 +710,34 @@ async def get_or_create_device(user_id: str, ip_address: str, user_agent: str) -
         await db.user_devices.insert_one(device.dict())
         return device
 
-async def create_security_notification(user_id: str, notification_type: str, title: str, message: str, metadata: Dict = None):
-    """Create a security notification for the user"""
+async def create_security_notification(
+    user_id: str,
+    notification_type: str,
+    title: str,
+    message: str,
+    metadata: Dict = None,
+    notification_id: Optional[str] = None
+):
+    """Create a security notification for the user (at most once per `notification_id`, when given)"""
     notification = SecurityNotification(
         user_id=user_id,
         notification_type=notification_type,
         title=title,
         message=message,
-        metadata=metadata or {}
+        metadata=metadata or {},
+        **({"id": notification_id} if notification_id else {})
     )
-    await db.security_notifications.insert_one(notification.dict())
+    notification_doc = notification.dict()
+    if notification_id:
+        notification_doc["_id"] = notification_id
+    try:
+        await db.security_notifications.insert_one(notification_doc)
+    except DuplicateKeyError:
+        pass
 
-async def create_session(user_id: str, device_id: str, ip_address: str, user_agent: str) -> str:
-    """Create a new user session"""
-    session_token = str(uuid.uuid4())
+async def create_session(user_id: str, device_id: str, ip_address: str, user_agent: str, session_token: Optional[str] = None) -> str:
+    """Create a new user session (once per token, so a retried task does not duplicate it)"""
+    session_token = session_token or str(uuid.uuid4())
     expires_at = datetime.utcnow() + timedelta(days=7)  # 7 days expiry
     
     session = UserSession(
@@ -341,9 +749,88 @@ async def create_session(user_id: str, device_id: str, ip_address: str, user_age
         expires_at=expires_at
     )
     
-    await db.user_sessions.insert_one(session.dict())
+    await db.user_sessions.update_one(
+        {"session_token": session_token},
+        {"$setOnInsert": session.dict()},
+        upsert=True
+    )
     return session_token
 
+def login_record_id(session_token: str, record: str) -> str:
+    """Stable id of a record written for a login, so a retried task writes it once"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"votatok:login:{session_token}:{record}"))
+
+async def run_login_side_effects(payload: Dict):
+    """
+    Device, last login, login attempt, session and notifications of a successful login.
+    Every write is keyed on the session token, so a retry after a partial run repeats nothing.
+    """
+    user_id = payload["user_id"]
+    ip_address = payload["ip_address"]
+    user_agent = payload["user_agent"]
+    session_token = payload["session_token"]
+    
+    # Get or create device
+    device = await get_or_create_device(user_id, ip_address, user_agent)
+    
+    # Check if this is a new device
+    if not device.is_trusted:
+        await create_security_notification(
+            user_id,
+            "new_device",
+            "New Device Login",
+            f"Login detected from new device: {device.device_name} ({device.browser})",
+            {
+                "device_id": device.id,
+                "ip_address": ip_address,
+                "location": "Unknown"  # You could add IP geolocation here
+            },
+            notification_id=login_record_id(session_token, "new_device")
+        )
+    
+    # Update last login
+    await db.users.update_one(
+        {"id": user_id},
+        {"$set": {"last_login": payload["logged_in_at"]}}
+    )
+    await invalidate_principal(user_id)
+    
+    # Track successful login
+    await track_login_attempt(
+        payload["email"], ip_address, user_agent, True,
+        attempt_id=login_record_id(session_token, "attempt")
+    )
+    
+    # Create session
+    await create_session(user_id, device.id, ip_address, user_agent, session_token)
+    
+    # Create login notification
+    await create_security_notification(
+        user_id,
+        "new_login",
+        "New Login",
+        f"Successful login from {device.device_name} ({device.browser})",
+        {
+            "device_id": device.id,
+            "ip_address": ip_address,
+            "session_token": session_token
+        },
+        notification_id=login_record_id(session_token, "new_login")
+    )
+
+# Handlers of durable background tasks, by task name
+BACKGROUND_TASK_HANDLERS = {
+    "login_side_effects": run_login_side_effects
+}
+
+async def enqueue_task(name: str, payload: Dict):
+    """Hand a side effect to the task queue (run it inline when the queue is unavailable)"""
+    from task_queue import task_queue
+    if task_queue:
+        await task_queue.enqueue(name, payload)
+    else:
+        await BACKGROUND_TASK_HANDLERS[name](payload)
+
 def get_client_ip(request: Request) -> str:
     """Get client IP address from request"""
     x_forwarded_for = request.headers.get('x-forwarded-for')
@@ -389,6 +876,10 @@ async def create_or_get_oauth_user(oauth_data: Dict, ip_address: str, user_agent
         
         if update_data:
             await db.users.update_one({"id": existing_user["id"]}, {"$set": update_data})
+            await invalidate_principal(existing_user["id"])
+            if "avatar_url" in update_data and update_data["avatar_url"] != existing_user.get("avatar_url"):
+                await refresh_search_index("user", existing_user["id"])
+                await refresh_user_card(existing_user["id"])
             
         # Get updated user data
         user_data = await db.users.find_one({"id": existing_user["id"]})
@@ -415,6 +906,7 @@ async def create_or_get_oauth_user(oauth_data: Dict, ip_address: str, user_agent
         )
         
         await db.users.insert_one(user.dict())
+        await refresh_search_index("user", user.id)
         
         # Create user profile
         profile = UserProfile(id=user.id, username=user.username)
@@ -645,9 +1137,19 @@ def validate_audio_file(file: UploadFile) -> dict:
 
 async def search_itunes_track(artist: str, track: str):
     """Search iTunes API for real song preview"""
+    # Construct search query
+    query = f"{artist} {track}".strip()
+    cache_key = f"search:{query.lower()}"
+
+    cached_result = await itunes_cache.aget(cache_key)
+    if cached_result is not None:
+        return None if cached_result == NEGATIVE_RESULT else cached_result
+
+    return await itunes_lookups.do(cache_key, lambda: fetch_itunes_search(query, cache_key))
+
+async def fetch_itunes_search(query: str, cache_key: str):
+    """Run an iTunes search request and cache the outcome"""
     try:
-        # Construct search query
-        query = f"{artist} {track}".strip()
         url = "https://itunes.apple.com/search"
         params = {
             'term': query,
@@ -658,39 +1160,92 @@ async def search_itunes_track(artist: str, track: str):
             'callback': ''  # Disable JSONP to get pure JSON
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                if response.status == 200:
-                    # Get text and parse as JSON (iTunes returns JSONP by default)
-                    text = await response.text()
-                    
-                    # If it starts with a function call, extract JSON
-                    if text.strip().startswith('(') or 'callback' in text:
-                        # Find JSON part
-                        start = text.find('{')
-                        end = text.rfind('}') + 1
-                        if start >= 0 and end > start:
-                            text = text[start:end]
-                    
-                    import json
-                    data = json.loads(text)
-                    
-                    if data.get('results') and len(data['results']) > 0:
-                        result = data['results'][0]
-                        return {
-                            'preview_url': result.get('previewUrl'),
-                            'artwork_url': result.get('artworkUrl100', '').replace('100x100', '400x400'),
-                            'artist_name': result.get('artistName'),
-                            'track_name': result.get('trackName'),
-                            'duration_ms': result.get('trackTimeMillis', 30000),
-                            'genre': result.get('primaryGenreName'),
-                            'iTunes_id': result.get('trackId')
-                        }
+        response = await get_itunes_http_client().get(url, params=params)
+        if response.status_code == 200:
+            # Get text and parse as JSON (iTunes returns JSONP by default)
+            text = response.text
+            
+            # If it starts with a function call, extract JSON
+            if text.strip().startswith('(') or 'callback' in text:
+                # Find JSON part
+                start = text.find('{')
+                end = text.rfind('}') + 1
+                if start >= 0 and end > start:
+                    text = text[start:end]
+            
+            data = json.loads(text)
+            
+            if data.get('results') and len(data['results']) > 0:
+                result = data['results'][0]
+                search_result = {
+                    'preview_url': result.get('previewUrl'),
+                    'artwork_url': result.get('artworkUrl100', '').replace('100x100', '400x400'),
+                    'artist_name': result.get('artistName'),
+                    'track_name': result.get('trackName'),
+                    'duration_ms': result.get('trackTimeMillis', 30000),
+                    'genre': result.get('primaryGenreName'),
+                    'iTunes_id': result.get('trackId')
+                }
+                await itunes_cache.aset(cache_key, search_result)
+                return search_result
+
+            # Remember searches without results for a shorter time
+            await itunes_cache.aset(cache_key, NEGATIVE_RESULT, ttl=config.CACHE_CONFIG['ITUNES']['NEGATIVE_TTL_SECONDS'])
         return None
     except Exception as e:
         print(f"Error searching iTunes: {e}")
         return None
 
+async def fetch_itunes_track(music_id: str, itunes_track_id: str):
+    """Fetch track info from the iTunes lookup API and cache the outcome"""
+    try:
+        print(f"🎵 Fetching iTunes track info for ID: {itunes_track_id}")
+        
+        # Fetch track info directly from iTunes API using track ID
+        url = f"https://itunes.apple.com/lookup?id={itunes_track_id}"
+        
+        response = await get_itunes_http_client().get(url)
+        if response.status_code == 200:
+            data = response.json()
+            results = data.get('results', [])
+            if results:
+                result = results[0]
+                music_info = {
+                    'id': music_id,
+                    'title': result.get('trackName'),
+                    'artist': result.get('artistName'),
+                    'duration': 30,  # iTunes previews are 30 seconds
+                    'url': '',  # No local URL for iTunes tracks
+                    'preview_url': result.get('previewUrl'),
+                    'cover': result.get('artworkUrl100', '').replace('100x100bb.jpg', '400x400bb.jpg'),
+                    'category': result.get('primaryGenreName', 'Music'),
+                    'isOriginal': False,
+                    'isTrending': False,
+                    'uses': 0,  # Default for iTunes tracks
+                    'source': 'iTunes'
+                }
+                print(f"✅ Successfully fetched iTunes track: {music_info['title']} - {music_info['artist']}")
+                
+                # Cache the result
+                await itunes_cache.aset(itunes_track_id, music_info)
+                
+                return music_info
+            else:
+                print(f"❌ No results found for iTunes track ID: {itunes_track_id}")
+                # Negative cache so feeds don't hit iTunes again for this id
+                await itunes_cache.aset(
+                    itunes_track_id,
+                    NEGATIVE_RESULT,
+                    ttl=config.CACHE_CONFIG['ITUNES']['NEGATIVE_TTL_SECONDS']
+                )
+                return None
+        else:
+            print(f"❌ iTunes API error: {response.status_code}")
+            return None
+    except Exception as e:
+        print(f"❌ Error fetching iTunes track {music_id}: {str(e)}")
+        return None
+
 async def get_music_info(music_id: str):
     """
     Get music information by ID with automatic iTunes preview fetching
@@ -701,60 +1256,21 @@ async def get_music_info(music_id: str):
     
     # Check if this is an iTunes ID (format: itunes_XXXXX)
     if music_id.startswith('itunes_'):
-        try:
-            # Extract iTunes track ID
-            itunes_track_id = music_id.replace('itunes_', '')
-            
-            # Check cache first
-            if itunes_track_id in itunes_cache and is_cache_valid(itunes_cache[itunes_track_id]):
-                print(f"🎵 Using cached iTunes track info for ID: {itunes_track_id}")
-                return itunes_cache[itunes_track_id]['data']
-            
-            print(f"🎵 Fetching iTunes track info for ID: {itunes_track_id}")
-            
-            # Fetch track info directly from iTunes API using track ID
-            url = f"https://itunes.apple.com/lookup?id={itunes_track_id}"
-            
-            import httpx
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, timeout=10.0)
-                if response.status_code == 200:
-                    data = response.json()
-                    results = data.get('results', [])
-                    if results:
-                        result = results[0]
-                        music_info = {
-                            'id': music_id,
-                            'title': result.get('trackName'),
-                            'artist': result.get('artistName'),
-                            'duration': 30,  # iTunes previews are 30 seconds
-                            'url': '',  # No local URL for iTunes tracks
-                            'preview_url': result.get('previewUrl'),
-                            'cover': result.get('artworkUrl100', '').replace('100x100bb.jpg', '400x400bb.jpg'),
-                            'category': result.get('primaryGenreName', 'Music'),
-                            'isOriginal': False,
-                            'isTrending': False,
-                            'uses': 0,  # Default for iTunes tracks
-                            'source': 'iTunes'
-                        }
-                        print(f"✅ Successfully fetched iTunes track: {music_info['title']} - {music_info['artist']}")
-                        
-                        # Cache the result
-                        itunes_cache[itunes_track_id] = {
-                            'data': music_info,
-                            'cached_at': datetime.utcnow()
-                        }
-                        
-                        return music_info
-                    else:
-                        print(f"❌ No results found for iTunes track ID: {itunes_track_id}")
-                        return None
-                else:
-                    print(f"❌ iTunes API error: {response.status_code}")
-                    return None
-        except Exception as e:
-            print(f"❌ Error fetching iTunes track {music_id}: {str(e)}")
-            return None
+        # Extract iTunes track ID
+        itunes_track_id = music_id.replace('itunes_', '')
+        
+        # Check cache first (including ids known to have no results)
+        cached_music_info = await itunes_cache.aget(itunes_track_id)
+        if cached_music_info is not None:
+            if cached_music_info == NEGATIVE_RESULT:
+                return None
+            print(f"🎵 Using cached iTunes track info for ID: {itunes_track_id}")
+            return cached_music_info
+        
+        return await itunes_lookups.do(
+            itunes_track_id,
+            lambda: fetch_itunes_track(music_id, itunes_track_id)
+        )
     
     # Check if this is a user audio ID (format: user_audio_XXXXX)
     user_audio_id = None
@@ -1625,7 +2141,7 @@ async def register(user_data: UserCreate, request: Request):
         )
     
     # Create user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await hash_password(user_data.password)
     user = User(
         email=user_data.email,
         username=user_data.username,
@@ -1636,6 +2152,7 @@ async def register(user_data: UserCreate, request: Request):
     
     # Insert user
     await db.users.insert_one(user.dict())
+    await refresh_search_index("user", user.id)
     
     # Create user profile
     profile = UserProfile(
@@ -1653,7 +2170,7 @@ async def register(user_data: UserCreate, request: Request):
     await track_login_attempt(user_data.email, ip_address, user_agent, True)
     
     # Generate token
-    access_token = create_access_token(data={"sub": user.id})
+    access_token = create_access_token(data={"sub": user.id, "ver": user.token_version})
     
     # Create session
     session_token = await create_session(user.id, device.id, ip_address, user_agent)
@@ -1707,7 +2224,7 @@ async def login(login_data: UserLogin, request: Request):
         )
     
     # Verify password (skip for OAuth users)
-    if user_data.get("hashed_password") and not verify_password(login_data.password, user_data["hashed_password"]):
+    if user_data.get("hashed_password") and not await check_password(login_data.password, user_data["hashed_password"]):
         await track_login_attempt(
             login_data.email, ip_address, user_agent,
             False, "Invalid password"
@@ -1726,50 +2243,19 @@ async def login(login_data: UserLogin, request: Request):
             detail="This account uses social login. Please use Google sign-in."
         )
     
-    # Get or create device
-    device = await get_or_create_device(user_data["id"], ip_address, user_agent)
-    
-    # Check if this is a new device
-    if not device.is_trusted:
-        await create_security_notification(
-            user_data["id"],
-            "new_device",
-            "New Device Login",
-            f"Login detected from new device: {device.device_name} ({device.browser})",
-            {
-                "device_id": device.id,
-                "ip_address": ip_address,
-                "location": "Unknown"  # You could add IP geolocation here
-            }
-        )
-    
-    # Update last login
-    await db.users.update_one(
-        {"id": user_data["id"]},
-        {"$set": {"last_login": datetime.utcnow()}}
-    )
-    
-    # Track successful login
-    await track_login_attempt(login_data.email, ip_address, user_agent, True)
+    # Device, last login, session and notifications are written by the task queue;
+    # queueing them is the only write before the token is returned
+    await enqueue_task("login_side_effects", {
+        "user_id": user_data["id"],
+        "email": login_data.email,
+        "ip_address": ip_address,
+        "user_agent": user_agent,
+        "session_token": str(uuid.uuid4()),
+        "logged_in_at": datetime.utcnow()
+    })
     
     # Generate token
-    access_token = create_access_token(data={"sub": user_data["id"]})
-    
-    # Create session
-    session_token = await create_session(user_data["id"], device.id, ip_address, user_agent)
-    
-    # Create login notification
-    await create_security_notification(
-        user_data["id"],
-        "new_login",
-        "New Login",
-        f"Successful login from {device.device_name} ({device.browser})",
-        {
-            "device_id": device.id,
-            "ip_address": ip_address,
-            "session_token": session_token
-        }
-    )
+    access_token = create_access_token(data={"sub": user_data["id"], "ver": user_data.get("token_version", 0)})
     
     return Token(
         access_token=access_token,
@@ -1819,7 +2305,7 @@ async def oauth_google_callback(session_id: str, request: Request):
         await track_login_attempt(user.email, ip_address, user_agent, True)
         
         # Generate JWT token
-        access_token = create_access_token(data={"sub": user.id})
+        access_token = create_access_token(data={"sub": user.id, "ver": user.token_version})
         
         # Create session
         session_token = await create_session(user.id, device.id, ip_address, user_agent)
@@ -1987,6 +2473,11 @@ async def update_profile(
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await invalidate_principal(current_user.id)
+    
+    if "display_name" in update_fields or "avatar_url" in update_fields:
+        await refresh_search_index("user", current_user.id)
+        await refresh_user_card(current_user.id)
     
     # SYNC DATA: Also update user_profiles collection to maintain consistency
     # Update user_profiles with the same fields to keep both collections in sync
@@ -2035,20 +2526,22 @@ async def change_password(
         )
     
     # Verify current password
-    if not verify_password(password_data.current_password, user_data["hashed_password"]):
+    if not await check_password(password_data.current_password, user_data["hashed_password"]):
         raise HTTPException(status_code=400, detail="Current password is incorrect")
     
     # Hash new password
-    new_hashed_password = get_password_hash(password_data.new_password)
+    new_hashed_password = await hash_password(password_data.new_password)
     
-    # Update password in database
+    # Update password in database, revoking tokens issued before the change
+    token_version = user_data.get("token_version", 0) + 1
     result = await db.users.update_one(
         {"id": current_user.id},
-        {"$set": {"hashed_password": new_hashed_password}}
+        {"$set": {"hashed_password": new_hashed_password, "token_version": token_version}}
     )
     
     if result.modified_count == 0:
         raise HTTPException(status_code=500, detail="Failed to update password")
+    await invalidate_principal(current_user.id)
     
     # Get device info
     device = await get_or_create_device(current_user.id, ip_address, user_agent)
@@ -2071,7 +2564,13 @@ async def change_password(
         {"$set": {"is_active": False}}
     )
     
-    return {"message": "Password updated successfully. Please log in again on other devices."}
+    # Fresh token so this device stays signed in
+    return {
+        "message": "Password updated successfully. Please log in again on other devices.",
+        "access_token": create_access_token(data={"sub": current_user.id, "ver": token_version}),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    }
 
 @api_router.put("/auth/settings", response_model=UserResponse)
 async def update_settings(
@@ -2142,6 +2641,7 @@ async def update_settings(
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await invalidate_principal(current_user.id)
     
     # Return updated user
     updated_user = await db.users.find_one({"id": current_user.id})
@@ -2162,6 +2662,59 @@ async def get_my_profile(current_user: UserResponse = Depends(get_current_user))
     profile = UserProfile(**profile_data)
     return profile
 
+async def count_profile_counters(user_id: str) -> Dict[str, int]:
+    """Count a user's profile counters from the source collections (used when profile counters are disabled)"""
+    # Count followers and following
+    followers_count = await db.follows.count_documents({"following_id": user_id})
+    following_count = await db.follows.count_documents({"follower_id": user_id})
+    
+    # Count total votes and polls
+    total_polls = await db.polls.count_documents({"author_id": user_id, "is_active": True})
+    
+    # Calculate actual vote statistics using aggregation for accuracy
+    # Use MongoDB aggregation to count real votes received on user's polls
+    pipeline = [
+        {"$match": {"author_id": user_id, "is_active": True}},
+        {"$unwind": "$options"},
+        {"$group": {
+            "_id": None,
+            "total_votes_received": {"$sum": "$options.votes"}
+        }}
+    ]
+    
+    result = await db.polls.aggregate(pipeline).to_list(length=1)
+    total_votes_received = result[0]["total_votes_received"] if result else 0
+    
+    logger.info(f"📊 Calculated real votes for user {user_id}: {total_votes_received}")
+    
+    # Count votes made by this user
+    votes_made_by_user = await db.votes.count_documents({"user_id": user_id})
+    
+    # Count likes received on user's polls using aggregation
+    likes_pipeline = [
+        {"$match": {"author_id": user_id, "is_active": True}},
+        {"$group": {
+            "_id": None,
+            "total_likes": {"$sum": "$likes"}
+        }}
+    ]
+    
+    likes_result = await db.polls.aggregate(likes_pipeline).to_list(length=1)
+    likes_received = likes_result[0]["total_likes"] if likes_result else 0
+    
+    # Count likes given by this user
+    likes_given_by_user = await db.poll_likes.count_documents({"user_id": user_id})
+    
+    return {
+        "followers_count": followers_count,
+        "following_count": following_count,
+        "total_polls_created": total_polls,
+        "total_votes": total_votes_received,  # Total votes received on user's polls
+        "likes_count": likes_received,  # Total likes received on user's polls
+        "votes_count": votes_made_by_user,  # Total votes made by this user
+        "likes_given": likes_given_by_user  # Total likes given by this user
+    }
+
 # Helper function to ensure user profile exists and is up to date
 async def ensure_user_profile(user_id: str):
     """Ensure user profile exists and is synchronized with user data"""
@@ -2174,46 +2727,16 @@ async def ensure_user_profile(user_id: str):
         # Check if profile exists
         profile_data = await db.user_profiles.find_one({"id": user_id})
         
-        # Count followers and following
-        followers_count = await db.follows.count_documents({"following_id": user_id})
-        following_count = await db.follows.count_documents({"follower_id": user_id})
-        
-        # Count total votes and polls
-        total_polls = await db.polls.count_documents({"author_id": user_id, "is_active": True})
-        
-        # Calculate actual vote statistics using aggregation for accuracy
-        # Use MongoDB aggregation to count real votes received on user's polls
-        pipeline = [
-            {"$match": {"author_id": user_id, "is_active": True}},
-            {"$unwind": "$options"},
-            {"$group": {
-                "_id": None,
-                "total_votes_received": {"$sum": "$options.votes"}
-            }}
-        ]
-        
-        result = await db.polls.aggregate(pipeline).to_list(length=1)
-        total_votes_received = result[0]["total_votes_received"] if result else 0
-        
-        logger.info(f"📊 Calculated real votes for user {user_id}: {total_votes_received}")
-        
-        # Count votes made by this user
-        votes_made_by_user = await db.votes.count_documents({"user_id": user_id})
-        
-        # Count likes received on user's polls using aggregation
-        likes_pipeline = [
-            {"$match": {"author_id": user_id, "is_active": True}},
-            {"$group": {
-                "_id": None,
-                "total_likes": {"$sum": "$likes"}
-            }}
-        ]
-        
-        likes_result = await db.polls.aggregate(likes_pipeline).to_list(length=1)
-        likes_received = likes_result[0]["total_likes"] if likes_result else 0
-        
-        # Count likes given by this user
-        likes_given_by_user = await db.poll_likes.count_documents({"user_id": user_id})
+        from profile_counters import profile_counters, PROFILE_COUNTER_FIELDS
+        if profile_counters and profile_data:
+            # Counters are kept current by $inc deltas (and repaired by the
+            # reconciliation job); recomputing them on every read would drop
+            # counter shard totals and overwrite in-flight deltas
+            counters = None
+        elif profile_counters:
+            counters = (await profile_counters.compute_counters([user_id]))[user_id]
+        else:
+            counters = await count_profile_counters(user_id)
         
         # Prepare profile data
         profile_update = {
@@ -2224,13 +2747,7 @@ async def ensure_user_profile(user_id: str):
             "bio": user_data.get("bio"),
             "occupation": user_data.get("occupation"),  # ✅ ADDED: Include occupation field
             "is_verified": user_data.get("is_verified", False),
-            "followers_count": followers_count,
-            "following_count": following_count,
-            "total_polls_created": total_polls,
-            "total_votes": total_votes_received,  # Total votes received on user's polls
-            "likes_count": likes_received,  # Total likes received on user's polls
-            "votes_count": votes_made_by_user,  # Total votes made by this user
-            "likes_given": likes_given_by_user,  # Total likes given by this user
+            **(counters or {}),
             "last_activity": datetime.utcnow(),
             "created_at": profile_data.get("created_at", datetime.utcnow()) if profile_data else datetime.utcnow()
         }
@@ -2242,12 +2759,22 @@ async def ensure_user_profile(user_id: str):
             upsert=True
         )
         
+        if counters is None:
+            profile_update.update({field: profile_data.get(field, 0) for field in PROFILE_COUNTER_FIELDS})
         return profile_update
         
     except Exception as e:
         print(f"❌ Error ensuring user profile for {user_id}: {e}")
         return None
 
+async def increment_profile_counters(user_id: str, **deltas: int):
+    """Apply counter deltas to a user's profile, building it from scratch only if it doesn't exist yet"""
+    if not user_id:
+        return
+    from profile_counters import profile_counters
+    if profile_counters is None or not await profile_counters.increment(user_id, **deltas):
+        await ensure_user_profile(user_id)
+
 @api_router.get("/user/profile/{user_id}")
 async def get_user_profile(user_id: str):
     """Get user profile by ID (public endpoint)"""
@@ -2296,6 +2823,15 @@ async def search_users(q: str = "", current_user: UserResponse = Depends(get_cur
     if not q.strip():
         return []
     
+    from search_index import search_index
+    if search_index and search_index.ready:
+        hits = search_index.search("user", q, 10, exclude=[current_user.id])
+        user_ids = [user_id for user_id, _ in hits]
+        users = await db.users.find({"id": {"$in": user_ids}}).to_list(len(user_ids))
+        order = {user_id: position for position, user_id in enumerate(user_ids)}
+        users.sort(key=lambda user: order[user["id"]])
+        return [UserResponse(**user) for user in users]
+    
     # Search by username or display_name (case-insensitive)
     search_regex = {"$regex": q, "$options": "i"}
     users = await db.users.find({
@@ -2314,14 +2850,14 @@ async def search_users(q: str = "", current_user: UserResponse = Depends(get_cur
 
 # =============  UNIVERSAL SEARCH ENDPOINTS =============
 
-from difflib import SequenceMatcher
 import re
+from search_ranking import rank_results, trigram_similarity
 
 def calculate_similarity(a, b):
     """Calculate similarity between two strings for fuzzy search"""
     if not a or not b:
         return 0.0
-    return SequenceMatcher(None, str(a).lower(), str(b).lower()).ratio()
+    return trigram_similarity(str(a), str(b))
 
 def extract_hashtags_from_text(text):
     """Extract hashtags from text content"""
@@ -2378,50 +2914,15 @@ async def universal_search(
     if len(query) > config.SEARCH_CONFIG['MAX_QUERY_LENGTH']:
         return {"success": False, "error": "Query too long"}
         
-    query_lower = query.lower()
-    results = []
-    
     try:
-        # OPTIMIZATION: Run searches concurrently for better performance
-        import asyncio
-        
-        tasks = []
-        
-        # Search Users
-        if filter_type in [config.SEARCH_CONFIG['DEFAULT_FILTER'], config.SEARCH_CONFIG['AVAILABLE_FILTERS'][1]]:
-            tasks.append(search_users_optimized(query_lower, current_user.id, limit))
-        
-        # Search Posts  
-        if filter_type in [config.SEARCH_CONFIG['DEFAULT_FILTER'], config.SEARCH_CONFIG['AVAILABLE_FILTERS'][2]]:
-            tasks.append(search_posts_optimized(query_lower, current_user.id, limit))
+        # Ranked hits are shared by every user; the page is hydrated per request
+        cache_key = search_cache_key("universal", query, filter_type, sort_by, limit)
+        results = await get_cached_search(cache_key)
+        if results is None:
+            results = await rank_universal_search(query, filter_type, sort_by, limit)
+            await cache_search(cache_key, results)
         
-        # Search Hashtags
-        if filter_type in [config.SEARCH_CONFIG['DEFAULT_FILTER'], config.SEARCH_CONFIG['AVAILABLE_FILTERS'][3]]:
-            tasks.append(search_hashtags_optimized(query_lower, current_user.id, limit))
-        
-        # Search Sounds/Music
-        if filter_type in [config.SEARCH_CONFIG['DEFAULT_FILTER'], config.SEARCH_CONFIG['AVAILABLE_FILTERS'][4]]:
-            tasks.append(search_sounds_optimized(query, current_user.id, limit))
-        
-        # Execute all searches concurrently
-        if tasks:
-            search_results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Combine results from all successful searches
-            for result in search_results:
-                if isinstance(result, list):  # Only process successful results
-                    results.extend(result)
-        
-        # Sort results
-        if sort_by == "popularity":
-            results.sort(key=lambda x: x.get("popularity_score", 0), reverse=True)
-        elif sort_by == "recent":
-            results.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-        else:  # relevance
-            results.sort(key=lambda x: x.get("relevance_score", 0), reverse=True)
-        
-        # Limit final results
-        results = results[:limit]
+        results = await hydrate_search_results(results, current_user.id, limit)
         
         return {
             "success": True,
@@ -2436,157 +2937,255 @@ async def universal_search(
         logger.error(f"Error in universal search: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Search error: {str(e)}")
 
+async def rank_universal_search(query: str, filter_type: str, sort_by: str, limit: int) -> List[Dict]:
+    """
+    Phase one of universal search: ranked lightweight hits across every
+    content type, independent of the requesting user. One extra hit is kept
+    so the requester can be dropped from the list when serving it.
+    """
+    query_lower = query.lower()
+    results = []
+    
+    # OPTIMIZATION: Run searches concurrently for better performance
+    tasks = []
+    
+    # Search Users
+    if filter_type in [config.SEARCH_CONFIG['DEFAULT_FILTER'], config.SEARCH_CONFIG['AVAILABLE_FILTERS'][1]]:
+        tasks.append(search_users_optimized(query_lower, None, limit + 1))
+    
+    # Search Posts  
+    if filter_type in [config.SEARCH_CONFIG['DEFAULT_FILTER'], config.SEARCH_CONFIG['AVAILABLE_FILTERS'][2]]:
+        tasks.append(search_posts_optimized(query_lower, None, limit))
+    
+    # Search Hashtags
+    if filter_type in [config.SEARCH_CONFIG['DEFAULT_FILTER'], config.SEARCH_CONFIG['AVAILABLE_FILTERS'][3]]:
+        tasks.append(search_hashtags_optimized(query_lower, None, limit))
+    
+    # Search Sounds/Music
+    if filter_type in [config.SEARCH_CONFIG['DEFAULT_FILTER'], config.SEARCH_CONFIG['AVAILABLE_FILTERS'][4]]:
+        tasks.append(search_sounds_optimized(query, None, limit))
+    
+    # Execute all searches concurrently
+    if tasks:
+        search_results = await asyncio.gather(*tasks, return_exceptions=True)
+        
+        # Combine results from all successful searches
+        for result in search_results:
+            if isinstance(result, list):  # Only process successful results
+                results.extend(result)
+    
+    # Sort results
+    if sort_by == "popularity":
+        results.sort(key=lambda x: x.get("popularity_score", 0), reverse=True)
+    elif sort_by == "recent":
+        results.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+    else:  # relevance
+        results = rank_results(query, results)
+    
+    return results[:limit + 1]
+
+async def hydrate_search_results(hits: List[Dict], current_user_id: str, limit: int) -> List[Dict]:
+    """
+    Phase two of search: turn the top `limit` ranked hits into the records the
+    search UI renders. The requester is dropped from user hits, and the whole
+    page is filled in with one polls, users, uploaded_files and follows query.
+    """
+    hits = [
+        hit for hit in hits
+        if not (hit.get("type") == "user" and hit.get("id") == current_user_id)
+    ][:limit]
+    
+    post_ids = list({hit["id"] for hit in hits if hit.get("type") == "post"})
+    posts = {}
+    if post_ids:
+        docs = await db.polls.find({"id": {"$in": post_ids}}, SEARCH_POST_PROJECTION).to_list(len(post_ids))
+        posts = {post["id"]: post for post in docs}
+    
+    result_user_ids = [hit["id"] for hit in hits if hit.get("type") == "user"]
+    user_ids = set(result_user_ids) | {post.get("author_id") for post in posts.values() if post.get("author_id")}
+    video_urls = {
+        option["media_url"]
+        for post in posts.values()
+        for option in post.get("options") or []
+        if option.get("media_type") == "video" and option.get("media_url") and not option.get("thumbnail_url")
+    }
+    
+    async def load_users():
+        if not user_ids:
+            return []
+        return await db.users.find(
+            {"id": {"$in": list(user_ids)}},
+            {"_id": 0, "id": 1, "username": 1, "display_name": 1, "avatar_url": 1}
+        ).to_list(len(user_ids))
+    
+    async def load_following():
+        if not result_user_ids:
+            return []
+        return await db.follows.find(
+            {"follower_id": current_user_id, "following_id": {"$in": result_user_ids}},
+            {"_id": 0, "following_id": 1}
+        ).to_list(len(result_user_ids))
+    
+    users, thumbnails, follows = await asyncio.gather(
+        load_users(),
+        get_thumbnails_for_media_urls(list(video_urls)),
+        load_following()
+    )
+    users = {user["id"]: user for user in users}
+    following = {follow["following_id"] for follow in follows}
+    
+    results = []
+    for hit in hits:
+        if hit.get("type") == "post":
+            post = posts.get(hit["id"])
+            if post:  # Deleted since the hits were ranked
+                results.append(build_post_search_result(hit, post, users.get(post.get("author_id"), {}), thumbnails))
+        elif hit.get("type") == "user":
+            user = users.get(hit["id"])
+            if user:
+                results.append({
+                    **hit,
+                    "user_id": hit["id"],  # Add user_id for follow functionality
+                    "username": user.get("username", hit.get("username", "")),
+                    "display_name": user.get("display_name", hit.get("display_name", "")),
+                    "avatar_url": user.get("avatar_url", ""),
+                    "is_following": hit["id"] in following
+                })
+        else:
+            results.append(dict(hit))
+    
+    return results
+
 # =============  OPTIMIZED SEARCH FUNCTIONS =============
 
+# Fields needed to rank a post (phase one) and to render it (phase two)
+SEARCH_HIT_PROJECTION = {
+    "_id": 0, "id": 1, "title": 1, "content": 1, "tags": 1, "hashtags": 1,
+    "created_at": 1, "votes_count": 1, "comments_count": 1
+}
+SEARCH_POST_PROJECTION = {
+    "_id": 0, "id": 1, "options": 1, "layout": 1, "images": 1, "image_url": 1,
+    "thumbnail_url": 1, "video_url": 1, "author_id": 1, "votes_count": 1, "comments_count": 1
+}
+
+def post_search_hit(post: Dict, relevance_score: float) -> Dict:
+    """Lightweight ranked post record (hydrated by hydrate_search_results)"""
+    return {
+        "type": "post",
+        "id": post["id"],
+        "title": post.get("title", ""),
+        "content": post.get("content", ""),
+        "tags": post.get("tags", []),
+        "hashtags": post.get("hashtags", []),
+        "created_at": post.get("created_at", ""),
+        "relevance_score": relevance_score,
+        "popularity_score": (post.get("votes_count") or 0) + (post.get("comments_count") or 0)
+    }
+
+def build_post_search_result(hit: Dict, post: Dict, author: Dict, thumbnails: Dict[str, Optional[str]]) -> Dict:
+    """Search UI record for a post hit, with video thumbnails from a batch lookup"""
+    # Get first image for thumbnail from poll options
+    image_url = None
+    media_url = None
+    thumbnail_url = None
+    
+    # Extract images from poll options (where they actually are stored)
+    for option in post.get("options") or []:
+        if option.get("media_url"):
+            media_url = option["media_url"]
+            # Check if it's a video and get thumbnail
+            if option.get("media_type") == "video":
+                option_thumbnail = option.get("thumbnail_url") or thumbnails.get(media_url)
+                if option_thumbnail:
+                    thumbnail_url = option_thumbnail
+                    image_url = option_thumbnail  # Use thumbnail for display
+                else:
+                    # Fallback to media_url if thumbnail not available
+                    image_url = media_url
+            else:
+                # For images, use media_url directly
+                image_url = media_url
+            break
+        elif option.get("thumbnail_url"):
+            thumbnail_url = option["thumbnail_url"]
+            if not image_url:  # Use thumbnail as fallback if no media_url found
+                image_url = thumbnail_url
+    
+    # Fallback to legacy fields if they exist
+    if not image_url:
+        if post.get("images") and len(post["images"]) > 0:
+            image_url = post["images"][0].get("url")
+        elif post.get("image_url"):
+            image_url = post["image_url"]
+        elif post.get("thumbnail_url"):
+            image_url = post["thumbnail_url"]
+    
+    # Build images array for frontend compatibility and process options with thumbnails
+    images_array = []
+    processed_options = []
+    for option in post.get("options") or []:
+        option_copy = option.copy()
+        if option.get("media_url"):
+            images_array.append({"url": option["media_url"]})
+            # If it's a video, ensure thumbnail_url is set
+            if option.get("media_type") == "video" and not option_copy.get("thumbnail_url"):
+                video_thumbnail = thumbnails.get(option["media_url"])
+                if video_thumbnail:
+                    option_copy["thumbnail_url"] = video_thumbnail
+        processed_options.append(option_copy)
+    
+    return {
+        **hit,
+        "image_url": image_url,
+        "thumbnail_url": thumbnail_url or image_url,  # Use specific thumbnail if available
+        "media_url": media_url or image_url,  # Add media_url field for frontend compatibility
+        "images": images_array,  # Add images array for frontend compatibility (result.images?.[0]?.url)
+        "layout": post.get("layout", "vertical"),  # Include layout for frontend grid rendering
+        "options": processed_options,  # Include all options with thumbnails for complete poll rendering
+        "video_url": post.get("video_url"),
+        "author_id": post.get("author_id"),  # Add author_id for follow functionality
+        "author": {
+            "id": author.get("id", ""),
+            "username": author.get("username", ""),
+            "display_name": author.get("display_name", ""),
+            "avatar_url": author.get("avatar_url", "")
+        },
+        "votes_count": post.get("votes_count") or 0,
+        "comments_count": post.get("comments_count") or 0
+    }
+
 async def search_posts_optimized(query: str, current_user_id: str, limit: int):
-    """Optimized post search with minimal database operations"""
+    """Phase one of post search: ranked hits with only the fields needed to rank them"""
     try:
-        # Use aggregation pipeline for better performance
-        pipeline = [
-            {
-                "$match": {
-                    "$or": [
-                        {"title": {"$regex": query, "$options": "i"}},
-                        {"content": {"$regex": query, "$options": "i"}}
-                    ]
-                }
-            },
-            {
-                "$limit": limit * 2  # Get more to ensure we have enough after processing
-            },
-            {
-                "$lookup": {
-                    "from": "users",
-                    "localField": "author_id", 
-                    "foreignField": "id",
-                    "as": "author_info"
-                }
-            },
-            {
-                "$addFields": {
-                    "author": {"$arrayElemAt": ["$author_info", 0]}
-                }
-            },
-            {
-                "$project": {
-                    "id": 1,
-                    "title": 1,
-                    "content": 1,
-                    "options": 1,  # Include options to extract media_url and thumbnail_url
-                    "layout": 1,   # Include layout for frontend grid rendering
-                    "images": 1,
-                    "image_url": 1,
-                    "thumbnail_url": 1,
-                    "video_url": 1,
-                    "author_id": 1,  # Include author_id for follow functionality
-                    "created_at": 1,
-                    "votes_count": {"$ifNull": ["$votes_count", 0]},
-                    "comments_count": {"$ifNull": ["$comments_count", 0]},
-                    "saves_count": {"$ifNull": ["$saves_count", 0]},
-                    "author.id": 1,  # Include author id
-                    "author.username": 1,
-                    "author.display_name": 1,
-                    "author.avatar_url": 1,
-                    "hashtags": 1
-                }
+        # Ranked candidates from the inverted index (regex scan until the index is ready)
+        from search_index import search_index
+        hit_scores = None
+        if search_index and search_index.ready:
+            hit_scores = dict(search_index.search("post", query, limit))
+            match_stage = {"id": {"$in": list(hit_scores)}}
+        else:
+            match_stage = {
+                "$or": [
+                    {"title": {"$regex": query, "$options": "i"}},
+                    {"content": {"$regex": query, "$options": "i"}}
+                ]
             }
-        ]
         
-        posts = await db.polls.aggregate(pipeline).to_list(limit * 2)
+        posts = await db.polls.find(match_stage, SEARCH_HIT_PROJECTION).limit(limit * 2).to_list(limit * 2)
+        if hit_scores is not None:
+            posts.sort(key=lambda post: hit_scores[post["id"]], reverse=True)
         
         results = []
         for post in posts[:limit]:  # Limit results after processing
-            # Calculate simple relevance score
-            title_score = 2 if query in post.get("title", "").lower() else 0
-            content_score = 1 if query in post.get("content", "").lower() else 0
-            relevance_score = title_score + content_score
-            
-            # Get first image for thumbnail from poll options
-            image_url = None
-            media_url = None
-            thumbnail_url = None
-            
-            # Extract images from poll options (where they actually are stored)
-            if post.get("options") and len(post["options"]) > 0:
-                for option in post["options"]:
-                    if option.get("media_url"):
-                        media_url = option["media_url"]
-                        # Check if it's a video and get thumbnail
-                        if option.get("media_type") == "video":
-                            # Try to get existing thumbnail_url
-                            option_thumbnail = option.get("thumbnail_url")
-                            if not option_thumbnail:
-                                # Generate thumbnail URL for video
-                                option_thumbnail = await get_thumbnail_for_media_url(media_url)
-                            if option_thumbnail:
-                                thumbnail_url = option_thumbnail
-                                image_url = option_thumbnail  # Use thumbnail for display
-                            else:
-                                # Fallback to media_url if thumbnail not available
-                                image_url = media_url
-                        else:
-                            # For images, use media_url directly
-                            image_url = media_url
-                        break
-                    elif option.get("thumbnail_url"):
-                        thumbnail_url = option["thumbnail_url"]
-                        if not image_url:  # Use thumbnail as fallback if no media_url found
-                            image_url = thumbnail_url
-            
-            # Fallback to legacy fields if they exist
-            if not image_url:
-                if post.get("images") and len(post["images"]) > 0:
-                    image_url = post["images"][0].get("url")
-                elif post.get("image_url"):
-                    image_url = post["image_url"]
-                elif post.get("thumbnail_url"):
-                    image_url = post["thumbnail_url"]
-                
-            # Build images array for frontend compatibility and process options with thumbnails
-            images_array = []
-            processed_options = []
-            if post.get("options"):
-                for option in post["options"]:
-                    option_copy = option.copy()
-                    
-                    if option.get("media_url"):
-                        images_array.append({"url": option["media_url"]})
-                        
-                        # If it's a video, ensure thumbnail_url is set
-                        if option.get("media_type") == "video":
-                            if not option_copy.get("thumbnail_url"):
-                                video_thumbnail = await get_thumbnail_for_media_url(option["media_url"])
-                                if video_thumbnail:
-                                    option_copy["thumbnail_url"] = video_thumbnail
-                    
-                    processed_options.append(option_copy)
+            if hit_scores is not None:
+                relevance_score = hit_scores[post["id"]]
+            else:
+                # Calculate simple relevance score
+                title_score = 2 if query in post.get("title", "").lower() else 0
+                content_score = 1 if query in post.get("content", "").lower() else 0
+                relevance_score = title_score + content_score
             
-            results.append({
-                "type": "post",
-                "id": post["id"],
-                "title": post.get("title", ""),
-                "content": post.get("content", ""),
-                "image_url": image_url,
-                "thumbnail_url": thumbnail_url or image_url,  # Use specific thumbnail if available
-                "media_url": media_url or image_url,  # Add media_url field for frontend compatibility
-                "images": images_array,  # Add images array for frontend compatibility (result.images?.[0]?.url)
-                "layout": post.get("layout", "vertical"),  # Include layout for frontend grid rendering
-                "options": processed_options,  # Include all options with thumbnails for complete poll rendering
-                "video_url": post.get("video_url"),
-                "author_id": post.get("author_id"),  # Add author_id for follow functionality
-                "author": {
-                    "id": post.get("author", {}).get("id", ""),  # Add author id
-                    "username": post.get("author", {}).get("username", ""),
-                    "display_name": post.get("author", {}).get("display_name", ""),  # Include display_name
-                    "avatar_url": post.get("author", {}).get("avatar_url", "")  # Changed 'avatar' to 'avatar_url' for consistency
-                },
-                "created_at": post.get("created_at", ""),
-                "votes_count": post.get("votes_count", 0),
-                "comments_count": post.get("comments_count", 0),
-                "hashtags": post.get("hashtags", []),
-                "relevance_score": relevance_score,
-                "popularity_score": post.get("votes_count", 0) + post.get("comments_count", 0)
-            })
+            results.append(post_search_hit(post, relevance_score))
         
         return results
         
@@ -2595,22 +3194,31 @@ async def search_posts_optimized(query: str, current_user_id: str, limit: int):
         return []
 
 async def search_users_optimized(query: str, current_user_id: str, limit: int):
-    """Optimized user search with minimal database operations"""
+    """Phase one of user search: ranked hits without avatar or follow state"""
     try:
+        # Ranked candidates from the inverted index (regex scan until the index is ready)
+        from search_index import search_index
+        hit_scores = None
+        if search_index and search_index.ready:
+            hit_scores = dict(search_index.search("user", query, limit, exclude=[current_user_id]))
+            match_stage = {"id": {"$in": list(hit_scores)}}
+        else:
+            match_stage = {
+                "$and": [
+                    {"id": {"$ne": current_user_id}},
+                    {
+                        "$or": [
+                            {"username": {"$regex": query, "$options": "i"}},
+                            {"display_name": {"$regex": query, "$options": "i"}}
+                        ]
+                    }
+                ]
+            }
+        
         # Use aggregation pipeline for better performance
         pipeline = [
             {
-                "$match": {
-                    "$and": [
-                        {"id": {"$ne": current_user_id}},
-                        {
-                            "$or": [
-                                {"username": {"$regex": query, "$options": "i"}},
-                                {"display_name": {"$regex": query, "$options": "i"}}
-                            ]
-                        }
-                    ]
-                }
+                "$match": match_stage
             },
             {
                 "$limit": limit
@@ -2633,7 +3241,6 @@ async def search_users_optimized(query: str, current_user_id: str, limit: int):
                     "id": 1,
                     "username": 1,
                     "display_name": 1,
-                    "avatar_url": 1,
                     "bio": 1,
                     "followers_count": {"$ifNull": ["$profile.followers_count", 0]}
                 }
@@ -2641,22 +3248,25 @@ async def search_users_optimized(query: str, current_user_id: str, limit: int):
         ]
         
         users = await db.users.aggregate(pipeline).to_list(limit)
+        if hit_scores is not None:
+            users.sort(key=lambda user: hit_scores[user["id"]], reverse=True)
         
         results = []
         for user in users:
-            # Calculate simple relevance score
-            username_score = 2 if query in user.get("username", "").lower() else 0
-            display_name_score = 1.5 if query in user.get("display_name", "").lower() else 0
-            relevance_score = username_score + display_name_score
+            if hit_scores is not None:
+                relevance_score = hit_scores[user["id"]]
+            else:
+                # Calculate simple relevance score
+                username_score = 2 if query in user.get("username", "").lower() else 0
+                display_name_score = 1.5 if query in user.get("display_name", "").lower() else 0
+                relevance_score = username_score + display_name_score
             
             results.append({
                 "type": "user",
                 "id": user["id"],
-                "user_id": user["id"],  # Add user_id for follow functionality
                 "username": user.get("username", ""),
                 "display_name": user.get("display_name", ""),
                 "bio": user.get("bio", ""),
-                "avatar_url": user.get("avatar_url", ""),  # Changed 'avatar' to 'avatar_url' for consistency
                 "followers_count": user.get("followers_count", 0),
                 "relevance_score": relevance_score,
                 "popularity_score": user.get("followers_count", 0)
@@ -2669,69 +3279,33 @@ async def search_users_optimized(query: str, current_user_id: str, limit: int):
         return []
 
 async def search_hashtags_optimized(query: str, current_user_id: str, limit: int):
-    """Optimized hashtag search - returns individual posts containing the hashtag"""
+    """Phase one of hashtag search: ranked hits for the posts containing the hashtag"""
     try:
         # Search for hashtags in post tags, title, and content
         hashtag_query = query if query.startswith("#") else f"#{query}"
         query_without_hash = query.replace("#", "").strip()
         
-        # Use aggregation pipeline similar to search_posts_optimized
-        pipeline = [
-            {
-                "$match": {
-                    "$or": [
-                        # Search in tags array (exact or partial match)
-                        {"tags": {"$regex": query_without_hash, "$options": "i"}},
-                        # Search in title for hashtags
-                        {"title": {"$regex": hashtag_query, "$options": "i"}},
-                        # Search in content field if exists
-                        {"content": {"$regex": hashtag_query, "$options": "i"}}
-                    ]
-                }
-            },
-            {
-                "$limit": limit * 2  # Get more to ensure we have enough after processing
-            },
-            {
-                "$lookup": {
-                    "from": "users",
-                    "localField": "author_id", 
-                    "foreignField": "id",
-                    "as": "author_info"
-                }
-            },
-            {
-                "$addFields": {
-                    "author": {"$arrayElemAt": ["$author_info", 0]}
-                }
-            },
-            {
-                "$project": {
-                    "id": 1,
-                    "title": 1,
-                    "content": 1,
-                    "options": 1,
-                    "layout": 1,
-                    "images": 1,
-                    "image_url": 1,
-                    "thumbnail_url": 1,
-                    "video_url": 1,
-                    "author_id": 1,
-                    "created_at": 1,
-                    "votes_count": {"$ifNull": ["$votes_count", 0]},
-                    "comments_count": {"$ifNull": ["$comments_count", 0]},
-                    "saves_count": {"$ifNull": ["$saves_count", 0]},
-                    "author.id": 1,
-                    "author.username": 1,
-                    "author.display_name": 1,
-                    "author.avatar_url": 1,
-                    "hashtags": 1,
-                    "tags": 1
-                }
+        # Ranked candidates from the inverted index (regex scan until the index is ready)
+        from search_index import search_index
+        hit_scores = None
+        if search_index and search_index.ready:
+            hit_scores = dict(search_index.search_hashtag(query, limit))
+            match_stage = {"id": {"$in": list(hit_scores)}}
+        else:
+            match_stage = {
+                "$or": [
+                    # Search in tags array (exact or partial match)
+                    {"tags": {"$regex": query_without_hash, "$options": "i"}},
+                    # Search in title for hashtags
+                    {"title": {"$regex": hashtag_query, "$options": "i"}},
+                    # Search in content field if exists
+                    {"content": {"$regex": hashtag_query, "$options": "i"}}
+                ]
             }
-        ]
         
-        posts = await db.polls.aggregate(pipeline).to_list(limit * 2)
+        posts = await db.polls.find(match_stage, SEARCH_HIT_PROJECTION).limit(limit * 2).to_list(limit * 2)
+        if hit_scores is not None:
+            posts.sort(key=lambda post: hit_scores[post["id"]], reverse=True)
         
         results = []
         for post in posts[:limit]:  # Limit results after processing
@@ -2743,88 +3317,10 @@ async def search_hashtags_optimized(query: str, current_user_id: str, limit: int
                 relevance_score += 2
             if hashtag_query.lower() in post.get("content", "").lower():
                 relevance_score += 1
+            if hit_scores is not None:
+                relevance_score = max(relevance_score, hit_scores[post["id"]])
             
-            # Get first image for thumbnail from poll options
-            image_url = None
-            media_url = None
-            thumbnail_url = None
-            
-            # Extract images from poll options
-            if post.get("options") and len(post["options"]) > 0:
-                for option in post["options"]:
-                    if option.get("media_url"):
-                        media_url = option["media_url"]
-                        if option.get("media_type") == "video":
-                            option_thumbnail = option.get("thumbnail_url")
-                            if not option_thumbnail:
-                                option_thumbnail = await get_thumbnail_for_media_url(media_url)
-                            if option_thumbnail:
-                                thumbnail_url = option_thumbnail
-                                image_url = option_thumbnail
-                            else:
-                                image_url = media_url
-                        else:
-                            image_url = media_url
-                        break
-                    elif option.get("thumbnail_url"):
-                        thumbnail_url = option["thumbnail_url"]
-                        if not image_url:
-                            image_url = thumbnail_url
-            
-            # Fallback to legacy fields
-            if not image_url:
-                if post.get("images") and len(post["images"]) > 0:
-                    image_url = post["images"][0].get("url")
-                elif post.get("image_url"):
-                    image_url = post["image_url"]
-                elif post.get("thumbnail_url"):
-                    image_url = post["thumbnail_url"]
-                
-            # Build images array for frontend compatibility
-            images_array = []
-            processed_options = []
-            if post.get("options"):
-                for option in post["options"]:
-                    option_copy = option.copy()
-                    
-                    if option.get("media_url"):
-                        images_array.append({"url": option["media_url"]})
-                        
-                        if option.get("media_type") == "video":
-                            if not option_copy.get("thumbnail_url"):
-                                video_thumbnail = await get_thumbnail_for_media_url(option["media_url"])
-                                if video_thumbnail:
-                                    option_copy["thumbnail_url"] = video_thumbnail
-                    
-                    processed_options.append(option_copy)
-            
-            results.append({
-                "type": "post",
-                "id": post["id"],
-                "title": post.get("title", ""),
-                "content": post.get("content", ""),
-                "image_url": image_url,
-                "thumbnail_url": thumbnail_url or image_url,
-                "media_url": media_url or image_url,
-                "images": images_array,
-                "layout": post.get("layout", "vertical"),
-                "options": processed_options,
-                "video_url": post.get("video_url"),
-                "author_id": post.get("author_id"),
-                "author": {
-                    "id": post.get("author", {}).get("id", ""),
-                    "username": post.get("author", {}).get("username", ""),
-                    "display_name": post.get("author", {}).get("display_name", ""),
-                    "avatar_url": post.get("author", {}).get("avatar_url", "")
-                },
-                "created_at": post.get("created_at", ""),
-                "votes_count": post.get("votes_count", 0),
-                "comments_count": post.get("comments_count", 0),
-                "hashtags": post.get("hashtags", []),
-                "tags": post.get("tags", []),
-                "relevance_score": relevance_score,
-                "popularity_score": post.get("votes_count", 0) + post.get("comments_count", 0)
-            })
+            results.append(post_search_hit(post, relevance_score))
         
         return results
         
@@ -3241,24 +3737,10 @@ async def get_search_suggestions_helper(current_user_id: str = None):
     }
     
     try:
-        # Get popular hashtags from recent posts
-        pipeline = [
-            {"$match": {"created_at": {"$gte": (datetime.utcnow() - timedelta(days=7)).isoformat()}}},
-            {"$project": {"content": 1}},
-            {"$limit": 1000}
-        ]
-        
-        recent_posts = await db.polls.aggregate(pipeline).to_list(1000)
-        hashtag_counts = {}
-        
-        for post in recent_posts:
-            hashtags = extract_hashtags_from_text(post.get("content", ""))
-            for hashtag in hashtags:
-                hashtag_counts[hashtag] = hashtag_counts.get(hashtag, 0) + 1
-        
-        # Get top trending hashtags
-        trending = sorted(hashtag_counts.items(), key=lambda x: x[1], reverse=True)[:10]
-        suggestions["trending_hashtags"] = [{"hashtag": h[0], "count": h[1]} for h in trending]
+        # Get top trending hashtags (posts created in the trending window)
+        from hashtag_stats import hashtag_stats
+        if hashtag_stats:
+            suggestions["trending_hashtags"] = await hashtag_stats.get_trending(10)
         
         # Get suggested users (users with high follower count)
         pipeline = [
@@ -3292,31 +3774,31 @@ async def get_search_suggestions_endpoint(current_user: UserResponse = Depends(g
 async def get_trending_content(current_user_id: str):
     """Get trending content for discovery section"""
     try:
-        # Get trending posts (high engagement in last 24 hours)
-        recent_time = (datetime.utcnow() - timedelta(hours=24)).isoformat()
-        
-        pipeline = [
-            {"$match": {"created_at": {"$gte": recent_time}}},
-            {"$addFields": {"votes_count": {"$size": "$votes"}}},
-            {"$sort": {"votes_count": -1}},
-            {"$limit": 10}
-        ]
+        # Top of the precomputed trending ranking (time-decayed engagement)
+        from trending_snapshots import trending_snapshots
+        if not trending_snapshots:
+            return []
+        trending_posts = await trending_snapshots.top(5)
         
-        trending_posts = await db.polls.aggregate(pipeline).to_list(10)
+        author_ids = list({post["author_id"] for post in trending_posts if post.get("author_id")})
+        authors = await db.users.find(
+            {"id": {"$in": author_ids}},
+            {"_id": 0, "id": 1, "username": 1, "display_name": 1, "avatar_url": 1}
+        ).to_list(len(author_ids)) if author_ids else []
+        authors = {author["id"]: author for author in authors}
         
         results = []
         for post in trending_posts:
-            author = await db.users.find_one({"id": post["user_id"]})
-            comments_count = await db.comments.count_documents({"poll_id": post["id"]})
+            author = authors.get(post.get("author_id"))
             
             results.append({
                 "type": "trending_post",
                 "id": post["id"],
                 "title": post.get("title", ""),
-                "content": post.get("content", "")[:100],
-                "image_url": post.get("image_url"),
-                "votes_count": len(post.get("votes", [])),
-                "comments_count": comments_count,
+                "content": post.get("content", ""),
+                "image_url": post.get("thumbnail_url"),
+                "votes_count": post.get("total_votes", 0),
+                "comments_count": post.get("comments_count", 0),
                 "author": {
                     "username": author.get("username", "") if author else "",
                     "display_name": author.get("display_name", "") if author else "",
@@ -3325,7 +3807,7 @@ async def get_trending_content(current_user_id: str):
                 "created_at": post.get("created_at", "")
             })
         
-        return results[:5]  # Return top 5 trending posts
+        return results  # Top 5 trending posts
         
     except Exception as e:
         logger.error(f"Error getting trending content: {str(e)}")
@@ -3349,91 +3831,95 @@ async def search_autocomplete(
         return {"suggestions": []}
     
     query = q.lower().strip()
-    suggestions = []
     
-    try:
-        # User suggestions
-        users = await db.users.find({
-            "$and": [
-                {"id": {"$ne": current_user.id}},
-                {
-                    "$or": [
-                        {"username": {"$regex": f"^{query}", "$options": "i"}},
-                        {"display_name": {"$regex": f"^{query}", "$options": "i"}}
-                    ]
-                }
-            ]
-        }).limit(limit // 2).to_list(limit // 2)
-        
-        for user in users:
-            suggestions.append({
+    # Cached suggestions are shared by every user; the requester is filtered out here
+    cache_key = search_cache_key("autocomplete", query, limit)
+    cached = await get_cached_search(cache_key)
+    if cached is None:
+        try:
+            cached = await build_autocomplete_suggestions(query, limit)
+        except Exception as e:
+            logger.error(f"Error in autocomplete: {str(e)}")
+            return {"suggestions": []}
+        await cache_search(cache_key, cached)
+    
+    suggestions = [suggestion for user_id, suggestion in cached["users"] if user_id != current_user.id]
+    suggestions = suggestions[:limit // 2] + cached["hashtags"]
+    return {"suggestions": suggestions[:8]}  # Limit to 8 suggestions
+
+async def build_autocomplete_suggestions(query: str, limit: int) -> Dict[str, List]:
+    """
+    User and hashtag suggestions for a query, independent of the requesting user.
+    Users are (user_id, suggestion) pairs with one extra so the requester can be dropped.
+    """
+    user_limit = limit // 2 + 1
+    users, hashtags = [], []
+    
+    from autocomplete_index import autocomplete_index
+    if autocomplete_index and autocomplete_index.ready:
+        for user in autocomplete_index.complete_users(query, user_limit):
+            users.append((user["id"], {
                 "type": "user",
                 "text": f"@{user['username']}",
-                "display": f"{user.get('display_name', user['username'])} (@{user['username']})",
-                "avatar": user.get("avatar")
-            })
+                "display": f"{user['display_name']} (@{user['username']})",
+                "avatar": user.get("avatar_url")
+            }))
         
-        # Hashtag suggestions
         if query.startswith("#") or not query.startswith("@"):
-            hashtag_query = query if query.startswith("#") else f"#{query}"
-            pipeline = [
-                {"$match": {"content": {"$regex": hashtag_query, "$options": "i"}}},
-                {"$limit": 100}
-            ]
-            
-            posts = await db.polls.aggregate(pipeline).to_list(100)
-            hashtag_counts = {}
-            
-            for post in posts:
-                hashtags = extract_hashtags_from_text(post.get("content", ""))
-                for hashtag in hashtags:
-                    if hashtag.lower().startswith(query.lower()):
-                        hashtag_counts[hashtag] = hashtag_counts.get(hashtag, 0) + 1
-            
-            # Get top hashtags
-            top_hashtags = sorted(hashtag_counts.items(), key=lambda x: x[1], reverse=True)[:3]
-            for hashtag, count in top_hashtags:
-                suggestions.append({
+            for hashtag in autocomplete_index.complete_hashtags(query, 3):
+                hashtags.append({
                     "type": "hashtag",
-                    "text": hashtag,
-                    "display": f"{hashtag} ({count} posts)",
-                    "count": count
+                    "text": hashtag["text"],
+                    "display": f"{hashtag['text']} ({hashtag['count']} posts)",
+                    "count": hashtag["count"]
                 })
         
-        return {"suggestions": suggestions[:8]}  # Limit to 8 suggestions
-        
-    except Exception as e:
-        logger.error(f"Error in autocomplete: {str(e)}")
-        return {"suggestions": []}
+        return {"users": users, "hashtags": hashtags}
+    
+    # User suggestions
+    matches = await db.users.find({
+        "$or": [
+            {"username": {"$regex": f"^{query}", "$options": "i"}},
+            {"display_name": {"$regex": f"^{query}", "$options": "i"}}
+        ]
+    }).limit(user_limit).to_list(user_limit)
+    
+    for user in matches:
+        users.append((user["id"], {
+            "type": "user",
+            "text": f"@{user['username']}",
+            "display": f"{user.get('display_name', user['username'])} (@{user['username']})",
+            "avatar": user.get("avatar")
+        }))
+    
+    # Hashtag suggestions
+    from hashtag_stats import hashtag_stats
+    if hashtag_stats and (query.startswith("#") or not query.startswith("@")):
+        for hashtag in await hashtag_stats.complete(query, 3):
+            hashtags.append({
+                "type": "hashtag",
+                "text": hashtag["text"],
+                "display": f"{hashtag['text']} ({hashtag['count']} posts)",
+                "count": hashtag["count"]
+            })
+    
+    return {"users": users, "hashtags": hashtags}
 
 # =============  FOLLOW ENDPOINTS =============
 
 # Helper function to update follow counts
-async def update_follow_counts(user_id: str):
-    """Update followers and following counts for a user"""
+async def update_follow_counts(follower_id: str, following_id: str, delta: int):
+    """Apply a follow (+1) or unfollow (-1) to both users' follow counters"""
     try:
-        # Count followers
-        followers_count = await db.follows.count_documents({"following_id": user_id})
-        
-        # Count following
-        following_count = await db.follows.count_documents({"follower_id": user_id})
-        
-        # Update user profile with new counts
-        await db.user_profiles.update_one(
-            {"id": user_id},
-            {
-                "$set": {
-                    "followers_count": followers_count,
-                    "following_count": following_count
-                }
-            },
-            upsert=True  # Create profile if doesn't exist
+        await asyncio.gather(
+            increment_profile_counters(following_id, followers_count=delta),
+            increment_profile_counters(follower_id, following_count=delta)
         )
-        
-        print(f"✅ Updated follow counts for user {user_id}: {followers_count} followers, {following_count} following")
-        
+        from autocomplete_index import autocomplete_index
+        if autocomplete_index:
+            autocomplete_index.adjust_user_weight(following_id, delta)
     except Exception as e:
-        print(f"❌ Error updating follow counts for user {user_id}: {e}")
+        print(f"❌ Error updating follow counts for {follower_id} -> {following_id}: {e}")
 
 @api_router.post("/users/{user_id}/follow")
 async def follow_user(user_id: str, current_user: UserResponse = Depends(get_current_user)):
@@ -3465,19 +3951,21 @@ async def follow_user(user_id: str, current_user: UserResponse = Depends(get_cur
     if not result.inserted_id:
         raise HTTPException(status_code=500, detail="Failed to follow user")
     
+    # Backfill the follower's materialized timeline with the author's recent polls
+    from timeline_materializer import timeline_materializer
+    if timeline_materializer:
+        asyncio.create_task(timeline_materializer.follow_author(current_user.id, user_id))
+    
     # Update follow counts for both users
-    await update_follow_counts(user_id)  # Update followed user's follower count
-    await update_follow_counts(current_user.id)  # Update current user's following count
+    await update_follow_counts(current_user.id, user_id, 1)
     
     # Clear cache for this relationship
-    cache_key = f"{current_user.id}:{user_id}"
-    if cache_key in follow_status_cache:
-        del follow_status_cache[cache_key]
+    await follow_status_cache.adelete(f"{current_user.id}:{user_id}")
     
     # Also clear reverse cache (for the followed user's perspective)
-    reverse_cache_key = f"{user_id}:{current_user.id}"
-    if reverse_cache_key in follow_status_cache:
-        del follow_status_cache[reverse_cache_key]
+    await follow_status_cache.adelete(f"{user_id}:{current_user.id}")
+    
+    await push_event([user_id], "follow", {"follow_id": follow_data.id, "follower": user_card(current_user.dict())})
     
     return {"message": "Successfully followed user", "follow_id": follow_data.id}
 
@@ -3493,30 +3981,31 @@ async def unfollow_user(user_id: str, current_user: UserResponse = Depends(get_c
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Follow relationship not found")
     
+    # Drop the author's polls from the materialized timeline
+    from timeline_materializer import timeline_materializer
+    if timeline_materializer:
+        asyncio.create_task(timeline_materializer.unfollow_author(current_user.id, user_id))
+    
     # Update follow counts for both users
-    await update_follow_counts(user_id)  # Update unfollowed user's follower count
-    await update_follow_counts(current_user.id)  # Update current user's following count
+    await update_follow_counts(current_user.id, user_id, -1)
     
     # Clear cache for this relationship
-    cache_key = f"{current_user.id}:{user_id}"
-    if cache_key in follow_status_cache:
-        del follow_status_cache[cache_key]
+    await follow_status_cache.adelete(f"{current_user.id}:{user_id}")
     
     # Also clear reverse cache (for the followed user's perspective)
-    reverse_cache_key = f"{user_id}:{current_user.id}"
-    if reverse_cache_key in follow_status_cache:
-        del follow_status_cache[reverse_cache_key]
+    await follow_status_cache.adelete(f"{user_id}:{current_user.id}")
     
     return {"message": "Successfully unfollowed user"}
 
 @api_router.get("/users/{user_id}/follow-status")
-async def get_follow_status(user_id: str, current_user: UserResponse = Depends(get_current_user)):
+async def get_follow_status(user_id: str, current_user: TokenPrincipal = Depends(get_token_principal)):
     """Get follow status for a specific user with caching"""
     
     # Check cache first
     cache_key = f"{current_user.id}:{user_id}"
-    if cache_key in follow_status_cache and is_follow_cache_valid(follow_status_cache[cache_key]):
-        return follow_status_cache[cache_key]['data']
+    cached_status = await follow_status_cache.aget(cache_key)
+    if cached_status is not None:
+        return cached_status
     
     follow_relationship = await db.follows.find_one({
         "follower_id": current_user.id,
@@ -3529,10 +4018,7 @@ async def get_follow_status(user_id: str, current_user: UserResponse = Depends(g
     )
     
     # Cache the result
-    follow_status_cache[cache_key] = {
-        'data': result,
-        'cached_at': datetime.utcnow()
-    }
+    await follow_status_cache.aset(cache_key, result, tags=(f"user:{current_user.id}", f"user:{user_id}"))
     
     return result
 
@@ -3623,6 +4109,11 @@ async def send_message(message: MessageCreate, current_user: UserResponse = Depe
                 )
                 
                 await db.chat_requests.insert_one(chat_request.dict())
+                await push_event([message.recipient_id], "chat_request", {
+                    "request_id": chat_request.id,
+                    "message": chat_request.message,
+                    "sender": user_card(current_user.dict())
+                })
                 
                 return {
                     "success": True,
@@ -3645,6 +4136,13 @@ async def send_message(message: MessageCreate, current_user: UserResponse = Depe
         # Create new conversation
         conversation = Conversation(
             participants=[current_user.id, message.recipient_id],
+            participant_cards={
+                current_user.id: user_card(current_user.dict()),
+                message.recipient_id: user_card(recipient)
+            },
+            last_message=message.content[:MESSAGE_SNIPPET_LENGTH],
+            last_message_at=datetime.utcnow(),
+            last_message_sender_id=current_user.id,
             unread_count={
                 current_user.id: 0,
                 message.recipient_id: 1
@@ -3660,8 +4158,9 @@ async def send_message(message: MessageCreate, current_user: UserResponse = Depe
             {
                 "$inc": {f"unread_count.{message.recipient_id}": 1},
                 "$set": {
-                    "last_message": message.content,
+                    "last_message": message.content[:MESSAGE_SNIPPET_LENGTH],
                     "last_message_at": datetime.utcnow(),
+                    "last_message_sender_id": current_user.id,
                     "updated_at": datetime.utcnow()
                 }
             }
@@ -3679,8 +4178,12 @@ async def send_message(message: MessageCreate, current_user: UserResponse = Depe
     
     await db.messages.insert_one(new_message.dict())
     
-    # Prepare complete message response with sender info
-    sender_user = await db.users.find_one({"id": current_user.id})
+    # The recipient, and the sender's other open clients
+    await push_event([message.recipient_id, current_user.id], "message", {
+        "conversation_id": conversation_id,
+        "message": new_message.dict(),
+        "sender": user_card(current_user.dict())
+    })
     
     return {
         "success": True,
@@ -3691,31 +4194,55 @@ async def send_message(message: MessageCreate, current_user: UserResponse = Depe
         "sender_id": current_user.id,
         "sender": {
             "id": current_user.id,
-            "username": sender_user.get("username") if sender_user else current_user.username,
-            "display_name": sender_user.get("display_name") if sender_user else current_user.display_name,
-            "avatar_url": sender_user.get("avatar_url") if sender_user else current_user.avatar_url
+            "username": current_user.username,
+            "display_name": current_user.display_name,
+            "avatar_url": current_user.avatar_url
         }
     }
 
 @api_router.get("/conversations")
 async def get_conversations(current_user: UserResponse = Depends(get_current_user)):
     """Get user's conversations including pending chat requests"""
-    # Get regular conversations
-    conversations = await db.conversations.find({
-        "participants": current_user.id,
-        "is_active": True
-    }).sort("last_message_at", -1).to_list(50)
+    # Regular conversations (participant cards and last message are stored on them) and
+    # pending chat requests where current user is the SENDER only
+    # Receivers will see these in the separate "Solicitudes de mensajes" section
+    conversations, pending_requests = await asyncio.gather(
+        db.conversations.find(
+            {"participants": current_user.id, "is_active": True},
+            {"_id": 0}
+        ).sort("last_message_at", -1).to_list(50),
+        db.chat_requests.find(
+            {"sender_id": current_user.id, "status": "pending"},
+            {"_id": 0}
+        ).sort("created_at", -1).to_list(50)
+    )
+    
+    # Cards missing from older conversations, and request receivers, come from the user-card cache
+    missing_ids = [
+        participant_id
+        for conv_data in conversations
+        for participant_id in conv_data["participants"]
+        if participant_id != current_user.id and participant_id not in (conv_data.get("participant_cards") or {})
+    ]
+    cards = await get_user_cards(missing_ids + [req["receiver_id"] for req in pending_requests])
     
     result = []
+    backfill = []
     for conv_data in conversations:
-        # Get participant info
-        participant_ids = [p for p in conv_data["participants"] if p != current_user.id]
+        stored_cards = conv_data.get("participant_cards") or {}
         participants = []
-        
-        for participant_id in participant_ids:
-            user_data = await db.users.find_one({"id": participant_id})
-            if user_data:
-                participants.append(UserResponse(**user_data))
+        for participant_id in conv_data["participants"]:
+            if participant_id == current_user.id:
+                continue
+            card = stored_cards.get(participant_id) or cards.get(participant_id)
+            if not card:
+                continue
+            participants.append(card)
+            if participant_id not in stored_cards:
+                backfill.append(UpdateOne(
+                    {"id": conv_data["id"]},
+                    {"$set": {f"participant_cards.{participant_id}": card}}
+                ))
         
         # Get unread count for current user
         unread_count = conv_data.get("unread_count", {}).get(current_user.id, 0)
@@ -3725,27 +4252,23 @@ async def get_conversations(current_user: UserResponse = Depends(get_current_use
             "participants": participants,
             "last_message": conv_data.get("last_message"),
             "last_message_at": conv_data.get("last_message_at"),
+            "last_message_sender_id": conv_data.get("last_message_sender_id"),
             "unread_count": unread_count,
             "created_at": conv_data["created_at"]
         }
         result.append(conversation_response)
     
-    # Get pending chat requests where current user is the SENDER only
-    # Receivers will see these in the separate "Solicitudes de mensajes" section
-    pending_requests = await db.chat_requests.find({
-        "sender_id": current_user.id,
-        "status": "pending"
-    }).sort("created_at", -1).to_list(50)
+    # Store the cards on conversations created before they were embedded
+    if backfill:
+        await db.conversations.bulk_write(backfill, ordered=False)
     
     # Convert chat requests to conversation-like format
     for req in pending_requests:
         # Get receiver user info
-        other_user_data = await db.users.find_one({"id": req["receiver_id"]})
-        if not other_user_data:
+        other_user = cards.get(req["receiver_id"])
+        if not other_user:
             continue
         
-        other_user = UserResponse(**other_user_data)
-        
         # Create conversation-like object with chat request metadata
         request_conversation = {
             "id": f"request-{req['id']}",  # Prefix to identify as request
@@ -3788,39 +4311,41 @@ async def get_conversation_messages(
     # Get messages
     messages = await db.messages.find({
         "conversation_id": conversation_id
-    }).sort("created_at", -1).limit(limit).to_list(limit)
-    
-    # Mark messages as read
-    await db.messages.update_many(
-        {
-            "conversation_id": conversation_id,
-            "recipient_id": current_user.id,
-            "is_read": False
-        },
-        {"$set": {"is_read": True}}
-    )
+    }, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
     
-    # Reset unread count for current user
-    await db.conversations.update_one(
-        {"id": conversation_id},
-        {"$set": {f"unread_count.{current_user.id}": 0}}
+    # Mark messages as read and reset unread count for current user
+    await asyncio.gather(
+        db.messages.update_many(
+            {
+                "conversation_id": conversation_id,
+                "recipient_id": current_user.id,
+                "is_read": False
+            },
+            {"$set": {"is_read": True}}
+        ),
+        db.conversations.update_one(
+            {"id": conversation_id},
+            {"$set": {f"unread_count.{current_user.id}": 0}}
+        )
     )
     
     # Reverse to get chronological order (oldest first)
     messages.reverse()
     
+    # Senders are normally participants, whose cards the conversation stores
+    senders = dict(conversation.get("participant_cards") or {})
+    missing_ids = [msg["sender_id"] for msg in messages if msg["sender_id"] not in senders]
+    if missing_ids:
+        senders.update(await get_user_cards(missing_ids))
+    
     # Enrich messages with sender information
     enriched_messages = []
     for msg in messages:
-        # Get sender user info
-        sender = await db.users.find_one({"id": msg["sender_id"]})
-        
-        # Remove MongoDB _id field if present (not JSON serializable)
-        msg_dict = {k: v for k, v in msg.items() if k != "_id"}
+        sender = senders.get(msg["sender_id"])
         
         # Build enriched message object
         enriched_msg = {
-            **msg_dict,
+            **msg,
             "sender": {
                 "id": msg["sender_id"],
                 "username": sender.get("username") if sender else "unknown",
@@ -3833,7 +4358,7 @@ async def get_conversation_messages(
     return enriched_messages
 
 @api_router.get("/messages/unread")
-async def get_unread_count(current_user: UserResponse = Depends(get_current_user)):
+async def get_unread_count(current_user: TokenPrincipal = Depends(get_token_principal)):
     """Get total unread message count"""
     conversations = await db.conversations.find({
         "participants": current_user.id,
@@ -3863,7 +4388,7 @@ async def get_chat_request_messages(
         raise HTTPException(status_code=403, detail="You don't have access to this chat request")
     
     # Get sender info
-    sender_data = await db.users.find_one({"id": chat_request["sender_id"]})
+    sender_data = (await get_user_cards([chat_request["sender_id"]])).get(chat_request["sender_id"])
     if not sender_data:
         raise HTTPException(status_code=404, detail="Sender not found")
     
@@ -3901,17 +4426,19 @@ async def get_message_requests(current_user: UserResponse = Depends(get_current_
         }).to_list(1000)
         viewed_ids = {v["request_id"] for v in viewed_requests}
         
+        # Get senders info in one batch
+        senders = await get_user_cards([req["sender_id"] for req in requests])
+        
         result = []
         for req in requests:
-            # Get sender info
-            sender = await db.users.find_one({"id": req["sender_id"]})
+            sender = senders.get(req["sender_id"])
             if sender:
                 result.append({
                     "id": req["id"],
                     "sender": {
                         "id": sender["id"],
                         "username": sender["username"],
-                        "display_name": sender.get("display_name", sender["username"]),
+                        "display_name": sender.get("display_name") or sender["username"],
                         "avatar_url": sender.get("avatar_url"),
                         "is_verified": sender.get("is_verified", False)
                     },
@@ -3967,7 +4494,7 @@ async def mark_requests_as_read(current_user: UserResponse = Depends(get_current
 
 
 @api_router.get("/messages/requests/unread-count")
-async def get_unread_requests_count(current_user: UserResponse = Depends(get_current_user)):
+async def get_unread_requests_count(current_user: TokenPrincipal = Depends(get_token_principal)):
     """Get count of unread message requests for the current user"""
     try:
         # Get pending chat requests where current user is the receiver
@@ -3994,6 +4521,24 @@ async def get_unread_requests_count(current_user: UserResponse = Depends(get_cur
         print(f"❌ Error getting unread requests count: {str(e)}")
         return {"unread_count": 0, "total_count": 0}
 
+@api_router.websocket("/ws")
+async def realtime_events(websocket: WebSocket, token: str = Query(...)):
+    """
+    Push channel for message, chat request, follow and activity events.
+    Browsers cannot set headers on WebSockets, so the access token comes as `?token=`.
+    """
+    from realtime import realtime_gateway
+    principal = token_principal(token)
+    user = await load_principal_user(principal) if principal else None
+    # Accept before rejecting: a close sent during the handshake reaches
+    # browsers as 1006, which clients can't tell apart from a network error
+    await websocket.accept()
+    if not realtime_gateway or not user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await realtime_gateway.serve(websocket, user.id)
+
 # =============  CHAT REQUEST ENDPOINTS =============
 
 @api_router.post("/chat-requests")
@@ -4046,6 +4591,11 @@ async def send_chat_request(
     )
     
     await db.chat_requests.insert_one(chat_request.dict())
+    await push_event([request_data.receiver_id], "chat_request", {
+        "request_id": chat_request.id,
+        "message": chat_request.message,
+        "sender": user_card(current_user.dict())
+    })
     
     return {
         "success": True,
@@ -4150,8 +4700,10 @@ async def respond_to_chat_request(
             # Create new conversation
             conversation = Conversation(
                 participants=[current_user.id, chat_request["sender_id"]],
-                last_message=chat_request.get("message", ""),
+                participant_cards=await get_user_cards([current_user.id, chat_request["sender_id"]]),
+                last_message=(chat_request.get("message") or "")[:MESSAGE_SNIPPET_LENGTH],
                 last_message_at=datetime.utcnow(),
+                last_message_sender_id=chat_request["sender_id"],
                 unread_count={
                     current_user.id: 0,
                     chat_request["sender_id"]: 0
@@ -4173,12 +4725,23 @@ async def respond_to_chat_request(
         else:
             conversation_id = existing_conversation["id"]
         
+        await push_event([chat_request["sender_id"]], "chat_request_response", {
+            "request_id": request_id,
+            "status": new_status,
+            "conversation_id": conversation_id,
+            "receiver": user_card(current_user.dict())
+        })
+        
         return {
             "success": True,
             "message": "Chat request accepted",
             "conversation_id": conversation_id
         }
     else:
+        await push_event([chat_request["sender_id"]], "chat_request_response", {
+            "request_id": request_id,
+            "status": new_status
+        })
         return {
             "success": True,
             "message": "Chat request rejected"
@@ -4306,7 +4869,7 @@ async def mark_followers_as_read(current_user: UserResponse = Depends(get_curren
 
 
 @api_router.get("/users/followers/unread-count")
-async def get_unread_followers_count(current_user: UserResponse = Depends(get_current_user)):
+async def get_unread_followers_count(current_user: TokenPrincipal = Depends(get_token_principal)):
     """Get count of unread new followers for the current user"""
     try:
         # Calculate 7 days ago
@@ -4633,7 +5196,7 @@ async def mark_activities_as_read(current_user: UserResponse = Depends(get_curre
 
 
 @api_router.get("/users/activity/unread-count")
-async def get_unread_activity_count(current_user: UserResponse = Depends(get_current_user)):
+async def get_unread_activity_count(current_user: TokenPrincipal = Depends(get_token_principal)):
     """Get count of unread activities for the current user"""
     try:
         seven_days_ago = datetime.utcnow() - timedelta(days=7)
@@ -4750,6 +5313,8 @@ async def create_comment(
         {"$inc": {"comments_count": 1}}
     )
     
+    await push_activity(poll, current_user.id, "comment", comment_id=comment.id, content=comment.content[:MESSAGE_SNIPPET_LENGTH])
+    
     # Retornar el comentario creado con información del usuario
     return CommentResponse(
         **comment.dict(),
@@ -4764,7 +5329,7 @@ async def get_poll_comments(
     poll_id: str,
     limit: int = 50,
     offset: int = 0,
-    current_user: UserResponse = Depends(get_current_user)
+    current_user: TokenPrincipal = Depends(get_token_principal)
 ):
     """Get comments for a specific poll with nested structure"""
     
@@ -5171,6 +5736,43 @@ async def get_thumbnail_for_media_url(media_url: str) -> Optional[str]:
         print(f"Error getting thumbnail for media URL {media_url}: {e}")
         return None
 
+async def get_thumbnails_for_media_urls(media_urls: List[str]) -> Dict[str, Optional[str]]:
+    """Batch version of get_thumbnail_for_media_url - one uploaded_files query for a whole page"""
+    thumbnails = {url: None for url in media_urls}
+    
+    # Map each filename back to the media URLs that reference it
+    urls_by_filename = {}
+    for media_url in media_urls:
+        if media_url and "/api/uploads/" in media_url:
+            parts = media_url.split("/")
+            if len(parts) >= 4:
+                urls_by_filename.setdefault(parts[-1], []).append(media_url)
+    
+    if not urls_by_filename:
+        return thumbnails
+    
+    try:
+        uploaded_files = await db.uploaded_files.find(
+            {"filename": {"$in": list(urls_by_filename.keys())}},
+            {"_id": 0, "filename": 1, "thumbnail_url": 1, "file_type": 1}
+        ).to_list(len(urls_by_filename))
+    except Exception as e:
+        print(f"Error batch loading thumbnails: {e}")
+        return thumbnails
+    
+    for uploaded_file in uploaded_files:
+        urls = urls_by_filename.get(uploaded_file["filename"], [])
+        if uploaded_file.get("thumbnail_url"):
+            for media_url in urls:
+                thumbnails[media_url] = uploaded_file["thumbnail_url"]
+        elif uploaded_file.get("file_type") == "video" and urls:
+            # Rare path: thumbnail was never generated, fall back to the single lookup which generates it
+            thumbnail_url = await get_thumbnail_for_media_url(urls[0])
+            for media_url in urls:
+                thumbnails[media_url] = thumbnail_url
+    
+    return thumbnails
+
 async def get_video_info(file_path: Path) -> tuple[Optional[int], Optional[int], Optional[float]]:
     """Get video info and generate thumbnail"""
     try:
@@ -5605,79 +6207,86 @@ async def get_test_carousel():
         
     except Exception as e:
         print(f"Error getting test carousel: {e}")
-        return []
-
-@api_router.get("/polls", response_model=List[PollResponse])
-async def get_polls(
-    limit: int = 20,
-    offset: int = 0,
-    category: Optional[str] = None,
-    featured: Optional[bool] = None,
-    current_user: UserResponse = Depends(get_current_user)
-):
-    """Get polls with pagination and filters"""
-    
-    # Build filter query
-    filter_query = {"is_active": True}
-    if category:
-        filter_query["category"] = category
-    if featured is not None:
-        filter_query["is_featured"] = featured
-    
-    # Get polls
-    polls_cursor = db.polls.find(filter_query).sort("created_at", -1).skip(offset).limit(limit)
-    polls = await polls_cursor.to_list(limit)
-    
+        return []
+
+async def overlay_poll_counters(polls: List[dict]) -> List[dict]:
+    """Apply counters kept outside the poll document (sharded counters, write-behind buffer)"""
+    from sharded_counters import sharded_counters
+    from engagement_buffer import engagement_buffer
+    if sharded_counters:
+        polls = await sharded_counters.overlay_polls(polls)
+    if engagement_buffer:
+        polls = [engagement_buffer.overlay_poll(poll_data) for poll_data in polls]
+    return polls
+
+async def hydrate_polls(polls: List[dict], current_user_id: str) -> List[PollResponse]:
+    """
+    Feed hydration stage: resolve every user, mention, thumbnail, vote and like
+    referenced by a page of polls with one batched query per collection,
+    then assemble PollResponse objects from in-memory maps.
+    """
     if not polls:
         return []
     
-    # Get all author IDs
-    author_ids = list(set(poll["author_id"] for poll in polls))
-    authors_cursor = db.users.find({"id": {"$in": author_ids}})
-    authors_list = await authors_cursor.to_list(len(author_ids))
-    authors_dict = {user["id"]: UserResponse(**user) for user in authors_list}
-    
-    # Batch get follow status for all authors to reduce DB queries
-    follow_relationships_cursor = db.follows.find({
-        "follower_id": current_user.id,
-        "following_id": {"$in": author_ids}
-    })
-    follow_relationships = await follow_relationships_cursor.to_list(len(author_ids))
-    following_dict = {rel["following_id"]: rel for rel in follow_relationships}
-    
-    # Get user votes and likes
+    # 1. COLLECT EVERY REFERENCE ACROSS THE PAGE
     poll_ids = [poll["id"] for poll in polls]
-    
-    user_votes_cursor = db.votes.find({
+    user_ids = set()
+    video_media_urls = set()
+    music_ids = set()
+    for poll_data in polls:
+        user_ids.add(poll_data["author_id"])
+        user_ids.update(poll_data.get("mentioned_users") or [])
+        if poll_data.get("music_id"):
+            music_ids.add(poll_data["music_id"])
+        for option in poll_data.get("options", []):
+            if option.get("user_id"):
+                user_ids.add(option["user_id"])
+            user_ids.update(option.get("mentioned_users") or [])
+            if not option.get("thumbnail_url") and option.get("media_url") and option.get("media_type") == "video":
+                video_media_urls.add(option["media_url"])
+    
+    # 2. RESOLVE EVERYTHING IN PARALLEL (one query per collection)
+    users_task = db.users.find({"id": {"$in": list(user_ids)}}, {"_id": 0}).to_list(len(user_ids))
+    user_votes_task = db.votes.find({
         "poll_id": {"$in": poll_ids},
-        "user_id": current_user.id
-    })
-    user_votes = await user_votes_cursor.to_list(len(poll_ids))
-    user_votes_dict = {vote["poll_id"]: vote["option_id"] for vote in user_votes}
-    
-    user_likes_cursor = db.poll_likes.find({
+        "user_id": current_user_id
+    }).to_list(len(poll_ids))
+    user_likes_task = db.poll_likes.find({
         "poll_id": {"$in": poll_ids},
-        "user_id": current_user.id
-    })
-    user_likes = await user_likes_cursor.to_list(len(poll_ids))
+        "user_id": current_user_id
+    }).to_list(len(poll_ids))
+    thumbnails_task = get_thumbnails_for_media_urls(list(video_media_urls))
+    music_ids = list(music_ids)
+    music_task = asyncio.gather(*[get_music_info(music_id) for music_id in music_ids])
+    
+    users_list, user_votes, user_likes, thumbnails_dict, music_list = await asyncio.gather(
+        users_task, user_votes_task, user_likes_task, thumbnails_task, music_task
+    )
+    
+    # 3. BUILD LOOKUP DICTIONARIES
+    users_dict = {user["id"]: user for user in users_list}
+    user_votes_dict = {vote["poll_id"]: vote["option_id"] for vote in user_votes}
     liked_poll_ids = set(like["poll_id"] for like in user_likes)
+    music_dict = dict(zip(music_ids, music_list))
+    
+    # Overlay sharded counters and votes/likes still waiting in the write-behind buffer
+    polls = await overlay_poll_counters(polls)
+    from engagement_buffer import engagement_buffer
+    if engagement_buffer:
+        engagement_buffer.overlay_user_state(current_user_id, poll_ids, user_votes_dict, liked_poll_ids)
+    
+    authors_dict = {}
+    for poll_data in polls:
+        author_data = users_dict.get(poll_data["author_id"])
+        if author_data and poll_data["author_id"] not in authors_dict:
+            authors_dict[poll_data["author_id"]] = UserResponse(**author_data)
     
-    # Build response
+    # 4. ASSEMBLE RESPONSES
     result = []
     for poll_data in polls:
-        # Get option users (solo si las opciones tienen user_id)
-        option_user_ids = [option["user_id"] for option in poll_data.get("options", []) if "user_id" in option]
-        if option_user_ids:
-            option_users_cursor = db.users.find({"id": {"$in": option_user_ids}})
-            option_users_list = await option_users_cursor.to_list(len(option_user_ids))
-            option_users_dict = {user["id"]: user for user in option_users_list}
-        else:
-            option_users_dict = {}
-        
-        # Process options
         options = []
         for option in poll_data.get("options", []):
-            option_user = option_users_dict.get(option.get("user_id")) if option.get("user_id") else None
+            option_user = users_dict.get(option.get("user_id")) if option.get("user_id") else None
             
             # Keep media_url as relative path for frontend to handle
             media_url = option.get("media_url")
@@ -5685,29 +6294,19 @@ async def get_polls(
             # Get thumbnail URL for videos
             thumbnail_url = option.get("thumbnail_url")
             if not thumbnail_url and media_url and option.get("media_type") == "video":
-                thumbnail_url = await get_thumbnail_for_media_url(media_url)
+                thumbnail_url = thumbnails_dict.get(media_url)
             
             # Resolve mentioned users for this option
-            option_mentioned_users_data = []
-            if option.get("mentioned_users"):
-                option_mentioned_user_ids = option.get("mentioned_users", [])
-                if option_mentioned_user_ids:
-                    try:
-                        option_mentioned_cursor = db.users.find({"id": {"$in": option_mentioned_user_ids}})
-                        option_mentioned_list = await option_mentioned_cursor.to_list(len(option_mentioned_user_ids))
-                        
-                        option_mentioned_users_data = [
-                            {
-                                "id": user["id"],
-                                "username": user["username"],
-                                "display_name": user.get("display_name"),
-                                "avatar_url": user.get("avatar_url")
-                            } 
-                            for user in option_mentioned_list
-                        ]
-                    except Exception as e:
-                        print(f"DEBUG: Error resolving mentioned users for option {option.get('id')}: {e}")
-                        option_mentioned_users_data = []
+            option_mentioned_users_data = [
+                {
+                    "id": users_dict[user_id]["id"],
+                    "username": users_dict[user_id]["username"],
+                    "display_name": users_dict[user_id].get("display_name"),
+                    "avatar_url": users_dict[user_id].get("avatar_url")
+                }
+                for user_id in option.get("mentioned_users") or []
+                if user_id in users_dict
+            ]
             
             option_dict = {
                 "id": option.get("id"),
@@ -5735,35 +6334,17 @@ async def get_polls(
         if not options or not poll_data.get("title"):
             continue
         
-        # Get music info if available
-        music_info = await get_music_info(poll_data.get("music_id")) if poll_data.get("music_id") else None
-        
         # Resolve mentioned users to user objects
-        mentioned_users_data = []
-        if poll_data.get("mentioned_users"):
-            mentioned_user_ids = poll_data.get("mentioned_users", [])
-            if mentioned_user_ids:
-                try:
-                    mentioned_users_cursor = db.users.find({"id": {"$in": mentioned_user_ids}})
-                    mentioned_users_list = await mentioned_users_cursor.to_list(len(mentioned_user_ids))
-                    
-                    # Log for debugging
-                    print(f"DEBUG: Found {len(mentioned_users_list)} users out of {len(mentioned_user_ids)} mentioned IDs for poll {poll_data['id']}")
-                    if len(mentioned_users_list) != len(mentioned_user_ids):
-                        print(f"DEBUG: Missing users for IDs: {set(mentioned_user_ids) - set(user['id'] for user in mentioned_users_list)}")
-                    
-                    mentioned_users_data = [
-                        MentionedUser(
-                            id=user["id"],
-                            username=user["username"],
-                            display_name=user.get("display_name"),
-                            avatar_url=user.get("avatar_url")
-                        ) 
-                        for user in mentioned_users_list
-                    ]
-                except Exception as e:
-                    print(f"DEBUG: Error resolving mentioned users for poll {poll_data['id']}: {e}")
-                    mentioned_users_data = []
+        mentioned_users_data = [
+            MentionedUser(
+                id=users_dict[user_id]["id"],
+                username=users_dict[user_id]["username"],
+                display_name=users_dict[user_id].get("display_name"),
+                avatar_url=users_dict[user_id].get("avatar_url")
+            )
+            for user_id in poll_data.get("mentioned_users") or []
+            if user_id in users_dict
+        ]
         
         poll_response = PollResponse(
             id=poll_data["id"],
@@ -5776,7 +6357,7 @@ async def get_polls(
             shares=len(poll_data["shares"]) if isinstance(poll_data["shares"], list) else poll_data["shares"],
             comments_count=poll_data["comments_count"],
             saves_count=poll_data.get("saves_count", 0),
-            music=music_info,  # Include music information
+            music=music_dict.get(poll_data.get("music_id")),  # Include music information
             user_vote=user_votes_dict.get(poll_data["id"]),
             user_liked=poll_data["id"] in liked_poll_ids,
             is_featured=poll_data["is_featured"],
@@ -5798,14 +6379,56 @@ async def get_polls(
     
     return result
 
+@api_router.get("/polls", response_model=List[PollResponse])
+async def get_polls(
+    response: Response,
+    limit: int = 20,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    category: Optional[str] = None,
+    featured: Optional[bool] = None,
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """
+    Get polls with pagination and filters.
+    Pass the X-Next-Cursor header of the previous page as `cursor` for
+    keyset pagination (`offset` is ignored when a cursor is given).
+    """
+    
+    # Build filter query
+    filter_query = {"is_active": True}
+    if category:
+        filter_query["category"] = category
+    if featured is not None:
+        filter_query["is_featured"] = featured
+    
+    sort_fields = get_sort_fields("recent")
+    try:
+        filter_query = apply_cursor(filter_query, cursor, sort_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Get polls
+    polls_cursor = db.polls.find(filter_query).sort(get_sort_spec(sort_fields))
+    if not cursor:
+        polls_cursor = polls_cursor.skip(offset)
+    polls = await polls_cursor.limit(limit).to_list(limit)
+    
+    if len(polls) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(polls[-1], sort_fields)
+    
+    # Resolve authors, options, mentions, thumbnails and user interactions in batch
+    return await hydrate_polls(polls, current_user.id)
+
 # =============  OPTIMIZED FEED ENDPOINTS =============
 
 @api_router.get("/polls/fast")
 async def get_fast_polls(
     limit: int = 10,
     offset: int = 0,
+    cursor: Optional[str] = None,
     lightweight: bool = True,
-    current_user: UserResponse = Depends(get_current_user)
+    current_user: TokenPrincipal = Depends(get_token_principal)
 ):
     """
     🚀 FAST FEED: Optimized endpoint for quick loading
@@ -5822,28 +6445,34 @@ async def get_fast_polls(
             init_feed_optimizer(db)
         
         if lightweight:
-            polls = await feed_optimizer.get_lightweight_feed(
+            page = await feed_optimizer.get_lightweight_feed(
                 current_user_id=current_user.id,
                 limit=limit,
-                offset=offset
+                offset=offset,
+                cursor=cursor
             )
         else:
-            polls = await feed_optimizer.get_optimized_polls(
+            page = await feed_optimizer.get_optimized_polls(
                 current_user_id=current_user.id, 
                 limit=limit,
                 offset=offset,
-                load_thumbnails=False  # Skip for speed
+                load_thumbnails=False,  # Skip for speed
+                cursor=cursor
             )
+        polls = page["polls"]
         
         return {
             "polls": polls,
             "total": len(polls),
             "offset": offset,
             "limit": limit,
+            "next_cursor": page["next_cursor"],
             "optimized": True,
             "cache_enabled": True
         }
         
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"❌ Fast feed error: {str(e)}")
         # Fallback to original endpoint
@@ -5852,7 +6481,7 @@ async def get_fast_polls(
 @api_router.get("/polls/{poll_id}/details")
 async def get_poll_details_on_demand(
     poll_id: str,
-    current_user: UserResponse = Depends(get_current_user)
+    current_user: TokenPrincipal = Depends(get_token_principal)
 ):
     """
     📱 ON-DEMAND DETAILS: Load full poll data only when user views it
@@ -5887,13 +6516,15 @@ async def get_poll_details_on_demand(
 async def preload_next_batch(
     current_offset: int = 0,
     batch_size: int = 5,
-    current_user: UserResponse = Depends(get_current_user)
+    cursor: Optional[str] = None,
+    current_user: TokenPrincipal = Depends(get_token_principal)
 ):
     """
     ⚡ PRELOAD: Background loading for smooth infinite scroll
     - Preloads next batch while user views current
     - Smaller batches for faster response
-    - Background processing
+    - Background processing (the batch after this one is prefetched into the cache)
+    - With `cursor` (the current batch's next_cursor) the batch is paged by keyset
     """
     try:
         from optimized_feed import feed_optimizer, init_feed_optimizer
@@ -5904,19 +6535,23 @@ async def preload_next_batch(
         
         # Load next batch
         next_offset = current_offset + batch_size
-        next_polls = await feed_optimizer.get_lightweight_feed(
+        next_page = await feed_optimizer.get_lightweight_feed(
             current_user_id=current_user.id,
             limit=batch_size,
-            offset=next_offset
+            offset=next_offset,
+            cursor=cursor
         )
         
         return {
-            "polls": next_polls,
+            "polls": next_page["polls"],
             "next_offset": next_offset,
+            "next_cursor": next_page["next_cursor"],
             "batch_size": batch_size,
             "preloaded": True
         }
         
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"❌ Preload error: {str(e)}")
         return {"polls": [], "next_offset": current_offset, "error": str(e)}
@@ -5926,28 +6561,58 @@ async def get_ultra_fast_feed(
     limit: int = 10,
     offset: int = 0,
     algorithm: str = "for_you",
-    current_user: UserResponse = Depends(get_current_user)
+    cursor: Optional[str] = None,
+    current_user: TokenPrincipal = Depends(get_token_principal)
 ):
     """
     🚀 ULTRA-FAST FEED: Simplified optimized query (no complex aggregation)
     - Fast and reliable
     - Built for performance without complexity
+    - Keyset pagination: pass `next_cursor` from the previous page as `cursor`
     """
     try:
         # 🚀 SIMPLIFIED FAST QUERY - Just use the working endpoint logic
-        filter_query = {"is_active": True}
-        
-        # Get polls with simple sort (fast and reliable)
-        if algorithm == "trending":
-            sort_criteria = [("likes_count", -1), ("created_at", -1)]
-        elif algorithm == "recent": 
-            sort_criteria = [("created_at", -1)]
-        else:  # for_you default
-            sort_criteria = [("total_votes", -1), ("created_at", -1)]
-        
-        # Execute fast query
-        polls_cursor = db.polls.find(filter_query).sort(sort_criteria).skip(offset).limit(limit)
-        polls = await polls_cursor.to_list(limit)
+        # Sort keys per algorithm, backed by matching compound indexes
+        sort_fields = get_sort_fields(algorithm)
+        base_query = {"is_active": True}
+        keyset_cursor, skip = cursor, offset
+        polls = None
+        slate_page = None
+        
+        # for_you pages come from the user's ranked slate, then continue with the for_you sort
+        from feed_ranking import feed_ranker
+        if algorithm == "for_you" and feed_ranker:
+            try:
+                page = await feed_ranker.get_page(current_user.id, limit, offset, cursor)
+            except (ValueError, TypeError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            if page["poll_ids"] is not None:
+                docs = await db.polls.find({"id": {"$in": page["poll_ids"]}}).to_list(len(page["poll_ids"]))
+                docs = {poll["id"]: poll for poll in docs}
+                polls = [docs[poll_id] for poll_id in page["poll_ids"] if poll_id in docs]
+                next_cursor = page["next_cursor"]
+            else:
+                slate_page = page
+                keyset_cursor, skip = page["cursor"], page["offset"]
+                if page["slate"]:
+                    base_query["id"] = {"$nin": page["slate"]}
+        
+        if polls is None:
+            try:
+                filter_query = apply_cursor(base_query, keyset_cursor, sort_fields)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            
+            # Execute fast query
+            polls_cursor = db.polls.find(filter_query).sort(get_sort_spec(sort_fields))
+            if not keyset_cursor:
+                polls_cursor = polls_cursor.skip(skip)
+            polls = await polls_cursor.limit(limit).to_list(limit)
+            next_cursor = encode_cursor(polls[-1], sort_fields) if len(polls) == limit else None
+            if next_cursor and slate_page:
+                # Keeps the slate the user paged excluded on the following pages
+                next_cursor = feed_ranker.continuation_cursor(slate_page["slate_id"], polls[-1])
+        polls = await overlay_poll_counters(polls)
         
         # Get author info in batch (fast)
         author_ids = list(set(poll.get("author_id") for poll in polls if poll.get("author_id")))
@@ -6025,12 +6690,15 @@ async def get_ultra_fast_feed(
             "total": len(result),
             "offset": offset,
             "limit": limit,
+            "next_cursor": next_cursor,
             "algorithm": algorithm,
             "optimized": True,
             "simplified": True,
             "performance_level": "ultra-fast-simplified"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Ultra-fast feed error: {str(e)}")
         raise HTTPException(status_code=500, detail="Ultra-fast feed temporarily unavailable")
@@ -6045,6 +6713,19 @@ async def get_performance_stats(
     try:
         from database_optimizer import db_optimizer
         from optimized_feed import feed_optimizer
+        from profile_counters import profile_counters
+        from engagement_buffer import engagement_buffer
+        from sharded_counters import sharded_counters
+        from view_ingestion import view_ingestion
+        from search_index import search_index
+        from autocomplete_index import autocomplete_index
+        from hashtag_stats import hashtag_stats
+        from trending_snapshots import trending_snapshots
+        from feed_ranking import feed_ranker
+        from seen_filter import seen_filter
+        from login_security import login_security
+        from task_queue import task_queue
+        from realtime import realtime_gateway
         
         stats = {
             "database_optimizer": {
@@ -6053,8 +6734,24 @@ async def get_performance_stats(
             },
             "feed_optimizer": {
                 "initialized": feed_optimizer is not None, 
-                "cache_stats": feed_optimizer.getCacheStats() if feed_optimizer else None
+                "cache_stats": feed_optimizer.get_cache_stats() if feed_optimizer else None
             },
+            "cache_namespaces": cache_manager.get_stats(),
+            "cache_backend": cache_manager.get_backend_info(),
+            "itunes_lookups": itunes_lookups.get_stats(),
+            "profile_counters": profile_counters.get_stats() if profile_counters else None,
+            "engagement_buffer": engagement_buffer.get_stats() if engagement_buffer else None,
+            "sharded_counters": sharded_counters.get_stats() if sharded_counters else None,
+            "view_ingestion": view_ingestion.get_stats() if view_ingestion else None,
+            "search_index": search_index.get_stats() if search_index else None,
+            "autocomplete_index": autocomplete_index.get_stats() if autocomplete_index else None,
+            "hashtag_stats": hashtag_stats.get_stats() if hashtag_stats else None,
+            "trending_snapshots": trending_snapshots.get_stats() if trending_snapshots else None,
+            "feed_ranker": feed_ranker.get_stats() if feed_ranker else None,
+            "seen_filter": seen_filter.get_stats() if seen_filter else None,
+            "login_security": login_security.get_stats() if login_security else None,
+            "task_queue": task_queue.get_stats() if task_queue else None,
+            "realtime": realtime_gateway.get_stats() if realtime_gateway else None,
             "performance_endpoints": {
                 "ultra_fast_feed": "/api/polls/ultra-fast",
                 "fast_feed": "/api/polls/fast", 
@@ -6205,36 +6902,68 @@ async def get_feed_analytics(
 
 @api_router.get("/polls/following", response_model=List[PollResponse])
 async def get_following_polls(
+    response: Response,
     limit: int = 20,
     offset: int = 0,
+    cursor: Optional[str] = None,
     current_user: UserResponse = Depends(get_current_user)
 ):
-    """Get polls from users that the current user follows"""
-    
-    # Get users that current user follows
-    follow_relationships_cursor = db.follows.find({
-        "follower_id": current_user.id
-    })
-    follow_relationships = await follow_relationships_cursor.to_list(None)
-    
-    if not follow_relationships:
-        return []
-    
-    # Extract following user IDs
-    following_user_ids = [rel["following_id"] for rel in follow_relationships]
+    """
+    Get polls from users that the current user follows.
+    Supports keyset pagination through `cursor` / X-Next-Cursor.
+    """
     
-    # Build filter query to only include polls from followed users
-    filter_query = {
-        "is_active": True,
-        "author_id": {"$in": following_user_ids}
-    }
+    sort_fields = get_sort_fields("following")
     
-    # Get polls from followed users only
-    polls_cursor = db.polls.find(filter_query).sort("created_at", -1).skip(offset).limit(limit)
-    polls = await polls_cursor.to_list(limit)
+    from timeline_materializer import timeline_materializer
+    if timeline_materializer:
+        # Materialized timeline: single indexed range read per page
+        try:
+            page = await timeline_materializer.get_timeline_page(current_user.id, limit, offset, cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        polls, next_cursor = page["polls"], page["next_cursor"]
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        if not polls:
+            return []
+        following_user_ids = list(set(poll["author_id"] for poll in polls))
+    else:
+        # Get users that current user follows
+        follow_relationships_cursor = db.follows.find({
+            "follower_id": current_user.id
+        })
+        follow_relationships = await follow_relationships_cursor.to_list(None)
+        
+        if not follow_relationships:
+            return []
+        
+        # Extract following user IDs
+        following_user_ids = [rel["following_id"] for rel in follow_relationships]
+        
+        # Build filter query to only include polls from followed users
+        filter_query = {
+            "is_active": True,
+            "author_id": {"$in": following_user_ids}
+        }
+        try:
+            filter_query = apply_cursor(filter_query, cursor, sort_fields)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # Get polls from followed users only
+        polls_cursor = db.polls.find(filter_query).sort(get_sort_spec(sort_fields))
+        if not cursor:
+            polls_cursor = polls_cursor.skip(offset)
+        polls = await polls_cursor.limit(limit).to_list(limit)
+        
+        if not polls:
+            return []
+        next_cursor = page_cursor(polls, limit, sort_fields)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
     
-    if not polls:
-        return []
+    polls = await overlay_poll_counters(polls)
     
     # Get all author IDs (should all be in following_user_ids but let's be safe)
     author_ids = list(set(poll["author_id"] for poll in polls))
@@ -6419,6 +7148,7 @@ async def get_user_mentioned_polls(
         
         if not polls:
             return []
+        polls = await overlay_poll_counters(polls)
         
         # Get all unique author IDs
         author_ids = list(set(poll["author_id"] for poll in polls))
@@ -6736,6 +7466,13 @@ async def create_poll(
     
     # Insert into database
     await db.polls.insert_one(poll.model_dump())  # Pydantic v2
+    await refresh_search_index("post", poll.id)
+    await record_hashtag_change(None, poll.model_dump())
+    
+    # Fan out to followers' materialized timelines in background
+    from timeline_materializer import timeline_materializer
+    if timeline_materializer:
+        asyncio.create_task(timeline_materializer.fan_out_poll(poll.model_dump()))
     
     # Send notifications to mentioned users (both general and option-specific)
     all_mentioned_users = set(poll_data.mentioned_users)
@@ -6838,6 +7575,35 @@ async def vote_on_poll(
     poll = await db.polls.find_one({"id": poll_id, "is_active": True})
     if not poll:
         raise HTTPException(status_code=404, detail="Poll not found")
+    await mark_polls_seen(current_user.id, poll_id)
+    
+    # Write-behind mode: buffer the vote, counters are flushed in batches
+    from engagement_buffer import engagement_buffer
+    if engagement_buffer:
+        if not any(option.get("id") == vote_data.option_id for option in poll.get("options", [])):
+            raise HTTPException(status_code=400, detail="Invalid option ID")
+        
+        previous_option = await engagement_buffer.record_vote(current_user.id, poll, vote_data.option_id)
+        await invalidate_follow_status_cache(current_user.id, poll.get("author_id"))
+        if previous_option is None:
+            await push_activity(poll, current_user.id, "vote")
+        updated_poll = (await overlay_poll_counters([poll]))[0]
+        return {
+            "message": "Vote recorded successfully",
+            "poll_id": poll_id,
+            "user_vote": next(
+                idx for idx, option in enumerate(updated_poll.get("options", []))
+                if option.get("id") == vote_data.option_id
+            ),
+            "total_votes": updated_poll.get("total_votes", 0),
+            "options": updated_poll.get("options", [])
+        }
+    
+    # Sharded counters: validate the option up front, counts go to a random shard
+    from sharded_counters import sharded_counters
+    sharded = sharded_counters is not None and await sharded_counters.ensure_sharded(poll)
+    if sharded and not any(option.get("id") == vote_data.option_id for option in poll.get("options", [])):
+        raise HTTPException(status_code=400, detail="Invalid option ID")
     
     # Check if user already voted
     existing_vote = await db.votes.find_one({
@@ -6848,10 +7614,11 @@ async def vote_on_poll(
     if existing_vote:
         # Update existing vote
         # First, decrease vote count from previous option
-        await db.polls.update_one(
-            {"id": poll_id, "options.id": existing_vote["option_id"]},
-            {"$inc": {"options.$.votes": -1, "total_votes": -1}}
-        )
+        if not sharded:
+            await db.polls.update_one(
+                {"id": poll_id, "options.id": existing_vote["option_id"]},
+                {"$inc": {"options.$.votes": -1, "total_votes": -1}}
+            )
         
         # Update vote record
         await db.votes.update_one(
@@ -6868,36 +7635,48 @@ async def vote_on_poll(
         await db.votes.insert_one(vote.dict())
     
     # Increment vote count for new option
-    result = await db.polls.update_one(
-        {"id": poll_id, "options.id": vote_data.option_id},
-        {"$inc": {"options.$.votes": 1, "total_votes": 1}}
-    )
-    
-    if result.modified_count == 0:
-        raise HTTPException(status_code=400, detail="Invalid option ID")
+    if sharded:
+        option_deltas = {vote_data.option_id: 1}
+        if existing_vote:
+            option_deltas[existing_vote["option_id"]] = option_deltas.get(existing_vote["option_id"], 0) - 1
+        await sharded_counters.increment(
+            poll_id,
+            options=option_deltas,
+            total_votes=0 if existing_vote else 1
+        )
+    else:
+        result = await db.polls.update_one(
+            {"id": poll_id, "options.id": vote_data.option_id},
+            {"$inc": {"options.$.votes": 1, "total_votes": 1}}
+        )
+        
+        if result.modified_count == 0:
+            raise HTTPException(status_code=400, detail="Invalid option ID")
     
-    # Update user profiles after vote
+    # Update user profiles after vote (changing an existing vote leaves the counters as they are)
     try:
-        # Update the voter's profile (increment votes_count)
-        await ensure_user_profile(current_user.id)
-        
-        # Update the poll author's profile (increment total_votes received)
         poll_author_id = poll.get("author_id")
-        if poll_author_id:
-            await ensure_user_profile(poll_author_id)
+        if not existing_vote:
+            await asyncio.gather(
+                # Voter's votes_count and the poll author's total_votes received
+                increment_profile_counters(current_user.id, votes_count=1),
+                increment_profile_counters(poll_author_id, total_votes=1)
+            )
             
         # Clear follow status cache for affected users
-        cache_keys_to_clear = [key for key in follow_status_cache.keys() if current_user.id in key or poll_author_id in key]
-        for key in cache_keys_to_clear:
-            follow_status_cache.pop(key, None)
+        await invalidate_follow_status_cache(current_user.id, poll_author_id)
             
     except Exception as e:
         print(f"Error updating profiles after vote: {e}")
     
+    if not existing_vote:
+        await push_activity(poll, current_user.id, "vote")
+    
     # Fetch updated poll data to return
     updated_poll = await db.polls.find_one({"id": poll_id})
     if not updated_poll:
         return {"message": "Vote recorded successfully"}
+    updated_poll = (await overlay_poll_counters([updated_poll]))[0]
     
     # Find which option index the user voted for
     user_vote_index = None
@@ -6914,6 +7693,17 @@ async def vote_on_poll(
         "options": updated_poll.get("options", [])
     }
 
+async def increment_poll_likes(poll: dict, delta: int):
+    """Apply a like delta to a poll, on a counter shard if the poll uses sharded counters"""
+    from sharded_counters import sharded_counters
+    if sharded_counters and await sharded_counters.ensure_sharded(poll):
+        await sharded_counters.increment(poll["id"], likes=delta)
+    else:
+        await db.polls.update_one(
+            {"id": poll["id"]},
+            {"$inc": {"likes": delta}}
+        )
+
 @api_router.post("/polls/{poll_id}/like")
 async def toggle_poll_like(
     poll_id: str,
@@ -6926,6 +7716,18 @@ async def toggle_poll_like(
     if not poll:
         raise HTTPException(status_code=404, detail="Poll not found")
     
+    # Write-behind mode: buffer the toggle, counters are flushed in batches
+    from engagement_buffer import engagement_buffer
+    if engagement_buffer:
+        liked = await engagement_buffer.toggle_like(current_user.id, poll)
+        await invalidate_follow_status_cache(current_user.id, poll.get("author_id"))
+        if liked:
+            await push_activity(poll, current_user.id, "like")
+        return {
+            "liked": liked,
+            "likes": (await overlay_poll_counters([poll]))[0]["likes"]
+        }
+    
     # Check if user already liked
     existing_like = await db.poll_likes.find_one({
         "poll_id": poll_id,
@@ -6940,28 +7742,22 @@ async def toggle_poll_like(
         })
         
         # Decrement like count
-        await db.polls.update_one(
-            {"id": poll_id},
-            {"$inc": {"likes": -1}}
-        )
+        await increment_poll_likes(poll, -1)
         
         # Get updated count
-        updated_poll = await db.polls.find_one({"id": poll_id})
+        updated_poll = (await overlay_poll_counters([await db.polls.find_one({"id": poll_id})]))[0]
         
         # Update user profiles after like removal
         try:
-            # Update the liker's profile (decrement likes_given)
-            await ensure_user_profile(current_user.id)
-            
-            # Update the poll author's profile (decrement likes_count)
             poll_author_id = poll.get("author_id")
-            if poll_author_id:
-                await ensure_user_profile(poll_author_id)
+            await asyncio.gather(
+                # Liker's likes_given and the poll author's likes_count
+                increment_profile_counters(current_user.id, likes_given=-1),
+                increment_profile_counters(poll_author_id, likes_count=-1)
+            )
                 
             # Clear follow status cache for affected users
-            cache_keys_to_clear = [key for key in follow_status_cache.keys() if current_user.id in key or poll_author_id in key]
-            for key in cache_keys_to_clear:
-                follow_status_cache.pop(key, None)
+            await invalidate_follow_status_cache(current_user.id, poll_author_id)
                 
         except Exception as e:
             print(f"Error updating profiles after like removal: {e}")
@@ -6980,32 +7776,28 @@ async def toggle_poll_like(
         await db.poll_likes.insert_one(like.dict())
         
         # Increment like count
-        await db.polls.update_one(
-            {"id": poll_id},
-            {"$inc": {"likes": 1}}
-        )
+        await increment_poll_likes(poll, 1)
         
         # Get updated count
-        updated_poll = await db.polls.find_one({"id": poll_id})
+        updated_poll = (await overlay_poll_counters([await db.polls.find_one({"id": poll_id})]))[0]
         
         # Update user profiles after like addition
         try:
-            # Update the liker's profile (increment likes_given)
-            await ensure_user_profile(current_user.id)
-            
-            # Update the poll author's profile (increment likes_count)
             poll_author_id = poll.get("author_id")
-            if poll_author_id:
-                await ensure_user_profile(poll_author_id)
+            await asyncio.gather(
+                # Liker's likes_given and the poll author's likes_count
+                increment_profile_counters(current_user.id, likes_given=1),
+                increment_profile_counters(poll_author_id, likes_count=1)
+            )
                 
             # Clear follow status cache for affected users
-            cache_keys_to_clear = [key for key in follow_status_cache.keys() if current_user.id in key or poll_author_id in key]
-            for key in cache_keys_to_clear:
-                follow_status_cache.pop(key, None)
+            await invalidate_follow_status_cache(current_user.id, poll_author_id)
                 
         except Exception as e:
             print(f"Error updating profiles after like addition: {e}")
         
+        await push_activity(poll, current_user.id, "like")
+        
         return {
             "liked": True,
             "likes": updated_poll["likes"]
@@ -7068,9 +7860,12 @@ async def get_poll_voters(
     all_votes = await db.votes.find({"poll_id": poll_id}).to_list(length=None)
     unique_voters = len(set(v.get("user_id") for v in all_votes if v.get("user_id")))
     
-    # Count total views from poll_views collection
-    # This counts EVERY view, not unique users - includes repeated views
-    total_views = await db.poll_views.count_documents({"poll_id": poll_id})
+    # Count total views (EVERY view, not unique users - includes repeated views)
+    from view_ingestion import view_ingestion
+    if view_ingestion:
+        total_views = await view_ingestion.get_total_views(poll)
+    else:
+        total_views = await db.poll_views.count_documents({"poll_id": poll_id})
     
     # If no views registered yet, use poll's views field or default to 0
     views = total_views if total_views > 0 else poll.get("views", 0)
@@ -7133,8 +7928,11 @@ async def register_poll_view(
 ):
     """Register a view for a poll - counts every view, even repeated views from same user"""
     
-    # Check if poll exists
-    poll = await db.polls.find_one({"id": poll_id, "is_active": True})
+    # Check if poll exists (only the counter fields are needed)
+    poll = await db.polls.find_one(
+        {"id": poll_id, "is_active": True},
+        {"_id": 0, "id": 1, "views": 1, "sharded_counters": 1}
+    )
     if not poll:
         raise HTTPException(status_code=404, detail="Poll not found")
     
@@ -7162,10 +7960,17 @@ async def register_poll_view(
         "ip_address": request.client.host if request.client else None
     }
     
-    await db.poll_views.insert_one(view_record)
-    
-    # Get total views count for this poll
-    total_views = await db.poll_views.count_documents({"poll_id": poll_id})
+    from view_ingestion import view_ingestion
+    if view_ingestion:
+        # Buffered: bulk-inserted and counted on the next flush, count comes from the views counter
+        viewer_key = user_id or request.headers.get("X-Session-ID") or view_record["ip_address"]
+        total_views = await view_ingestion.record_view(poll, view_record, viewer_key)
+    else:
+        await db.poll_views.insert_one(view_record)
+        
+        # Get total views count for this poll
+        total_views = await db.poll_views.count_documents({"poll_id": poll_id})
+    await mark_polls_seen(user_id, poll_id)
     
     return {
         "success": True,
@@ -7174,6 +7979,31 @@ async def register_poll_view(
         "message": "View registered successfully"
     }
 
+@api_router.get("/polls/{poll_id}/views")
+async def get_poll_view_stats(poll_id: str):
+    """Get total views and the estimated number of unique viewers of a poll"""
+    poll = await db.polls.find_one(
+        {"id": poll_id, "is_active": True},
+        {"_id": 0, "id": 1, "views": 1, "sharded_counters": 1}
+    )
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    
+    from view_ingestion import view_ingestion
+    if not view_ingestion:
+        raise HTTPException(status_code=503, detail="View ingestion is disabled")
+    
+    total_views, unique_viewers = await asyncio.gather(
+        view_ingestion.get_total_views(poll),
+        view_ingestion.estimate_unique_viewers(poll_id)
+    )
+    return {
+        "poll_id": poll_id,
+        "total_views": total_views,
+        "unique_viewers": unique_viewers,
+        "unique_viewers_estimated": True
+    }
+
 
 
 @api_router.get("/polls/{poll_id}", response_model=PollResponse)
@@ -7212,6 +8042,19 @@ async def get_poll_by_id(
         "poll_id": poll_id,
         "user_id": current_user.id
     })
+    user_vote_option = user_vote["option_id"] if user_vote else None
+    user_liked = bool(user_like)
+    
+    # Overlay sharded counters and a vote or like still waiting in the write-behind buffer
+    poll = (await overlay_poll_counters([poll]))[0]
+    from engagement_buffer import engagement_buffer, NOT_PENDING
+    if engagement_buffer:
+        pending_vote = engagement_buffer.get_pending_vote(current_user.id, poll_id)
+        if pending_vote is not NOT_PENDING:
+            user_vote_option = pending_vote
+        pending_like = engagement_buffer.get_pending_like(current_user.id, poll_id)
+        if pending_like is not NOT_PENDING:
+            user_liked = pending_like
     
     # Process options
     options = []
@@ -7262,8 +8105,8 @@ async def get_poll_by_id(
         comments_count=poll["comments_count"],
         saves_count=poll.get("saves_count", 0),
         music=music_info,  # Include music information
-        user_vote=user_vote["option_id"] if user_vote else None,
-        user_liked=bool(user_like),
+        user_vote=user_vote_option,
+        user_liked=user_liked,
         is_featured=poll["is_featured"],
         tags=poll.get("tags", []),
         category=poll.get("category"),
@@ -8525,7 +9368,7 @@ async def get_user_favorites(
 async def check_audio_in_favorites(
     audio_id: str,
     audio_type: str = "system",
-    current_user: UserResponse = Depends(get_current_user)
+    current_user: TokenPrincipal = Depends(get_token_principal)
 ):
     """Check if audio is in user's favorites"""
     try:
@@ -8594,11 +9437,16 @@ async def update_poll(
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="No changes made")
         
+        if "title" in update_data:
+            await refresh_search_index("post", poll_id)
+        
         # Return updated poll (remove MongoDB ObjectId fields)
         updated_poll = await db.polls.find_one({"id": poll_id})
         if updated_poll:
             # Remove MongoDB ObjectId field to avoid serialization issues
             updated_poll.pop('_id', None)
+            if "title" in update_data:
+                await record_hashtag_change(poll, updated_poll)
         return updated_poll
         
     except HTTPException:
@@ -8634,6 +9482,17 @@ async def delete_poll(
         if result.deleted_count == 0:
             raise HTTPException(status_code=400, detail="Failed to delete poll")
         
+        from timeline_materializer import timeline_materializer
+        if timeline_materializer:
+            await timeline_materializer.remove_poll(poll_id)
+        
+        from sharded_counters import sharded_counters
+        if sharded_counters:
+            await sharded_counters.delete_poll(poll_id)
+        
+        await refresh_search_index("post", poll_id)
+        await record_hashtag_change(poll, None)
+        
         return {"message": "Poll deleted successfully"}
         
     except HTTPException:
@@ -8679,6 +9538,10 @@ async def mark_not_interested(
         )
         
         await db.user_preferences.insert_one(preference.dict())
+        from seen_filter import seen_filter
+        if seen_filter:
+            await seen_filter.mark_not_interested(current_user.id, poll_id)
+        await invalidate_feed_slate(current_user.id)
         logger.info(f"✅ Successfully marked poll as not interested: {poll_id}")
         
         return {"success": True, "message": "Content marked as not interested"}
@@ -8724,6 +9587,10 @@ async def hide_user_content(
         )
         
         await db.user_preferences.insert_one(preference.dict())
+        from seen_filter import seen_filter
+        if seen_filter:
+            await seen_filter.hide_author(current_user.id, author_id)
+        await invalidate_feed_slate(current_user.id)
         
         return {"success": True, "message": "User content hidden"}
         
@@ -8879,20 +9746,27 @@ async def get_user_feed_preferences(
 async def filter_polls_by_preferences(polls: List[dict], user_id: str) -> List[dict]:
     """Filter polls based on user's feed preferences"""
     try:
-        # Get user preferences
-        preferences = await db.user_preferences.find({
-            "user_id": user_id
-        }).to_list(1000)
-        
-        # Create sets for faster lookup
-        hidden_users = set()
-        not_interested_polls = set()
-        
-        for pref in preferences:
-            if pref["preference_type"] == "hidden_user" and pref.get("author_id"):
-                hidden_users.add(pref["author_id"])
-            elif pref["preference_type"] == "not_interested" and pref.get("poll_id"):
-                not_interested_polls.add(pref["poll_id"])
+        from seen_filter import seen_filter
+        if seen_filter:
+            # Preferences are kept with the user's seen filter (cached per worker)
+            state = await seen_filter.get(user_id)
+            hidden_users = state["hidden_authors"]
+            not_interested_polls = state["not_interested"]
+        else:
+            # Get user preferences
+            preferences = await db.user_preferences.find({
+                "user_id": user_id
+            }).to_list(1000)
+            
+            # Create sets for faster lookup
+            hidden_users = set()
+            not_interested_polls = set()
+            
+            for pref in preferences:
+                if pref["preference_type"] == "hidden_user" and pref.get("author_id"):
+                    hidden_users.add(pref["author_id"])
+                elif pref["preference_type"] == "not_interested" and pref.get("poll_id"):
+                    not_interested_polls.add(pref["poll_id"])
         
         # Filter polls
         filtered_polls = []
@@ -9044,7 +9918,7 @@ async def get_saved_polls(
         poll_ids = [record["poll_id"] for record in saved_records]
         logger.info(f"📚 Looking up polls with IDs: {poll_ids}")
         
-        polls = await db.polls.find({"id": {"$in": poll_ids}}).to_list(len(poll_ids))
+        polls = await overlay_poll_counters(await db.polls.find({"id": {"$in": poll_ids}}).to_list(len(poll_ids)))
         logger.info(f"📚 Found {len(polls)} actual polls")
         
         # Create a mapping for easier lookup
@@ -9206,10 +10080,10 @@ async def get_liked_polls(
         poll_ids = [record["poll_id"] for record in liked_records]
         logger.info(f"❤️ Looking up polls with IDs: {poll_ids}")
         
-        polls = await db.polls.find({
+        polls = await overlay_poll_counters(await db.polls.find({
             "id": {"$in": poll_ids},
             "is_active": True
-        }).to_list(len(poll_ids))
+        }).to_list(len(poll_ids)))
         logger.info(f"❤️ Found {len(polls)} actual polls")
         
         # Create a mapping for easier lookup
@@ -9369,7 +10243,7 @@ async def get_shared_polls(
 @api_router.get("/polls/{poll_id}/save-status")
 async def get_poll_save_status(
     poll_id: str,
-    current_user: UserResponse = Depends(get_current_user)
+    current_user: TokenPrincipal = Depends(get_token_principal)
 ):
     """Check if a poll is saved by the current user"""
     try:
@@ -9651,70 +10525,53 @@ async def get_search_recommendations(
     current_user: UserResponse = Depends(get_current_user)
 ):
     """Get recommended content for the search page"""
+    # Recommendations are the same for every user
+    cache_key = search_cache_key("recommendations", "", limit)
+    cached = await get_cached_search(cache_key)
+    if cached is not None:
+        return cached
+    
     try:
-        # Get trending polls from last 7 days
-        trending_date = (datetime.utcnow() - timedelta(days=7)).isoformat()
+        # Top of the precomputed trending ranking, hydrated with one polls and one users query
+        from trending_snapshots import trending_snapshots
+        ranked = await trending_snapshots.top(limit) if trending_snapshots else []
+        poll_ids = [entry["id"] for entry in ranked]
         
-        # Aggregate popular polls based on votes and likes
-        pipeline = [
-            {
-                "$match": {
-                    "created_at": {"$gte": trending_date}
-                }
-            },
-            {
-                "$addFields": {
-                    "engagement_count": {
-                        "$add": [
-                            {"$ifNull": ["$votes_count", 0]},
-                            {"$multiply": [{"$ifNull": ["$likes_count", 0]}, 2]},
-                            {"$ifNull": ["$comments_count", 0]}
-                        ]
-                    }
-                }
-            },
-            {
-                "$sort": {"engagement_count": -1}
-            },
-            {
-                "$limit": limit
-            },
-            {
-                "$lookup": {
-                    "from": "users",
-                    "localField": "author_id",
-                    "foreignField": "id",
-                    "as": "author_info"
-                }
-            },
-            {
-                "$addFields": {
-                    "author": {"$arrayElemAt": ["$author_info", 0]}
-                }
-            },
+        polls = await db.polls.find(
+            {"id": {"$in": poll_ids}},
             {
-                "$project": {
-                    "id": 1,
-                    "title": 1,
-                    "content": 1,
-                    "thumbnail_url": 1,
-                    "image_url": 1,
-                    "options": 1,
-                    "engagement_count": 1,
-                    "votes_count": 1,
-                    "likes_count": 1,
-                    "comments_count": 1,
-                    "hashtags": 1,
-                    "created_at": 1,
-                    "type": {"$literal": "poll"},
-                    "author.username": 1,
-                    "author.display_name": 1,
-                    "author.avatar_url": 1
-                }
+                "_id": 0, "id": 1, "title": 1, "content": 1, "thumbnail_url": 1, "image_url": 1,
+                "options": 1, "hashtags": 1, "created_at": 1, "author_id": 1
             }
-        ]
-        
-        recommendations = await db.polls.aggregate(pipeline).to_list(limit)
+        ).to_list(len(poll_ids)) if poll_ids else []
+        polls = {poll["id"]: poll for poll in polls}
+        
+        author_ids = list({poll["author_id"] for poll in polls.values() if poll.get("author_id")})
+        authors = await db.users.find(
+            {"id": {"$in": author_ids}},
+            {"_id": 0, "id": 1, "username": 1, "display_name": 1, "avatar_url": 1}
+        ).to_list(len(author_ids)) if author_ids else []
+        authors = {author["id"]: author for author in authors}
+        
+        recommendations = []
+        for entry in ranked:
+            poll = polls.get(entry["id"])
+            if not poll:
+                continue
+            author = authors.get(poll.pop("author_id", None), {})
+            recommendations.append({
+                **poll,
+                "engagement_count": entry["engagement"],
+                "votes_count": entry["total_votes"],
+                "likes_count": entry["likes_count"],
+                "comments_count": entry["comments_count"],
+                "type": "poll",
+                "author": {
+                    "username": author.get("username"),
+                    "display_name": author.get("display_name"),
+                    "avatar_url": author.get("avatar_url")
+                }
+            })
         
         # Add thumbnail_url from first option if not present
         for rec in recommendations:
@@ -9727,7 +10584,9 @@ async def get_search_recommendations(
                         rec["thumbnail_url"] = option["media_url"]
                         break
         
-        return {"recommendations": recommendations, "total": len(recommendations)}
+        response = {"recommendations": recommendations, "total": len(recommendations)}
+        await cache_search(cache_key, response)
+        return response
         
     except Exception as e:
         logger.error(f"Error getting search recommendations: {str(e)}")
@@ -10347,6 +11206,8 @@ async def create_vs_experience(
         }
         
         await db.polls.insert_one(poll_doc)
+        await refresh_search_index("post", vs_id)
+        await record_hashtag_change(None, poll_doc)
         logger.info(f"Poll inserted successfully for VS: {vs_id}")
         
         logger.info(f"VS experience created: {vs_id} by user {current_user.id}")
@@ -10776,6 +11637,91 @@ async def get_moment_image(filename: str):
     return FileResponse(file_path)
 
 
+# =============  APPLICATION LIFECYCLE =============
+
+@app.on_event("startup")
+async def start_background_services():
+    """Start background services that need the running event loop"""
+    await cache_manager.start()
+    from profile_counters import profile_counters
+    if profile_counters:
+        profile_counters.start()
+    from engagement_buffer import engagement_buffer
+    if engagement_buffer:
+        engagement_buffer.start()
+    from view_ingestion import view_ingestion
+    if view_ingestion:
+        view_ingestion.start()
+    from search_index import search_index
+    if search_index:
+        search_index.start()
+    from autocomplete_index import autocomplete_index
+    if autocomplete_index:
+        autocomplete_index.start()
+    from hashtag_stats import hashtag_stats
+    if hashtag_stats:
+        hashtag_stats.start()
+    from trending_snapshots import trending_snapshots
+    if trending_snapshots:
+        trending_snapshots.start()
+    from seen_filter import seen_filter
+    if seen_filter:
+        seen_filter.start()
+    from login_security import login_security
+    if login_security:
+        await login_security.start()
+    from task_queue import task_queue
+    if task_queue:
+        for name, handler in BACKGROUND_TASK_HANDLERS.items():
+            task_queue.register(name, handler)
+        task_queue.start()
+    from realtime import realtime_gateway
+    if realtime_gateway:
+        realtime_gateway.start()
+    from optimized_feed import feed_optimizer
+    if feed_optimizer:
+        asyncio.create_task(feed_optimizer.warm_up(config.FEED_WARMUP_LIMIT, config.FEED_WARMUP_PAGES))
+
+@app.on_event("shutdown")
+async def stop_background_services():
+    """Stop background services and release connections"""
+    from profile_counters import profile_counters
+    if profile_counters:
+        profile_counters.stop()
+    from engagement_buffer import engagement_buffer
+    if engagement_buffer:
+        await engagement_buffer.stop()
+    from view_ingestion import view_ingestion
+    if view_ingestion:
+        await view_ingestion.stop()
+    from search_index import search_index
+    if search_index:
+        search_index.stop()
+    from autocomplete_index import autocomplete_index
+    if autocomplete_index:
+        autocomplete_index.stop()
+    from hashtag_stats import hashtag_stats
+    if hashtag_stats:
+        hashtag_stats.stop()
+    from trending_snapshots import trending_snapshots
+    if trending_snapshots:
+        trending_snapshots.stop()
+    from seen_filter import seen_filter
+    if seen_filter:
+        await seen_filter.stop()
+    from task_queue import task_queue
+    if task_queue:
+        task_queue.stop()
+    from login_security import login_security
+    if login_security:
+        await login_security.stop()
+    from realtime import realtime_gateway
+    if realtime_gateway:
+        realtime_gateway.stop()
+    await cache_manager.close()
+    if itunes_http_client is not None:
+        await itunes_http_client.aclose()
+
 # Incluir el router en la aplicación
 app.include_router(api_router)
 
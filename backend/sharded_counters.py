@@ -0,0 +1,263 @@
+"""
+Sharded Counters for VotaTok
+Spreads vote/like/view increments for hot polls over K counter documents
+"""
+from typing import Dict, Iterable, List, Optional
+from collections import defaultdict
+import asyncio
+import copy
+import random
+import zlib
+from pymongo import UpdateOne
+from cache_manager import cache_manager
+from config import config
+from database_optimizer import batch_marker
+
+# Scalar counters kept on shards (option votes live under "options.<option_id>")
+SHARDED_FIELDS = ["total_votes", "likes", "views"]
+
+class ShardedCounters:
+    """
+    Opt-in sharded representation of poll counters.
+
+    A sharded poll (`sharded_counters: true` on the poll document) keeps the
+    counter values it had when it was switched over as a base on the poll
+    document; every later increment goes to one of `num_shards` documents in
+    `poll_counter_shards` picked at random, so concurrent votes on a viral
+    poll no longer contend on a single document.
+
+    Readers add the sum of the shards to the base (`overlay_polls`). Sums are
+    cached for a short time per poll (rollup cache). When the feature is
+    enabled, polls are switched over the first time they receive a counter
+    write; polls already switched keep using shards even if it is disabled.
+    """
+
+    def __init__(self, db, num_shards: int = 16, enabled: bool = True):
+        self.db = db
+        self.num_shards = max(1, num_shards)
+        self.enabled = enabled
+        self.rollups = cache_manager.namespace(
+            "counter_rollups",
+            max_size=config.CACHE_CONFIG['COUNTER_ROLLUPS']['MAX_SIZE'],
+            ttl=config.CACHE_CONFIG['COUNTER_ROLLUPS']['TTL_SECONDS']
+        )
+        self.shard_writes = 0
+
+    async def initialize_indexes(self):
+        """Create indexes used by shard writes and rollups"""
+
+        await self.db.poll_counter_shards.create_index([
+            ("poll_id", 1),
+            ("shard", 1)
+        ], unique=True, name="poll_counter_shard")
+
+        print("✅ Sharded counter indexes created successfully")
+
+    # =============  SHARDING STATE =============
+
+    def is_sharded(self, poll: Dict) -> bool:
+        return bool(poll.get("sharded_counters"))
+
+    async def ensure_sharded(self, poll: Dict) -> bool:
+        """Switch a poll to sharded counters if enabled. Returns whether it is sharded"""
+        if self.is_sharded(poll):
+            return True
+        if not self.enabled:
+            return False
+
+        await self.db.polls.update_one(
+            {"id": poll["id"], "sharded_counters": {"$ne": True}},
+            {"$set": {"sharded_counters": True}}
+        )
+        poll["sharded_counters"] = True
+        return True
+
+    async def get_sharded_ids(self, poll_ids: Iterable[str]) -> set:
+        """Poll ids (out of `poll_ids`) that use sharded counters, switching them over if enabled"""
+        poll_ids = list(set(poll_ids))
+        if not poll_ids:
+            return set()
+        if self.enabled:
+            await self.db.polls.update_many(
+                {"id": {"$in": poll_ids}, "sharded_counters": {"$ne": True}},
+                {"$set": {"sharded_counters": True}}
+            )
+            return set(poll_ids)
+
+        docs = await self.db.polls.find(
+            {"id": {"$in": poll_ids}, "sharded_counters": True},
+            {"_id": 0, "id": 1}
+        ).to_list(len(poll_ids))
+        return {doc["id"] for doc in docs}
+
+    # =============  WRITE PATH =============
+
+    def _increments(self, deltas: Dict[str, int], options: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+        increments = {field: delta for field, delta in deltas.items() if delta}
+        for option_id, delta in (options or {}).items():
+            if delta:
+                increments[f"options.{option_id}"] = delta
+        return increments
+
+    async def increment(self, poll_id: str, options: Optional[Dict[str, int]] = None, **deltas: int):
+        """Add deltas (total_votes/likes/views and per-option votes) to a random shard"""
+        increments = self._increments(deltas, options)
+        if not increments:
+            return
+
+        await self.db.poll_counter_shards.update_one(
+            {"poll_id": poll_id, "shard": random.randrange(self.num_shards)},
+            {"$inc": increments},
+            upsert=True
+        )
+        self.shard_writes += 1
+        self.rollups.delete(poll_id)
+
+    async def absorb_counter_updates(self, updates: List[Dict], batch_id: Optional[str] = None) -> List[Dict]:
+        """
+        Route DatabaseOptimizer.update_counters_batch-style updates for sharded
+        polls to shards. Returns the updates for polls that are not sharded.
+
+        With a `batch_id` each poll's increments go to a shard picked from the
+        batch id and are applied at most once, so the batch can be retried.
+        """
+        if not updates:
+            return updates
+        sharded_ids = await self.get_sharded_ids(update["poll_id"] for update in updates)
+        if not sharded_ids:
+            return updates
+
+        remaining = []
+        shard_increments: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        for update in updates:
+            if update["poll_id"] not in sharded_ids or "inc" not in update:
+                remaining.append(update)
+                continue
+            for field, delta in update["inc"].items():
+                if field == "options.$.votes":
+                    field = f"options.{update['option_id']}"
+                shard_increments[update["poll_id"]][field] += delta
+
+        operations = []
+        for poll_id, increments in shard_increments.items():
+            if not batch_id:
+                operations.append(UpdateOne(
+                    {"poll_id": poll_id, "shard": random.randrange(self.num_shards)},
+                    {"$inc": dict(increments)},
+                    upsert=True
+                ))
+                continue
+            # Create the shard first: the marked update must not upsert a second copy of it
+            shard = zlib.crc32(f"{batch_id}:{poll_id}".encode()) % self.num_shards
+            marker = batch_marker(batch_id, "")
+            operations.append(UpdateOne(
+                {"poll_id": poll_id, "shard": shard},
+                {"$setOnInsert": {"poll_id": poll_id, "shard": shard}},
+                upsert=True
+            ))
+            operations.append(UpdateOne(
+                {"poll_id": poll_id, "shard": shard, **marker["filter"]},
+                {"$inc": dict(increments), "$push": marker["push"]}
+            ))
+        if operations:
+            await self.db.poll_counter_shards.bulk_write(operations, ordered=bool(batch_id))
+            self.shard_writes += len(operations)
+            for poll_id in shard_increments:
+                self.rollups.delete(poll_id)
+        return remaining
+
+    # =============  READ PATH =============
+
+    async def get_rollups(self, poll_ids: List[str]) -> Dict[str, Dict]:
+        """Sum of every shard per poll (cached for a short time)"""
+        rollups = {}
+        missing = []
+        for poll_id in poll_ids:
+            cached = self.rollups.get(poll_id)
+            if cached is not None:
+                rollups[poll_id] = cached
+            else:
+                missing.append(poll_id)
+
+        if missing:
+            shards = await self.db.poll_counter_shards.find(
+                {"poll_id": {"$in": missing}},
+                {"_id": 0}
+            ).to_list(None)
+
+            fresh = {
+                poll_id: {**{field: 0 for field in SHARDED_FIELDS}, "options": {}}
+                for poll_id in missing
+            }
+            for shard in shards:
+                rollup = fresh[shard["poll_id"]]
+                for field in SHARDED_FIELDS:
+                    rollup[field] += shard.get(field, 0)
+                for option_id, votes in (shard.get("options") or {}).items():
+                    rollup["options"][option_id] = rollup["options"].get(option_id, 0) + votes
+
+            for poll_id, rollup in fresh.items():
+                self.rollups.set(poll_id, rollup)
+            rollups.update(fresh)
+
+        return rollups
+
+    def apply_rollup(self, poll: Dict, rollup: Dict) -> Dict:
+        """Return a copy of a poll document with its shard totals added to the base counters"""
+        poll = copy.copy(poll)
+        poll["total_votes"] = poll.get("total_votes", 0) + rollup["total_votes"]
+        poll["views"] = poll.get("views", 0) + rollup["views"]
+        if not isinstance(poll.get("likes", 0), list):
+            poll["likes"] = poll.get("likes", 0) + rollup["likes"]
+        if rollup["options"] and poll.get("options"):
+            poll["options"] = [
+                {**option, "votes": option.get("votes", 0) + rollup["options"].get(option.get("id"), 0)}
+                for option in poll["options"]
+            ]
+        return poll
+
+    async def overlay_polls(self, polls: List[Dict]) -> List[Dict]:
+        """Apply shard totals to every sharded poll in a page (one query for all cache misses)"""
+        sharded_ids = [poll["id"] for poll in polls if self.is_sharded(poll)]
+        if not sharded_ids:
+            return polls
+
+        rollups = await self.get_rollups(sharded_ids)
+        return [
+            self.apply_rollup(poll, rollups[poll["id"]]) if poll.get("id") in rollups else poll
+            for poll in polls
+        ]
+
+    async def get_counter(self, poll: Dict, field: str) -> int:
+        """Current value of a scalar counter for a single poll"""
+        if not self.is_sharded(poll):
+            return poll.get(field, 0)
+        rollup = (await self.get_rollups([poll["id"]]))[poll["id"]]
+        return poll.get(field, 0) + rollup[field]
+
+    async def delete_poll(self, poll_id: str):
+        """Remove a deleted poll's shards"""
+        await self.db.poll_counter_shards.delete_many({"poll_id": poll_id})
+        self.rollups.delete(poll_id)
+
+    def get_stats(self) -> Dict:
+        """Get sharded counter statistics"""
+        return {
+            "enabled": self.enabled,
+            "num_shards": self.num_shards,
+            "shard_writes": self.shard_writes,
+            "rollup_cache": self.rollups.get_stats()
+        }
+
+# Global instance
+sharded_counters = None
+
+def init_sharded_counters(db, num_shards: int = 16, enabled: bool = True):
+    """Initialize sharded counters"""
+    global sharded_counters
+    sharded_counters = ShardedCounters(db, num_shards, enabled)
+
+    # Initialize indexes in background
+    asyncio.create_task(sharded_counters.initialize_indexes())
+
+    return sharded_counters
@@ -0,0 +1,227 @@
+"""
+Task Queue for VotaTok
+Durable background tasks stored in Mongo and run by a local worker in each process
+"""
+from typing import Awaitable, Callable, Dict, Optional
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+
+TaskHandler = Callable[[Dict], Awaitable[None]]
+
+class TaskQueue:
+    """
+    Side effects that do not have to finish before a response is sent are
+    inserted into `background_tasks` (one write) and executed by workers
+    running in every process. Tasks enqueued locally are picked up
+    immediately; the rest are found by polling every `poll_interval`.
+
+    A worker claims a task by atomically marking it running with a lease.
+    Tasks whose lease expires (their process died) are claimed again, and
+    failed tasks are retried with exponential backoff up to `max_attempts`,
+    so handlers run at least once and should tolerate repeats.
+    """
+
+    def __init__(
+        self,
+        db,
+        workers: int = 2,
+        poll_interval: float = 1.0,
+        max_attempts: int = 5,
+        lease_seconds: int = 60,
+        stats_interval: float = 5.0
+    ):
+        self.db = db
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease = timedelta(seconds=lease_seconds)
+        self.stats_interval = stats_interval
+        self.instance_id = uuid.uuid4().hex
+        self.handlers: Dict[str, TaskHandler] = {}
+        self.wakeup = asyncio.Event()
+        self.worker_tasks = []
+        self.stats_task: Optional[asyncio.Task] = None
+
+        # Statistics
+        self.enqueued = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.depth = 0
+        self.oldest_pending_seconds = 0.0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+
+    async def initialize_indexes(self):
+        """Create indexes used by the task queue"""
+
+        await self.db.background_tasks.create_index([
+            ("status", 1),
+            ("run_at", 1)
+        ], name="tasks_by_status")
+
+        await self.db.background_tasks.create_index([("id", 1)], unique=True, name="task_id")
+
+        print("✅ Task queue indexes created successfully")
+
+    def register(self, name: str, handler: TaskHandler):
+        """Run `handler(payload)` for tasks enqueued under `name`"""
+        self.handlers[name] = handler
+
+    # =============  WRITE PATH =============
+
+    async def enqueue(self, name: str, payload: Dict, delay_seconds: float = 0) -> str:
+        """Persist a task and wake the local workers. Returns the task id"""
+        now = datetime.utcnow()
+        task = {
+            "id": str(uuid.uuid4()),
+            "name": name,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "created_at": now,
+            "run_at": now + timedelta(seconds=delay_seconds)
+        }
+        await self.db.background_tasks.insert_one(task)
+        self.enqueued += 1
+        self.depth += 1
+        self.wakeup.set()
+        return task["id"]
+
+    # =============  WORKERS =============
+
+    async def _claim(self) -> Optional[Dict]:
+        now = datetime.utcnow()
+        task = await self.db.background_tasks.find_one_and_update(
+            {
+                "name": {"$in": list(self.handlers)},
+                "$or": [
+                    {"status": "pending", "run_at": {"$lte": now}},
+                    {"status": "running", "locked_until": {"$lte": now}}
+                ]
+            },
+            {
+                "$set": {"status": "running", "locked_until": now + self.lease, "owner": self.instance_id},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("run_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+        if task is not None:
+            task["attempts"] += 1
+        return task
+
+    async def _run(self, task: Dict):
+        lag_ms = (datetime.utcnow() - task["run_at"]).total_seconds() * 1000
+        self.last_lag_ms = lag_ms
+        self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+        try:
+            await self.handlers[task["name"]](task["payload"])
+        except Exception as e:
+            if task["attempts"] >= self.max_attempts:
+                self.failed += 1
+                print(f"❌ Background task {task['name']} failed permanently: {e}")
+                await self.db.background_tasks.update_one(
+                    {"id": task["id"]},
+                    {"$set": {"status": "failed", "error": str(e), "failed_at": datetime.utcnow()}}
+                )
+            else:
+                self.retried += 1
+                await self.db.background_tasks.update_one(
+                    {"id": task["id"]},
+                    {"$set": {
+                        "status": "pending",
+                        "error": str(e),
+                        "run_at": datetime.utcnow() + timedelta(seconds=2 ** task["attempts"])
+                    }}
+                )
+            return
+        await self.db.background_tasks.delete_one({"id": task["id"]})
+        self.completed += 1
+        self.depth = max(0, self.depth - 1)
+
+    async def _work_forever(self):
+        while True:
+            try:
+                # Cleared before claiming so a task enqueued meanwhile still wakes us
+                self.wakeup.clear()
+                task = await self._claim()
+                if task is not None:
+                    await self._run(task)
+                    continue
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Task queue worker error: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def refresh_stats(self):
+        """Queue depth and age of the oldest runnable task, across every process"""
+        now = datetime.utcnow()
+        self.depth = await self.db.background_tasks.count_documents({"status": {"$in": ["pending", "running"]}})
+        oldest = await self.db.background_tasks.find_one(
+            {"status": "pending", "run_at": {"$lte": now}},
+            {"_id": 0, "run_at": 1},
+            sort=[("run_at", 1)]
+        )
+        self.oldest_pending_seconds = (now - oldest["run_at"]).total_seconds() if oldest else 0.0
+
+    async def _refresh_stats_forever(self):
+        while True:
+            try:
+                await self.refresh_stats()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Task queue stats refresh failed: {e}")
+            await asyncio.sleep(self.stats_interval)
+
+    def start(self):
+        """Start the local workers"""
+        if not self.worker_tasks:
+            self.worker_tasks = [asyncio.create_task(self._work_forever()) for _ in range(self.workers)]
+            self.stats_task = asyncio.create_task(self._refresh_stats_forever())
+
+    def stop(self):
+        """Stop the local workers (claimed tasks are picked up again once their lease expires)"""
+        for task in self.worker_tasks:
+            task.cancel()
+        self.worker_tasks = []
+        if self.stats_task is not None:
+            self.stats_task.cancel()
+            self.stats_task = None
+
+    def get_stats(self) -> Dict:
+        """Get task queue statistics"""
+        return {
+            "workers": self.workers,
+            "handlers": sorted(self.handlers),
+            "depth": self.depth,
+            "oldest_pending_seconds": round(self.oldest_pending_seconds, 2),
+            "last_lag_ms": round(self.last_lag_ms, 2),
+            "max_lag_ms": round(self.max_lag_ms, 2),
+            "enqueued": self.enqueued,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed
+        }
+
+# Global instance
+task_queue = None
+
+def init_task_queue(db, workers: int = 2, poll_interval: float = 1.0, max_attempts: int = 5, lease_seconds: int = 60):
+    """Initialize the task queue"""
+    global task_queue
+    task_queue = TaskQueue(db, workers, poll_interval, max_attempts, lease_seconds)
+
+    # Initialize indexes in background
+    asyncio.create_task(task_queue.initialize_indexes())
+
+    return task_queue
@@ -0,0 +1,396 @@
+"""
+Timeline Materializer for VotaTok
+Fan-out-on-write timelines for the following feed
+"""
+from typing import List, Dict, Optional, Set
+import asyncio
+from datetime import datetime, timedelta
+from pymongo.errors import BulkWriteError
+from feed_cursor import get_sort_spec, apply_cursor, page_cursor
+
+TIMELINE_SORT_FIELDS = ["created_at"]
+
+# A celebrity is demoted once its followers drop below this share of the cutoff
+# (the gap keeps authors near the cutoff from flapping)
+CELEBRITY_DEMOTE_RATIO = 0.9
+
+class TimelineMaterializer:
+    """
+    Maintains a per-user `user_timelines` collection so /api/polls/following
+    becomes a single indexed range read per page.
+
+    New polls are pushed to every follower's timeline when they are created
+    (fan-out-on-write). Authors with more followers than `fanout_max_followers`
+    are treated as celebrities: their polls are not fanned out and are merged
+    in at read time instead (fan-out-on-read). A celebrity whose followers
+    drop well below the cutoff is demoted: new polls are fanned out again and
+    the ones from before the demotion keep being merged at read time.
+
+    Timelines are backfilled with at most `backfill_limit` polls, so
+    `timeline_state.complete_since` records where a timeline stops being
+    complete; pages past it are read from the followed authors' polls.
+    """
+
+    def __init__(self, db, fanout_max_followers: int = 5000, backfill_limit: int = 200):
+        self.db = db
+        self.fanout_max_followers = fanout_max_followers
+        self.backfill_limit = backfill_limit
+        self.batch_size = 1000
+        self.celebrity_ids: Set[str] = set()
+        self.demoted_celebrities: Dict[str, datetime] = {}
+        self.celebrity_ids_loaded_at = 0.0
+        self.celebrity_ttl = 60  # seconds
+        self.materialized_users: Set[str] = set()
+
+    async def initialize_indexes(self):
+        """Create indexes used by timeline reads and fan-out"""
+
+        await self.db.user_timelines.create_index([
+            ("user_id", 1),
+            ("created_at", -1),
+            ("poll_id", -1)
+        ], name="user_timeline_by_date")
+
+        await self.db.user_timelines.create_index([
+            ("user_id", 1),
+            ("poll_id", 1)
+        ], unique=True, name="user_timeline_poll")
+
+        await self.db.user_timelines.create_index([
+            ("poll_id", 1)
+        ], name="timeline_poll")
+
+        await self.db.timeline_state.create_index([
+            ("user_id", 1)
+        ], unique=True, name="timeline_state_user")
+
+        await self.db.follows.create_index([
+            ("following_id", 1)
+        ], name="followers_by_user")
+
+        await self.db.follows.create_index([
+            ("follower_id", 1),
+            ("following_id", 1)
+        ], name="follower_following")
+
+        print("✅ Timeline indexes created successfully")
+
+    # =============  CELEBRITY ACCOUNTS =============
+
+    async def get_celebrity_ids(self) -> Set[str]:
+        """Authors whose polls are merged at read time (cached for celebrity_ttl seconds, with the demoted ones)"""
+        now = datetime.now().timestamp()
+        if now - self.celebrity_ids_loaded_at > self.celebrity_ttl:
+            docs = await self.db.timeline_celebrities.find({}, {"_id": 0, "user_id": 1, "demoted_at": 1}).to_list(None)
+            self.celebrity_ids = {doc["user_id"] for doc in docs if not doc.get("demoted_at")}
+            self.demoted_celebrities = {doc["user_id"]: doc["demoted_at"] for doc in docs if doc.get("demoted_at")}
+            self.celebrity_ids_loaded_at = now
+        return self.celebrity_ids
+
+    async def is_celebrity(self, author_id: str) -> bool:
+        """Check (and record) whether an author exceeds the fan-out cutoff"""
+        if author_id in await self.get_celebrity_ids():
+            return True
+
+        followers_count = await self.db.follows.count_documents({"following_id": author_id})
+        if followers_count <= self.fanout_max_followers:
+            return False
+
+        await self.db.timeline_celebrities.update_one(
+            {"user_id": author_id},
+            {
+                "$set": {"user_id": author_id, "followers_count": followers_count, "updated_at": datetime.utcnow()},
+                "$unset": {"demoted_at": ""}
+            },
+            upsert=True
+        )
+        self.celebrity_ids.add(author_id)
+        self.demoted_celebrities.pop(author_id, None)
+        return True
+
+    async def review_celebrity(self, author_id: str):
+        """Demote a celebrity whose followers dropped below the cutoff (after an unfollow)"""
+        if author_id not in await self.get_celebrity_ids():
+            return
+
+        followers_count = await self.db.follows.count_documents({"following_id": author_id})
+        if followers_count > self.fanout_max_followers * CELEBRITY_DEMOTE_RATIO:
+            return
+
+        # Workers still holding the old celebrity list skip fan-out for up to
+        # celebrity_ttl seconds, so polls up to then keep being merged on read
+        demoted_at = datetime.utcnow() + timedelta(seconds=2 * self.celebrity_ttl)
+        await self.db.timeline_celebrities.update_one(
+            {"user_id": author_id},
+            {"$set": {"followers_count": followers_count, "updated_at": datetime.utcnow(), "demoted_at": demoted_at}}
+        )
+        self.celebrity_ids.discard(author_id)
+        self.demoted_celebrities[author_id] = demoted_at
+        print(f"⭐ Demoted celebrity author {author_id} ({followers_count} followers), fan-out resumes")
+
+    # =============  WRITE PATH =============
+
+    async def _insert_entries(self, entries: List[Dict]):
+        """Insert timeline entries, ignoring ones that already exist"""
+        if not entries:
+            return
+        try:
+            await self.db.user_timelines.insert_many(entries, ordered=False)
+        except BulkWriteError:
+            # Duplicate (user_id, poll_id) pairs are expected on retries and backfills
+            pass
+
+    async def fan_out_poll(self, poll: Dict):
+        """Push a newly created poll to every follower's timeline"""
+        try:
+            author_id = poll["author_id"]
+            if await self.is_celebrity(author_id):
+                print(f"⭐ Skipping fan-out for celebrity author {author_id} (merged on read)")
+                return
+
+            entry = {
+                "poll_id": poll["id"],
+                "author_id": author_id,
+                "created_at": poll["created_at"]
+            }
+
+            followers_cursor = self.db.follows.find(
+                {"following_id": author_id},
+                {"_id": 0, "follower_id": 1}
+            )
+
+            batch = []
+            delivered = 0
+            async for follow in followers_cursor:
+                batch.append({**entry, "user_id": follow["follower_id"]})
+                if len(batch) >= self.batch_size:
+                    await self._insert_entries(batch)
+                    delivered += len(batch)
+                    batch = []
+            await self._insert_entries(batch)
+            delivered += len(batch)
+
+            print(f"📬 Fanned out poll {poll['id']} to {delivered} timelines")
+
+        except Exception as e:
+            print(f"❌ Timeline fan-out failed for poll {poll.get('id')}: {str(e)}")
+
+    async def remove_poll(self, poll_id: str):
+        """Remove a deleted poll from every timeline"""
+        try:
+            await self.db.user_timelines.delete_many({"poll_id": poll_id})
+        except Exception as e:
+            print(f"❌ Timeline removal failed for poll {poll_id}: {str(e)}")
+
+    async def follow_author(self, user_id: str, author_id: str):
+        """Backfill a timeline with recent polls from a newly followed author"""
+        try:
+            if user_id not in self.materialized_users and not await self.db.timeline_state.find_one({"user_id": user_id}):
+                # Timeline will be built from the follow graph on first read
+                return
+
+            if await self.is_celebrity(author_id):
+                return
+
+            polls = await self.db.polls.find(
+                {"author_id": author_id, "is_active": True},
+                {"_id": 0, "id": 1, "author_id": 1, "created_at": 1}
+            ).sort("created_at", -1).limit(self.backfill_limit).to_list(self.backfill_limit)
+
+            await self._insert_entries([
+                {
+                    "user_id": user_id,
+                    "poll_id": poll["id"],
+                    "author_id": poll["author_id"],
+                    "created_at": poll["created_at"]
+                }
+                for poll in polls
+            ])
+            if len(polls) == self.backfill_limit:
+                # The author's older polls are not materialized: read them from the polls past this point
+                await self.db.timeline_state.update_one(
+                    {"user_id": user_id},
+                    {"$max": {"complete_since": polls[-1]["created_at"]}}
+                )
+        except Exception as e:
+            print(f"❌ Timeline backfill failed for {user_id} -> {author_id}: {str(e)}")
+
+    async def unfollow_author(self, user_id: str, author_id: str):
+        """Drop an unfollowed author's polls from a timeline"""
+        try:
+            await self.db.user_timelines.delete_many({"user_id": user_id, "author_id": author_id})
+            await self.review_celebrity(author_id)
+        except Exception as e:
+            print(f"❌ Timeline cleanup failed for {user_id} -> {author_id}: {str(e)}")
+
+    async def ensure_materialized(self, user_id: str) -> Optional[datetime]:
+        """
+        Build a user's timeline from the follow graph the first time it is read.
+        Returns the time the timeline is complete since (None when it holds every followed poll)
+        """
+        state = await self.db.timeline_state.find_one({"user_id": user_id}, {"_id": 0, "complete_since": 1})
+        if not state:
+            follows = await self.db.follows.find(
+                {"follower_id": user_id},
+                {"_id": 0, "following_id": 1}
+            ).to_list(None)
+            celebrity_ids = await self.get_celebrity_ids()
+            author_ids = [
+                follow["following_id"] for follow in follows
+                if follow["following_id"] not in celebrity_ids
+            ]
+
+            polls = await self.db.polls.find(
+                {"author_id": {"$in": author_ids}, "is_active": True},
+                {"_id": 0, "id": 1, "author_id": 1, "created_at": 1}
+            ).sort("created_at", -1).limit(self.backfill_limit).to_list(self.backfill_limit)
+
+            await self._insert_entries([
+                {
+                    "user_id": user_id,
+                    "poll_id": poll["id"],
+                    "author_id": poll["author_id"],
+                    "created_at": poll["created_at"]
+                }
+                for poll in polls
+            ])
+            state = {"complete_since": polls[-1]["created_at"] if len(polls) == self.backfill_limit else None}
+            await self.db.timeline_state.update_one(
+                {"user_id": user_id},
+                {
+                    "$set": {"user_id": user_id, "materialized_at": datetime.utcnow()},
+                    "$max": {"complete_since": state["complete_since"]}
+                },
+                upsert=True
+            )
+            print(f"🧱 Materialized timeline for {user_id} with {len(polls)} polls")
+
+        self.materialized_users.add(user_id)
+        return state.get("complete_since")
+
+    # =============  READ PATH =============
+
+    async def _read_entries(self, query: Dict, cursor: Optional[str], window: int) -> List[Dict]:
+        """Timeline entries read straight from the polls matching `query` (fan-out-on-read)"""
+        polls = await self.db.polls.find(
+            apply_cursor({**query, "is_active": True}, cursor, TIMELINE_SORT_FIELDS),
+            {"_id": 0, "id": 1, "created_at": 1}
+        ).sort(get_sort_spec(TIMELINE_SORT_FIELDS)).limit(window).to_list(window)
+        return [{"poll_id": poll["id"], "created_at": poll["created_at"]} for poll in polls]
+
+    async def get_timeline_page(
+        self,
+        user_id: str,
+        limit: int = 20,
+        offset: int = 0,
+        cursor: Optional[str] = None
+    ) -> Dict:
+        """
+        Get a page of the following feed: materialized entries merged with
+        polls from followed celebrity accounts (and, past the materialized
+        tail, from every followed account), newest first.
+        When `cursor` is given, `offset` is ignored (keyset pagination).
+        Returns {"polls", "next_cursor"}; the cursor follows the timeline
+        entries, so polls deactivated since they were fanned out don't end
+        the feed early.
+        """
+        complete_since = await self.ensure_materialized(user_id)
+        if cursor:
+            offset = 0
+        window = offset + limit
+
+        # Materialized entries, down to where the timeline stops being complete
+        entries_filter = {"user_id": user_id}
+        if complete_since:
+            entries_filter["created_at"] = {"$gt": complete_since}
+        entries_task = self.db.user_timelines.find(
+            apply_cursor(entries_filter, cursor, TIMELINE_SORT_FIELDS, id_field="poll_id"),
+            {"_id": 0, "poll_id": 1, "created_at": 1}
+        ).sort(get_sort_spec(TIMELINE_SORT_FIELDS, id_field="poll_id")).limit(window).to_list(window)
+
+        celebrity_ids = await self.get_celebrity_ids()
+        merged_ids = celebrity_ids | set(self.demoted_celebrities)
+        if merged_ids:
+            followed_celebrities_task = self.db.follows.find(
+                {"follower_id": user_id, "following_id": {"$in": list(merged_ids)}},
+                {"_id": 0, "following_id": 1}
+            ).to_list(len(merged_ids))
+            entries, followed_celebrities = await asyncio.gather(entries_task, followed_celebrities_task)
+        else:
+            entries, followed_celebrities = await entries_task, []
+        materialized_exhausted = len(entries) < window
+
+        # Fan-out-on-read for celebrity authors (for demoted ones, the polls from before the demotion)
+        clauses = []
+        followed_ids = [follow["following_id"] for follow in followed_celebrities]
+        celebrities = [author_id for author_id in followed_ids if author_id in celebrity_ids]
+        if celebrities:
+            clauses.append({"author_id": {"$in": celebrities}})
+        clauses.extend(
+            {"author_id": author_id, "created_at": {"$lt": self.demoted_celebrities[author_id]}}
+            for author_id in followed_ids
+            if author_id not in celebrity_ids and author_id in self.demoted_celebrities
+        )
+        if clauses:
+            entries.extend(await self._read_entries({"$or": clauses}, cursor, window))
+
+        # Past the materialized tail, fall back to fan-out-on-read over every followed author
+        if complete_since and materialized_exhausted:
+            follows = await self.db.follows.find(
+                {"follower_id": user_id}, {"_id": 0, "following_id": 1}
+            ).to_list(None)
+            author_ids = [follow["following_id"] for follow in follows if follow["following_id"] not in celebrity_ids]
+            if author_ids:
+                entries.extend(await self._read_entries(
+                    {"author_id": {"$in": author_ids}, "created_at": {"$lte": complete_since}}, cursor, window
+                ))
+
+        # A poll can come from several sources (demoted or re-promoted authors, backfills)
+        entries.sort(key=lambda entry: (entry["created_at"], entry["poll_id"]), reverse=True)
+        unique_entries, seen_ids = [], set()
+        for entry in entries:
+            if entry["poll_id"] not in seen_ids:
+                seen_ids.add(entry["poll_id"])
+                unique_entries.append(entry)
+        entries = unique_entries
+
+        page_entries = entries[offset:window]
+        page_ids = [entry["poll_id"] for entry in page_entries]
+        if not page_ids:
+            return {"polls": [], "next_cursor": None}
+        next_cursor = page_cursor(
+            [{"id": entry["poll_id"], "created_at": entry["created_at"]} for entry in page_entries],
+            limit,
+            TIMELINE_SORT_FIELDS
+        )
+
+        polls = await self.db.polls.find(
+            {"id": {"$in": page_ids}, "is_active": True}
+        ).to_list(len(page_ids))
+        polls_dict = {poll["id"]: poll for poll in polls}
+
+        return {
+            "polls": [polls_dict[poll_id] for poll_id in page_ids if poll_id in polls_dict],
+            "next_cursor": next_cursor
+        }
+
+    def get_stats(self) -> Dict:
+        """Get timeline materializer statistics"""
+        return {
+            "materialized_users": len(self.materialized_users),
+            "celebrity_accounts": len(self.celebrity_ids),
+            "fanout_max_followers": self.fanout_max_followers
+        }
+
+# Global instance
+timeline_materializer = None
+
+def init_timeline_materializer(db, fanout_max_followers: int = 5000, backfill_limit: int = 200):
+    """Initialize timeline materializer"""
+    global timeline_materializer
+    timeline_materializer = TimelineMaterializer(db, fanout_max_followers, backfill_limit)
+
+    # Initialize indexes in background
+    asyncio.create_task(timeline_materializer.initialize_indexes())
+
+    return timeline_materializer
@@ -0,0 +1,210 @@
+"""
+Trending Snapshots for VotaTok
+Periodically recomputed time-decayed engagement rankings for trending, recommendations and for_you slates
+"""
+from typing import Dict, List, Optional
+import asyncio
+from datetime import datetime, timedelta
+
+# Engagement weight of each poll counter
+ENGAGEMENT_WEIGHTS = {
+    "likes": 2.0,
+    "votes": 1.0,
+    "comments": 3.0,
+    "views": 0.1
+}
+
+SNAPSHOT_ID = "polls"
+
+def _created_at(poll: Dict) -> Optional[datetime]:
+    created_at = poll.get("created_at")
+    if isinstance(created_at, str):
+        try:
+            created_at = datetime.fromisoformat(created_at.replace("Z", "+00:00")).replace(tzinfo=None)
+        except ValueError:
+            return None
+    return created_at if isinstance(created_at, datetime) else None
+
+def _likes(poll: Dict) -> int:
+    """`likes` is the maintained counter (`likes_count` is only a fallback for polls without it)"""
+    likes = poll.get("likes")
+    if likes is None:
+        return poll.get("likes_count") or 0
+    return len(likes) if isinstance(likes, list) else likes
+
+def _thumbnail(poll: Dict) -> Optional[str]:
+    """First option thumbnail (or media), falling back to the poll-level image"""
+    for option in poll.get("options") or []:
+        if option.get("thumbnail_url"):
+            return option["thumbnail_url"]
+        if option.get("media_url"):
+            return option["media_url"]
+    return poll.get("thumbnail_url") or poll.get("image_url")
+
+def engagement(poll: Dict) -> float:
+    """Weighted likes, votes, comments and views of a poll"""
+    return (
+        ENGAGEMENT_WEIGHTS["likes"] * _likes(poll) +
+        ENGAGEMENT_WEIGHTS["votes"] * (poll.get("total_votes") or 0) +
+        ENGAGEMENT_WEIGHTS["comments"] * (poll.get("comments_count") or 0) +
+        ENGAGEMENT_WEIGHTS["views"] * (poll.get("views") or 0)
+    )
+
+def decayed_score(poll: Dict, now: datetime, half_life_hours: float) -> float:
+    """Engagement halved every `half_life_hours` since creation (+1 so new polls rank by recency)"""
+    created_at = _created_at(poll)
+    age_hours = max(0.0, (now - created_at).total_seconds() / 3600) if created_at else float("inf")
+    return (1 + engagement(poll)) * 0.5 ** (age_hours / half_life_hours)
+
+class TrendingSnapshots:
+    """
+    Recomputes a ranking of the polls created inside the trending window every
+    `interval` seconds, so trending and recommendation endpoints read the top
+    of an in-memory list instead of aggregating over recent polls per request.
+
+    Each poll is scored by its weighted engagement with exponential time decay.
+    The top `size` polls are kept in memory, persisted to `trending_snapshots`
+    (other workers adopt a fresh snapshot instead of recomputing it). Scores
+    change on every recompute, so they are never used as a pagination key.
+    """
+
+    def __init__(self, db, interval: int = 60, size: int = 1000, window_days: int = 7, half_life_hours: float = 24):
+        self.db = db
+        self.interval = interval
+        self.size = size
+        self.window = timedelta(days=window_days)
+        self.half_life_hours = half_life_hours
+        self.refresh_task: Optional[asyncio.Task] = None
+        self.refresh_lock = asyncio.Lock()
+
+        self.entries: List[Dict] = []
+        self.computed_at: Optional[datetime] = None
+
+        # Statistics
+        self.computations = 0
+        self.adoptions = 0
+        self.last_duration_ms = 0.0
+
+    # =============  COMPUTE =============
+
+    async def compute(self):
+        """Rank the polls inside the window and publish the snapshot"""
+        started = datetime.utcnow()
+        polls = await self.db.polls.find(
+            {"is_active": True, "created_at": {"$gte": started - self.window}},
+            {
+                "_id": 0, "id": 1, "author_id": 1, "title": 1, "content": 1, "created_at": 1,
+                "total_votes": 1, "likes": 1, "likes_count": 1, "comments_count": 1, "views": 1,
+                "sharded_counters": 1, "options.thumbnail_url": 1, "options.media_url": 1,
+                "thumbnail_url": 1, "image_url": 1
+            }
+        ).to_list(None)
+
+        # Counters kept outside the poll document
+        from sharded_counters import sharded_counters
+        from engagement_buffer import engagement_buffer
+        if sharded_counters:
+            polls = await sharded_counters.overlay_polls(polls)
+        if engagement_buffer:
+            polls = [engagement_buffer.overlay_poll(poll) for poll in polls]
+
+        for poll in polls:
+            poll["score"] = decayed_score(poll, started, self.half_life_hours)
+        polls.sort(key=lambda poll: poll["score"], reverse=True)
+        ranked = polls[:self.size]
+
+        entries = [
+            {
+                "id": poll["id"],
+                "author_id": poll.get("author_id"),
+                "title": poll.get("title", ""),
+                "content": (poll.get("content") or "")[:100],
+                "thumbnail_url": _thumbnail(poll),
+                "created_at": _created_at(poll),
+                "total_votes": poll.get("total_votes") or 0,
+                "likes_count": _likes(poll),
+                "comments_count": poll.get("comments_count") or 0,
+                "views": poll.get("views") or 0,
+                "engagement": engagement(poll),
+                "score": round(poll["score"], 6)
+            }
+            for poll in ranked
+        ]
+
+        await self.db.trending_snapshots.replace_one(
+            {"_id": SNAPSHOT_ID},
+            {"entries": entries, "computed_at": started},
+            upsert=True
+        )
+        self.entries, self.computed_at = entries, started
+        self.computations += 1
+        self.last_duration_ms = (datetime.utcnow() - started).total_seconds() * 1000
+
+    async def refresh(self):
+        """Adopt a snapshot another worker computed recently, otherwise compute one"""
+        async with self.refresh_lock:
+            snapshot = await self.db.trending_snapshots.find_one({"_id": SNAPSHOT_ID})
+            fresh_after = datetime.utcnow() - timedelta(seconds=self.interval)
+            if snapshot and snapshot.get("computed_at") and snapshot["computed_at"] > fresh_after:
+                if snapshot["computed_at"] != self.computed_at:
+                    self.entries, self.computed_at = snapshot.get("entries", []), snapshot["computed_at"]
+                    self.adoptions += 1
+                return
+            await self.compute()
+
+    async def _refresh_forever(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Trending snapshot refresh failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Start the periodic recompute"""
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self._refresh_forever())
+
+    def stop(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            self.refresh_task = None
+
+    # =============  READS =============
+
+    async def top(self, limit: int, since: Optional[datetime] = None) -> List[Dict]:
+        """Best ranked polls (optionally only those created after `since`)"""
+        if self.computed_at is None:
+            await self.refresh()
+        if since is None:
+            return self.entries[:limit]
+        results = []
+        for entry in self.entries:
+            if entry.get("created_at") and entry["created_at"] >= since:
+                results.append(entry)
+                if len(results) >= limit:
+                    break
+        return results
+
+    def get_stats(self) -> Dict:
+        """Get trending snapshot statistics"""
+        return {
+            "polls_ranked": len(self.entries),
+            "computations": self.computations,
+            "adoptions": self.adoptions,
+            "interval_seconds": self.interval,
+            "half_life_hours": self.half_life_hours,
+            "last_duration_ms": round(self.last_duration_ms, 2),
+            "computed_at": self.computed_at.isoformat() if self.computed_at else None
+        }
+
+# Global instance
+trending_snapshots = None
+
+def init_trending_snapshots(db, interval: int = 60, size: int = 1000, window_days: int = 7, half_life_hours: float = 24):
+    """Initialize trending snapshots"""
+    global trending_snapshots
+    trending_snapshots = TrendingSnapshots(db, interval, size, window_days, half_life_hours)
+    return trending_snapshots
@@ -0,0 +1,438 @@
+"""
+View Ingestion for VotaTok
+Buffered poll impressions with periodic view counters and unique-viewer sketches
+"""
+from typing import Dict, List, Optional
+from collections import Counter
+import asyncio
+import hashlib
+import math
+import uuid
+from datetime import datetime, timedelta
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from database_optimizer import counter_update_operations
+
+DUPLICATE_KEY = 11000
+
+# instance_id of the per-poll sketch that idle workers' sketches are compacted into
+COMPACTED_INSTANCE = "compacted"
+
+class HyperLogLog:
+    """
+    Fixed-size cardinality sketch (2^precision one-byte registers).
+    Standard error is about 1.04 / sqrt(2^precision), 1.6% at precision 12.
+    Sketches merge by taking the register-wise maximum.
+    """
+
+    def __init__(self, precision: int = 12, registers: Optional[bytes] = None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+
+    def add(self, value: str):
+        x = int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+        index = x >> (64 - self.precision)
+        remaining = x & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        for index, rank in enumerate(other.registers):
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            # Small range correction (linear counting)
+            estimate = self.size * math.log(self.size / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+class ViewBatch:
+    """One swapped-out buffer and the steps of its flush that already succeeded"""
+
+    def __init__(self, views: List[Dict], counts: Counter, sketches: Dict[str, "HyperLogLog"]):
+        self.id = uuid.uuid4().hex
+        # Events are keyed by their id, so inserting them again only hits duplicate keys
+        for view in views:
+            view.setdefault("_id", view.get("id") or uuid.uuid4().hex)
+        self.views = views
+        self.counts = counts
+        self.sketches = sketches
+        self.views_written = False
+        self.counter_updates: Optional[List[Dict]] = None
+        self.counters_written = False
+        self.attempts = 0
+
+class ViewIngestion:
+    """
+    Buffers poll impressions in memory and writes them in batches:
+    raw events are bulk-inserted into `poll_views`, the `views` counter on
+    the poll is advanced with one `$inc` per poll per flush (on counter
+    shards for sharded polls), and unique viewers are tracked with
+    HyperLogLog sketches in `poll_view_sketches`.
+
+    Each worker owns one sketch document per poll (keyed by instance id) so
+    sketch updates never race; readers merge every worker's sketch. Sketches
+    not updated for `compact_interval` seconds (restarted workers, polls no
+    longer viewed) are periodically merged into one compacted sketch per poll
+    and deleted, so readers merge at most one document per live worker.
+
+    A batch that fails to write is kept (its views still count) and written
+    again before anything newer. Events are keyed by id and the counter
+    `$inc` carries the batch id, so a retry after a partial write neither
+    duplicates events nor counts views twice.
+    """
+
+    def __init__(
+        self,
+        db,
+        flush_interval_ms: int = 1000,
+        max_pending: int = 10000,
+        precision: int = 12,
+        compact_interval: int = 3600,
+        compact_batch_size: int = 500
+    ):
+        self.db = db
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max_pending
+        self.precision = precision
+        self.compact_interval = compact_interval
+        self.compact_batch_size = compact_batch_size
+        self.instance_id = uuid.uuid4().hex
+        self.flush_task: Optional[asyncio.Task] = None
+        self.compact_task: Optional[asyncio.Task] = None
+        self.flush_lock = asyncio.Lock()
+
+        self.pending_views: List[Dict] = []
+        self.pending_counts: Counter = Counter()
+        self.pending_sketches: Dict[str, HyperLogLog] = {}
+        self.inflight_counts: Counter = Counter()
+        self.retry_batch: Optional[ViewBatch] = None
+
+        # Statistics
+        self.views_buffered = 0
+        self.views_written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_at: Optional[datetime] = None
+        self.sketches_compacted = 0
+        self.last_compacted_at: Optional[datetime] = None
+
+    async def initialize_indexes(self):
+        """Create indexes used by view ingestion"""
+
+        await self.db.poll_views.create_index([
+            ("poll_id", 1),
+            ("viewed_at", -1)
+        ], name="poll_views_by_date")
+
+        await self.db.poll_views.create_index([
+            ("user_id", 1),
+            ("viewed_at", -1)
+        ], name="user_views_by_date")
+
+        await self.db.poll_view_sketches.create_index([
+            ("poll_id", 1),
+            ("instance_id", 1)
+        ], unique=True, name="poll_view_sketch")
+
+        await self.db.poll_view_sketches.create_index([
+            ("updated_at", 1)
+        ], name="poll_view_sketch_updated")
+
+        print("✅ View ingestion indexes created successfully")
+
+    # =============  WRITE PATH =============
+
+    async def _ensure_counter(self, poll: Dict):
+        """Seed the `views` counter of a poll that predates it from its raw events (once)"""
+        if "views" in poll:
+            return
+        views = await self.db.poll_views.count_documents({"poll_id": poll["id"]})
+        await self.db.polls.update_one(
+            {"id": poll["id"], "views": {"$exists": False}},
+            {"$set": {"views": views}}
+        )
+        poll["views"] = views
+
+    async def record_view(self, poll: Dict, view_record: Dict, viewer_key: Optional[str]) -> int:
+        """Buffer one impression. Returns the poll's total view count including buffered views"""
+        await self._ensure_counter(poll)
+
+        poll_id = poll["id"]
+        self.pending_views.append(view_record)
+        self.pending_counts[poll_id] += 1
+        if viewer_key:
+            if poll_id not in self.pending_sketches:
+                self.pending_sketches[poll_id] = HyperLogLog(self.precision)
+            self.pending_sketches[poll_id].add(viewer_key)
+
+        self.views_buffered += 1
+        if len(self.pending_views) >= self.max_pending and not self.flush_lock.locked():
+            asyncio.create_task(self.flush())
+
+        return await self.get_total_views(poll)
+
+    # =============  READ PATH =============
+
+    async def get_total_views(self, poll: Dict) -> int:
+        """Persisted counter (base + shards) plus views not flushed yet"""
+        await self._ensure_counter(poll)
+        from sharded_counters import sharded_counters
+        if sharded_counters:
+            persisted = await sharded_counters.get_counter(poll, "views")
+        else:
+            persisted = poll.get("views", 0)
+        return persisted + self.pending_counts[poll["id"]] + self.inflight_counts[poll["id"]]
+
+    async def estimate_unique_viewers(self, poll_id: str) -> int:
+        """Estimated number of distinct viewers, merged from every worker's sketch"""
+        sketch = HyperLogLog(self.precision)
+        docs = await self.db.poll_view_sketches.find(
+            {"poll_id": poll_id},
+            {"_id": 0, "registers": 1}
+        ).to_list(None)
+        for doc in docs:
+            sketch.merge(HyperLogLog(self.precision, doc["registers"]))
+        if poll_id in self.pending_sketches:
+            sketch.merge(self.pending_sketches[poll_id])
+        if self.retry_batch is not None and poll_id in self.retry_batch.sketches:
+            sketch.merge(self.retry_batch.sketches[poll_id])
+        return sketch.count()
+
+    # =============  FLUSH =============
+
+    async def _flush_sketches(self, sketches: Dict[str, HyperLogLog]):
+        existing = await self.db.poll_view_sketches.find(
+            {"poll_id": {"$in": list(sketches)}, "instance_id": self.instance_id},
+            {"_id": 0, "poll_id": 1, "registers": 1}
+        ).to_list(len(sketches))
+        for doc in existing:
+            sketches[doc["poll_id"]].merge(HyperLogLog(self.precision, doc["registers"]))
+
+        await self.db.poll_view_sketches.bulk_write([
+            UpdateOne(
+                {"poll_id": poll_id, "instance_id": self.instance_id},
+                {"$set": {"registers": sketch.to_bytes(), "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+            for poll_id, sketch in sketches.items()
+        ], ordered=False)
+
+    async def _write_views(self, views: List[Dict]):
+        try:
+            await self.db.poll_views.insert_many(views, ordered=False)
+        except BulkWriteError as e:
+            # Events inserted by an earlier attempt of the same batch
+            if any(error.get("code") != DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                raise
+
+    async def _write_counters(self, batch: ViewBatch):
+        from sharded_counters import sharded_counters
+
+        if batch.counter_updates is None:
+            counter_updates = [
+                {"poll_id": poll_id, "inc": {"views": count}}
+                for poll_id, count in batch.counts.items()
+            ]
+            if sharded_counters:
+                counter_updates = await sharded_counters.absorb_counter_updates(counter_updates, batch.id)
+            batch.counter_updates = counter_updates
+        if batch.counter_updates:
+            await self.db.polls.bulk_write(counter_update_operations(batch.counter_updates, batch.id), ordered=False)
+
+    async def _write_batch(self, batch: ViewBatch):
+        """Write a batch's remaining steps: events, then view counters, then sketches (merging is idempotent)"""
+        batch.attempts += 1
+        if not batch.views_written:
+            await self._write_views(batch.views)
+            batch.views_written = True
+        if not batch.counters_written:
+            await self._write_counters(batch)
+            batch.counters_written = True
+        if batch.sketches:
+            await self._flush_sketches(batch.sketches)
+
+    async def flush(self) -> int:
+        """
+        Write every buffered impression, after the batch left over by a
+        failed flush (if any). Returns the number of views written
+        """
+        async with self.flush_lock:
+            written = 0
+            # At most the retried batch and one fresh one
+            for _ in range(2):
+                if self.retry_batch is None:
+                    if not self.pending_views:
+                        break
+                    # Swap buffers before the first await so new views go to a fresh buffer
+                    self.retry_batch = ViewBatch(self.pending_views, self.pending_counts, self.pending_sketches)
+                    self.inflight_counts = self.pending_counts
+                    self.pending_views, self.pending_counts, self.pending_sketches = [], Counter(), {}
+
+                batch = self.retry_batch
+                try:
+                    await self._write_batch(batch)
+                except Exception as e:
+                    self.failed_flushes += 1
+                    print(f"❌ View ingestion flush failed (attempt {batch.attempts}, kept for retry): {e}")
+                    return written
+
+                self.retry_batch = None
+                self.inflight_counts = Counter()
+                written += len(batch.views)
+                self.flushes += 1
+                self.views_written += len(batch.views)
+                self.last_flush_at = datetime.utcnow()
+            return written
+
+    # =============  COMPACTION =============
+
+    async def _merge_compacted(self, poll_id: str, sketch: HyperLogLog) -> bool:
+        """Merge into a poll's compacted sketch (optimistic, retried on concurrent compactions)"""
+        for _ in range(3):
+            doc = await self.db.poll_view_sketches.find_one(
+                {"poll_id": poll_id, "instance_id": COMPACTED_INSTANCE},
+                {"_id": 1, "registers": 1, "version": 1}
+            )
+            if doc is None:
+                try:
+                    await self.db.poll_view_sketches.insert_one({
+                        "poll_id": poll_id,
+                        "instance_id": COMPACTED_INSTANCE,
+                        "registers": sketch.to_bytes(),
+                        "version": 0,
+                        "updated_at": datetime.utcnow()
+                    })
+                    return True
+                except DuplicateKeyError:
+                    continue
+            merged = HyperLogLog(self.precision, doc["registers"])
+            merged.merge(sketch)
+            result = await self.db.poll_view_sketches.update_one(
+                {"_id": doc["_id"], "version": doc.get("version", 0)},
+                {"$set": {"registers": merged.to_bytes(), "updated_at": datetime.utcnow()}, "$inc": {"version": 1}}
+            )
+            if result.matched_count:
+                return True
+        return False
+
+    async def compact_sketches(self) -> int:
+        """
+        Fold worker sketches idle for `compact_interval` into the per-poll
+        compacted sketch. Returns the number of worker sketches removed
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=self.compact_interval)
+        compacted = 0
+        while True:
+            docs = await self.db.poll_view_sketches.find(
+                {"instance_id": {"$ne": COMPACTED_INSTANCE}, "updated_at": {"$lt": cutoff}},
+                {"_id": 1, "poll_id": 1, "registers": 1, "updated_at": 1}
+            ).limit(self.compact_batch_size).to_list(self.compact_batch_size)
+            if not docs:
+                break
+
+            by_poll: Dict[str, List[Dict]] = {}
+            for doc in docs:
+                by_poll.setdefault(doc["poll_id"], []).append(doc)
+
+            deletions = []
+            for poll_id, poll_docs in by_poll.items():
+                sketch = HyperLogLog(self.precision)
+                for doc in poll_docs:
+                    sketch.merge(HyperLogLog(self.precision, doc["registers"]))
+                if await self._merge_compacted(poll_id, sketch):
+                    # Only if untouched since read: a worker that flushed meanwhile keeps its sketch
+                    deletions.extend(DeleteOne({"_id": doc["_id"], "updated_at": doc["updated_at"]}) for doc in poll_docs)
+            if not deletions:
+                break
+            result = await self.db.poll_view_sketches.bulk_write(deletions, ordered=False)
+            compacted += result.deleted_count
+            if len(docs) < self.compact_batch_size:
+                break
+
+        self.sketches_compacted += compacted
+        self.last_compacted_at = datetime.utcnow()
+        return compacted
+
+    async def _compact_forever(self):
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await self.compact_sketches()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ View sketch compaction failed: {e}")
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ View ingestion flush loop error: {e}")
+
+    def start(self):
+        """Start the periodic flush loop"""
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_forever())
+        if self.compact_task is None and self.compact_interval > 0:
+            self.compact_task = asyncio.create_task(self._compact_forever())
+
+    async def stop(self):
+        """Stop the flush loop and write whatever is still buffered"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if self.compact_task is not None:
+            self.compact_task.cancel()
+            self.compact_task = None
+        await self.flush()
+        if self.retry_batch is not None:
+            print(f"⚠️  View ingestion stopped with {len(self.retry_batch.views)} unwritten views")
+
+    def get_stats(self) -> Dict:
+        """Get view ingestion statistics"""
+        return {
+            "pending_views": len(self.pending_views),
+            "pending_polls": len(self.pending_counts),
+            "views_buffered": self.views_buffered,
+            "views_written": self.views_written,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "retry_pending": self.retry_batch is not None,
+            "flush_interval_ms": int(self.flush_interval * 1000),
+            "last_flush_at": self.last_flush_at.isoformat() if self.last_flush_at else None,
+            "sketches_compacted": self.sketches_compacted,
+            "last_compacted_at": self.last_compacted_at.isoformat() if self.last_compacted_at else None
+        }
+
+# Global instance
+view_ingestion = None
+
+def init_view_ingestion(
+    db,
+    flush_interval_ms: int = 1000,
+    max_pending: int = 10000,
+    precision: int = 12,
+    compact_interval: int = 3600
+):
+    """Initialize view ingestion"""
+    global view_ingestion
+    view_ingestion = ViewIngestion(db, flush_interval_ms, max_pending, precision, compact_interval)
+
+    # Initialize indexes in background
+    asyncio.create_task(view_ingestion.initialize_indexes())
+
+    return view_ingestion
@@ -7,7 +7,7 @@ import { useToast } from '../hooks/use-toast';
 import { useAuth } from '../contexts/AuthContext';
 
 const ChangePasswordModal = ({ isOpen, onClose }) => {
-  const { apiRequest } = useAuth();
+  const { apiRequest, user, setAuthData } = useAuth();
   const { toast } = useToast();
   const [loading, setLoading] = useState(false);
   const [showPasswords, setShowPasswords] = useState({
@@ -92,6 +92,10 @@ const ChangePasswordModal = ({ isOpen, onClose }) => {
 
       if (response.ok) {
         const data = await response.json();
+        // Tokens issued before the change are revoked; keep this device signed in
+        if (data.access_token && user) {
+          setAuthData(user, data.access_token);
+        }
         toast({
           title: "¡Contraseña actualizada!",
           description: "Tu contraseña se ha cambiado exitosamente",
@@ -621,6 +621,7 @@ export const AuthProvider = ({ children }) => {
     logout,
     refreshUser,
     updateUser,
+    setAuthData,
     clearError,
     
     // Utilities
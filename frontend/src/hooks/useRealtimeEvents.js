@@ -0,0 +1,89 @@
+import { useEffect, useRef, useState } from 'react';
+import AppConfig from '../config/config.js';
+
+const MAX_RECONNECT_DELAY = 30000;
+// Intentos seguidos sin llegar a abrir el socket antes de dejar de reintentar
+const MAX_HANDSHAKE_FAILURES = 5;
+// 1008: token inválido o revocado. 4000: reemplazado por una conexión más nueva del mismo usuario
+const NO_RECONNECT_CODES = [1008, 4000];
+
+/**
+ * Hook para recibir eventos en tiempo real (mensajes, solicitudes de chat, seguidores y actividad)
+ * Mantiene un WebSocket con /api/ws y reconecta con backoff exponencial si se cae
+ */
+export const useRealtimeEvents = (onEvent, enabled = true) => {
+  const [connected, setConnected] = useState(false);
+  const onEventRef = useRef(onEvent);
+
+  useEffect(() => {
+    onEventRef.current = onEvent;
+  }, [onEvent]);
+
+  useEffect(() => {
+    const token = localStorage.getItem('token');
+    if (!enabled || !token) {
+      return;
+    }
+
+    let socket = null;
+    let reconnectTimer = null;
+    let attempts = 0;
+    let handshakeFailures = 0;
+    let closedByUs = false;
+
+    const connect = () => {
+      const wsUrl = AppConfig.BACKEND_URL.replace(/^http/, 'ws');
+      socket = new WebSocket(`${wsUrl}/api/ws?token=${encodeURIComponent(token)}`);
+
+      let opened = false;
+
+      socket.onopen = () => {
+        opened = true;
+        attempts = 0;
+        handshakeFailures = 0;
+        setConnected(true);
+      };
+
+      socket.onmessage = (message) => {
+        try {
+          const event = JSON.parse(message.data);
+          if (event.type === 'ping' || event.type === 'pong' || event.type === 'ready') {
+            return;
+          }
+          onEventRef.current?.(event);
+        } catch (error) {
+          console.warn('Realtime event could not be parsed:', error);
+        }
+      };
+
+      socket.onclose = (closeEvent) => {
+        setConnected(false);
+        if (closedByUs || NO_RECONNECT_CODES.includes(closeEvent.code)) {
+          return;
+        }
+        // Un socket que nunca abrió (p. ej. 1006 en el handshake) cuenta como fallo
+        if (!opened) {
+          handshakeFailures += 1;
+          if (handshakeFailures >= MAX_HANDSHAKE_FAILURES) {
+            return;
+          }
+        }
+        const delay = Math.min(1000 * 2 ** attempts, MAX_RECONNECT_DELAY);
+        attempts += 1;
+        reconnectTimer = setTimeout(connect, delay);
+      };
+    };
+
+    connect();
+
+    return () => {
+      closedByUs = true;
+      clearTimeout(reconnectTimer);
+      socket?.close();
+    };
+  }, [enabled]);
+
+  return { connected };
+};
+
+export default useRealtimeEvents;
@@ -3,6 +3,7 @@ import { useSearchParams, useNavigate } from 'react-router-dom';
 import { Plus, Search, ArrowLeft, Send, Camera, Mic, Smile, Users, Bell, MessageCircle, Phone, User } from 'lucide-react';
 import { useAuth } from '../contexts/AuthContext';
 import { useToast } from '../hooks/use-toast';
+import useRealtimeEvents from '../hooks/useRealtimeEvents';
 import { cn } from '../lib/utils';
 import { motion, AnimatePresence } from 'framer-motion';
 
@@ -480,6 +481,16 @@ const MessagesPage = () => {
 
   // ===================== EFFECT HOOKS =====================
 
+  // New messages are pushed over the realtime connection
+  const { connected: realtimeConnected } = useRealtimeEvents((event) => {
+    if (event.type === 'message' || event.type === 'chat_request_response') {
+      loadConversations();
+      if (event.type === 'message' && selectedConversation?.id === event.data.conversation_id) {
+        loadMessages(event.data.conversation_id);
+      }
+    }
+  }, !!user?.id);
+
   useEffect(() => {
     const handleResize = () => setIsMobile(window.innerWidth < 768);
     window.addEventListener('resize', handleResize);
@@ -497,8 +508,8 @@ const MessagesPage = () => {
       console.log('🔄 UseEffect: Loading messages for conversation:', selectedConversation.id);
       loadMessages(selectedConversation.id);
       
-      // Set up polling for new messages (don't poll for chat requests)
-      if (!selectedConversation.is_chat_request) {
+      // Poll for new messages only while the realtime connection is down (don't poll for chat requests)
+      if (!selectedConversation.is_chat_request && !realtimeConnected) {
         const interval = setInterval(() => {
           loadMessages(selectedConversation.id);
         }, 5000);
@@ -506,7 +517,7 @@ const MessagesPage = () => {
         return () => clearInterval(interval);
       }
     }
-  }, [selectedConversation?.id]);
+  }, [selectedConversation?.id, realtimeConnected]);
 
   // Auto-scroll to bottom when new messages arrive
   useEffect(() => {
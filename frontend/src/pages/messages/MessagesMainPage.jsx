@@ -4,6 +4,7 @@ import { MessageCircle, X, ArrowLeft, Users, Bell, Send, Plus, Inbox, User } fro
 import { useNavigate, useLocation } from 'react-router-dom';
 import { useAuth } from '../../contexts/AuthContext';
 import AppConfig from '../../config/config.js';
+import useRealtimeEvents from '../../hooks/useRealtimeEvents';
 
 const MessagesMainPage = () => {
   const navigate = useNavigate();
@@ -313,6 +314,39 @@ const MessagesMainPage = () => {
     }
   }, [user]);
 
+  // Eventos en tiempo real: actualizar conversaciones y badges sin volver a consultar los contadores
+  const bumpSegmentCount = (segment) => {
+    setSegmentData(prev => ({
+      ...prev,
+      [segment]: { ...prev[segment], count: (prev[segment]?.count || 0) + 1 }
+    }));
+  };
+
+  useRealtimeEvents((event) => {
+    switch (event.type) {
+      case 'message':
+        loadConversations();
+        if (selectedConversation?.id === event.data.conversation_id) {
+          loadMessages(event.data.conversation_id);
+        }
+        break;
+      case 'chat_request':
+        bumpSegmentCount('messages');
+        break;
+      case 'chat_request_response':
+        loadConversations();
+        break;
+      case 'follow':
+        bumpSegmentCount('followers');
+        break;
+      case 'activity':
+        bumpSegmentCount('activity');
+        break;
+      default:
+        break;
+    }
+  }, !!user);
+
   // Manejar apertura de conversación desde navegación
   useEffect(() => {
     if (location.state?.openConversation) {